@@ -110,6 +110,11 @@ class AsyncStatsClient:
         return [f'{self._prefix}{t2[1]}:{((t2[0] - t1[0]) * 1000):0.6f}|ms' for t1,
                 t2 in sliding_window(2, timings)]
 
+    def flush(self) -> None:
+        """send the stats queued so far"""
+        if self._stats:
+            self._sendbatch()
+
     def _sendbatch(self, stats: deque = None):
         try:
             stats = stats or self._stats
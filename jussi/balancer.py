@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from time import perf_counter
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+import structlog
+from async_timeout import timeout
+
+from .concurrency import ConcurrencyLimiter
+from .concurrency import ConcurrencyPolicy
+from .errors import UpstreamUnavailableError
+
+logger = structlog.get_logger(__name__)
+
+'''
+Load balancing between the urls configured for one upstream prefix.
+
+A prefix may map to a list of urls, the balancer for that list picks the
+endpoint for each upstream request:
+
+- round_robin: each endpoint in turn
+- least_outstanding: the endpoint with the fewest requests in flight
+- ewma: the endpoint with the lowest moving average latency, weighted by
+  its requests in flight
+
+Endpoints are picked when a request is sent upstream, not when it is
+routed, so requests in flight are counted for every strategy.
+
+Each endpoint also has a circuit breaker. After `consecutive_failures`
+errors, timeouts or requests slower than `max_latency` in a row, the
+endpoint is ejected for `ejection_time` seconds. Then one probe request at
+a time is let through (half-open). A successful probe closes the breaker,
+a failed one ejects the endpoint again. Requests time out inside their
+endpoint context, after the time left before their client request times
+out, so an endpoint which never answers is ejected. Requests cancelled from
+outside, eg when a client disconnects, are neither failures nor successes.
+
+At most `max_ejection_percent` of the endpoints of a prefix are ejected at
+once, and never the last endpoint in service, so a prefix with one url is
+never ejected. When every endpoint is ejected anyway, eg by hand, requests
+fail fast with UpstreamUnavailableError.
+'''
+
+ROUND_ROBIN = 'round_robin'
+LEAST_OUTSTANDING = 'least_outstanding'
+EWMA = 'ewma'
+STRATEGIES = (ROUND_ROBIN, LEAST_OUTSTANDING, EWMA)
+
+# weight of the newest latency sample in the moving average
+EWMA_ALPHA = 0.3
+
+# separates the urls of one prefix in a url group, urls can't contain spaces
+URL_GROUP_SEPARATOR = ' '
+
+
+def url_group(urls: Iterable[str]) -> str:
+    return URL_GROUP_SEPARATOR.join(urls)
+
+
+def url_group_urls(group: str) -> List[str]:
+    return group.split(URL_GROUP_SEPARATOR)
+
+
+class HealthPolicy(NamedTuple):
+    # failures in a row which eject an endpoint, 0 never ejects
+    consecutive_failures: int = 5
+    # seconds before an ejected endpoint is probed
+    ejection_time: float = 10.0
+    # requests slower than this many seconds are failures, 0 disables
+    max_latency: float = 0.0
+    # endpoints of a prefix which may be ejected at once, at least one stays
+    max_ejection_percent: float = 50.0
+
+
+DEFAULT_HEALTH_POLICY = HealthPolicy()
+
+
+# pylint: disable=too-many-instance-attributes
+class Endpoint:
+    __slots__ = ('url', 'policy', 'outstanding', 'latency', 'requests',
+                 'failures', 'ejections', 'ejected_until', 'probing')
+
+    def __init__(self, url: str, policy: HealthPolicy = DEFAULT_HEALTH_POLICY) -> None:
+        self.url = url
+        self.policy = policy
+        self.outstanding = 0
+        self.latency = 0.0
+        self.requests = 0
+        # circuit breaker
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.probing = False
+
+    def available(self, now: float) -> bool:
+        if not self.ejected_until:
+            return True
+        # half-open, one probe at a time
+        return now >= self.ejected_until and not self.probing
+
+    def record(self, latency: float, failed: bool = False) -> bool:
+        """True if the endpoint should be ejected"""
+        if self.requests:
+            self.latency += EWMA_ALPHA * (latency - self.latency)
+        else:
+            self.latency = latency
+        self.requests += 1
+
+        policy = self.policy
+        if policy.max_latency and latency > policy.max_latency:
+            failed = True
+        if not failed:
+            if self.ejected_until:
+                logger.info('upstream endpoint restored', url=self.url)
+            self.failures = 0
+            self.ejected_until = 0.0
+            self.probing = False
+            return False
+        self.failures += 1
+        return self.probing or bool(policy.consecutive_failures and
+                                    self.failures >= policy.consecutive_failures)
+
+    def eject(self) -> None:
+        self.ejections += 1
+        self.ejected_until = perf_counter() + self.policy.ejection_time
+        self.probing = False
+        logger.warning('upstream endpoint ejected', url=self.url,
+                       failures=self.failures, ejection_time=self.policy.ejection_time)
+
+    @property
+    def load(self) -> float:
+        return self.latency * (self.outstanding + 1)
+
+    @property
+    def state(self) -> str:
+        if not self.ejected_until:
+            return 'closed'
+        if perf_counter() < self.ejected_until:
+            return 'open'
+        return 'half_open'
+
+    def stats(self) -> dict:
+        return {
+            'url': self.url,
+            'outstanding': self.outstanding,
+            'latency': self.latency,
+            'requests': self.requests,
+            'state': self.state,
+            'failures': self.failures,
+            'ejections': self.ejections
+        }
+
+
+class EndpointRequest:
+    """context manager which counts an upstream request against its endpoint
+
+    The request times out after `timeout` seconds, raising
+    asyncio.TimeoutError inside the context.
+    """
+    __slots__ = ('balancer', 'endpoint', '_timeout', '_start')
+
+    def __init__(self, balancer: 'Balancer', endpoint: Endpoint,
+                 timeout_seconds: Optional[float] = None) -> None:
+        self.balancer = balancer
+        self.endpoint = endpoint
+        self._timeout = timeout(timeout_seconds)
+        self._start = None
+
+    def __enter__(self) -> str:
+        endpoint = self.endpoint
+        if endpoint.ejected_until:
+            endpoint.probing = True
+        endpoint.outstanding += 1
+        self._start = perf_counter()
+        self._timeout.__enter__()
+        return endpoint.url
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        endpoint = self.endpoint
+        endpoint.outstanding -= 1
+        try:
+            # turns the cancellation of a timed out request into TimeoutError
+            self._timeout.__exit__(exc_type, exc_value, traceback)
+        except asyncio.TimeoutError:
+            self._record(failed=True)
+            raise
+        if exc_type is not None and issubclass(exc_type, asyncio.CancelledError):
+            # cancelled from outside, eg the client went away, let another
+            # request probe the endpoint
+            endpoint.probing = False
+            return
+        # errors and timeouts both count as failures
+        self._record(failed=exc_type is not None)
+
+    def _record(self, failed: bool) -> None:
+        if self.endpoint.record(perf_counter() - self._start, failed=failed):
+            self.balancer.eject(self.endpoint)
+
+
+class Balancer:
+    """picks one of the urls configured for an upstream prefix"""
+    __slots__ = ('strategy', 'endpoints', 'limiter', '_next')
+
+    def __init__(self, urls: List[str], strategy: str = ROUND_ROBIN,
+                 policy: HealthPolicy = DEFAULT_HEALTH_POLICY,
+                 concurrency: Optional[ConcurrencyPolicy] = None) -> None:
+        if strategy not in STRATEGIES:
+            raise ValueError(f'unknown load balancing strategy {strategy}')
+        self.strategy = strategy
+        self.endpoints = [Endpoint(url, policy=policy) for url in urls]
+        # admission control for the whole prefix, not per endpoint
+        self.limiter = None
+        if concurrency is not None:
+            self.limiter = ConcurrencyLimiter(url_group(urls), concurrency)
+        self._next = 0
+
+    def select(self) -> Optional[Endpoint]:
+        """the endpoint for the next request, None if all are ejected"""
+        endpoints = self.endpoints
+        now = perf_counter()
+        if len(endpoints) == 1:
+            endpoint = endpoints[0]
+            return endpoint if endpoint.available(now) else None
+        # rotate the starting point so ties are shared between endpoints
+        start = self._next
+        self._next = (start + 1) % len(endpoints)
+        rotated = [e for e in endpoints[start:] + endpoints[:start] if e.available(now)]
+        if not rotated:
+            return None
+        if self.strategy == ROUND_ROBIN:
+            return rotated[0]
+        if self.strategy == LEAST_OUTSTANDING:
+            return min(rotated, key=lambda e: e.outstanding)
+        return min(rotated, key=lambda e: e.load)
+
+    def request(self, timeout_seconds: Optional[float] = None) -> EndpointRequest:
+        endpoint = self.select()
+        if endpoint is None:
+            raise UpstreamUnavailableError(url=url_group(e.url for e in self.endpoints))
+        return EndpointRequest(self, endpoint, timeout_seconds)
+
+    @property
+    def max_ejections(self) -> int:
+        endpoints = len(self.endpoints)
+        policy = self.endpoints[0].policy
+        return min(endpoints - 1, int(endpoints * policy.max_ejection_percent / 100))
+
+    def eject(self, endpoint: Endpoint) -> None:
+        """eject an endpoint, unless too many endpoints are already ejected"""
+        if not endpoint.ejected_until:
+            ejected = sum(1 for e in self.endpoints if e.ejected_until)
+            if ejected >= self.max_ejections:
+                logger.warning('upstream endpoint not ejected, too many endpoints ejected',
+                               url=endpoint.url, failures=endpoint.failures,
+                               ejected=ejected)
+                return
+        endpoint.eject()
+
+    def stats(self) -> dict:
+        stats = {
+            'strategy': self.strategy,
+            'endpoints': [endpoint.stats() for endpoint in self.endpoints]
+        }
+        if self.limiter is not None:
+            stats['concurrency'] = self.limiter.stats()
+        return stats
@@ -12,7 +12,9 @@ from aredis import StrictRedis
 
 from .cache_group import CacheGroup
 from ..typedefs import WebApp
+from .backends.block_store import BlockStore
 from .backends.redis import Cache
+from .backends.shared_memory import SharedMemoryCache
 
 logger = structlog.get_logger(__name__)
 
@@ -58,5 +60,29 @@ def setup_caches(app: WebApp, loop) -> Any:
                                        write=False,
                                        speed_tier=SpeedTier.SLOW))
 
-    configured_cache_group = CacheGroup(caches=caches)
+    shared_memory_cache = None
+    if args.shared_memory_cache_path:
+        try:
+            shared_memory_cache = SharedMemoryCache(args.shared_memory_cache_path,
+                                                    size=args.shared_memory_cache_size)
+        except Exception as e:
+            logger.error('failed to add shared memory cache', exception=e)
+
+    block_store = None
+    if args.irreversible_block_store_path:
+        try:
+            block_store = BlockStore(args.irreversible_block_store_path)
+        except Exception as e:
+            logger.error('failed to add irreversible block store', exception=e)
+
+    configured_cache_group = CacheGroup(caches=caches,
+                                        memory_cache_max_ttl=args.memory_cache_max_ttl,
+                                        memory_cache_max_size=args.memory_cache_max_size,
+                                        memory_cache_max_bytes=args.memory_cache_max_bytes,
+                                        stale_cache_max_bytes=args.stale_cache_max_bytes,
+                                        stale_cache_max_ttl=app.config.upstreams.max_stale_time,
+                                        shared_memory_cache=shared_memory_cache,
+                                        block_store=block_store,
+                                        cache_key_digest=args.cache_key_digest,
+                                        canonical_cache_keys=args.cache_canonical_keys)
     return configured_cache_group
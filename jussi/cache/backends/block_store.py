@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import mmap
+import os
+import struct
+from typing import Dict
+from typing import Optional
+
+import structlog
+from ujson import dumps
+from ujson import loads
+
+logger = structlog.get_logger(__name__)
+
+'''
+A local store of irreversible blocks, indexed by block number.
+
+Each block format ("flavor") is kept in a pair of files:
+
+- `<flavor>.dat`, an append-only file of ujson encoded blocks
+- `<flavor>.idx`, a fixed-width index, entry `n` holds the offset and length
+  of block `n` in the data file. A zero length marks a missing block.
+
+Both files are memory-mapped for reads. Writers from all workers serialize
+on a lockf lock over the index file. Irreversible blocks never change, so an
+entry is only ever written once.
+'''
+
+INDEX_ENTRY = struct.Struct('<QI')  # data file offset, length
+
+# block formats returned by the different apis
+CONDENSER_FLAVOR = 'condenser'  # steemd and condenser_api, result is the block
+BLOCK_API_FLAVOR = 'block_api'  # appbase block_api, result is {'block': block}
+FLAVORS = (CONDENSER_FLAVOR, BLOCK_API_FLAVOR)
+
+
+class BlockFile:
+    __slots__ = ('_data_fd', '_index_fd', '_data', '_index')
+
+    def __init__(self, path: str) -> None:
+        self._data_fd = os.open(f'{path}.dat', os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._index_fd = os.open(f'{path}.idx', os.O_RDWR | os.O_CREAT, 0o644)
+        self._data = None
+        self._index = None
+
+    @staticmethod
+    def _remap(current: Optional[mmap.mmap], fd: int, needed: int) -> Optional[mmap.mmap]:
+        if current is not None and len(current) >= needed:
+            return current
+        size = os.fstat(fd).st_size
+        if size < needed:
+            return current
+        if current is not None:
+            current.close()
+        return mmap.mmap(fd, size, prot=mmap.PROT_READ)
+
+    def _entry(self, block_num: int) -> Optional[tuple]:
+        end = (block_num + 1) * INDEX_ENTRY.size
+        self._index = self._remap(self._index, self._index_fd, end)
+        if self._index is None or len(self._index) < end:
+            return None
+        offset, length = INDEX_ENTRY.unpack_from(self._index, block_num * INDEX_ENTRY.size)
+        if not length:
+            return None
+        return offset, length
+
+    def get(self, block_num: int) -> Optional[bytes]:
+        entry = self._entry(block_num)
+        if entry is None:
+            return None
+        offset, length = entry
+        self._data = self._remap(self._data, self._data_fd, offset + length)
+        if self._data is None or len(self._data) < offset + length:
+            return None
+        return self._data[offset:offset + length]
+
+    def put(self, block_num: int, block: dict) -> bool:
+        data = dumps(block, ensure_ascii=False).encode()
+        fcntl.lockf(self._index_fd, fcntl.LOCK_EX)
+        try:
+            existing = os.pread(self._index_fd, INDEX_ENTRY.size, block_num * INDEX_ENTRY.size)
+            if len(existing) == INDEX_ENTRY.size and INDEX_ENTRY.unpack(existing)[1]:
+                return False
+            offset = os.fstat(self._data_fd).st_size
+            os.write(self._data_fd, data)
+            os.pwrite(self._index_fd, INDEX_ENTRY.pack(offset, len(data)),
+                      block_num * INDEX_ENTRY.size)
+            return True
+        finally:
+            fcntl.lockf(self._index_fd, fcntl.LOCK_UN)
+
+    def close(self) -> None:
+        for mapped in (self._data, self._index):
+            if mapped is not None:
+                mapped.close()
+        os.close(self._data_fd)
+        os.close(self._index_fd)
+
+
+class BlockStore:
+    """append-only store of irreversible blocks in `directory`"""
+    __slots__ = ('_directory', '_files')
+
+    def __init__(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._files = {flavor: BlockFile(os.path.join(directory, flavor))
+                       for flavor in FLAVORS}  # type: Dict[str, BlockFile]
+
+    def get(self, flavor: str, block_num: int) -> Optional[dict]:
+        block = self.get_serialized(flavor, block_num)
+        if block is None:
+            return None
+        return loads(block)
+
+    def get_serialized(self, flavor: str, block_num: int) -> Optional[bytes]:
+        try:
+            return self._files[flavor].get(block_num)
+        except Exception as e:
+            logger.error('block store read failed', flavor=flavor,
+                         block_num=block_num, e=e)
+        return None
+
+    def put(self, flavor: str, block_num: int, block: dict) -> bool:
+        try:
+            return self._files[flavor].put(block_num, block)
+        except Exception as e:
+            logger.error('block store write failed', flavor=flavor,
+                         block_num=block_num, e=e)
+        return False
+
+    def close(self) -> None:
+        for block_file in self._files.values():
+            block_file.close()
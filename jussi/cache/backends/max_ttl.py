@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
+from sys import getsizeof
 from time import perf_counter
 from typing import Dict
 from typing import List
@@ -8,11 +10,14 @@ from typing import Tuple
 from typing import TypeVar
 
 import structlog
+from ujson import dumps
 
 logger = structlog.get_logger(__name__)
 
 MEMORY_CACHE_MAX_TTL = 180
 MEMORY_CACHE_MAX_SIZE = 2000
+MEMORY_CACHE_MAX_BYTES = 256 * 2**20
+STALE_CACHE_MAX_BYTES = 32 * 2**20
 
 
 CacheTTLValue = TypeVar('CacheTTL', int, float, type(None))
@@ -26,10 +31,20 @@ CacheResult = Optional[CacheResultValue]
 CacheResults = List[CacheResult]
 
 
-class SimplerMaxTTLMemoryCache:
-    def __init__(self, max_ttl: int = None, max_size: int=None):
+# pylint: disable=too-many-instance-attributes
+class LRUMaxTTLMemoryCache:
+    """In-process cache with O(1) gets and sets.
 
-        self._cache = {}
+    Items are kept in least-recently-used order and the least recently used
+    items are evicted once ``max_size`` items or ``max_bytes`` of approximate
+    (serialized) value size is reached. Expired items are removed lazily on
+    read, and in bulk by a timer wheel of one second slots which is advanced
+    on every write, so no write ever scans the whole cache.
+    """
+
+    def __init__(self, max_ttl: int = None, max_size: int = None, max_bytes: int = None):
+        self._cache = OrderedDict()
+        self._sizes = {}
 
         # these are dynamic views
         self._keys = self._cache.keys()
@@ -37,14 +52,29 @@ class SimplerMaxTTLMemoryCache:
         self._items = self._cache.items()
         self._max_ttl = max_ttl or MEMORY_CACHE_MAX_TTL
         self._max_size = max_size or MEMORY_CACHE_MAX_SIZE
+        self._max_bytes = max_bytes or MEMORY_CACHE_MAX_BYTES
+
+        # a wheel slot holds the keys expiring in its second
+        self._wheel = [set() for _ in range(int(self._max_ttl) + 2)]
+        self._wheel_second = int(perf_counter())
+
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
 
     def gets(self, key: CacheKey) -> CacheResult:
         if key in self._cache:
             timestamp, result = self._cache[key]
             if timestamp - perf_counter() > 0:
+                self._cache.move_to_end(key)
+                self._hits += 1
                 return result
             else:
-                del self._cache[key]
+                self._remove(key)
+                self._expirations += 1
+        self._misses += 1
         return None
 
     async def get(self, key: CacheKey) -> CacheResult:
@@ -59,41 +89,93 @@ class SimplerMaxTTLMemoryCache:
     def sets(self, key: CacheKey, value: CacheValue, expire_time: CacheTTLValue) -> NoReturn:
         if expire_time is None or expire_time > self._max_ttl:
             expire_time = self._max_ttl
-        self.prune()
-        self._cache[key] = (perf_counter() + expire_time), value
-        return
+        now = perf_counter()
+        self.prune(now)
+        self._remove(key)
+        size = sizeof(value)
+        if size > self._max_bytes:
+            return
+        while self._cache and (len(self._cache) >= self._max_size or
+                               self._bytes + size > self._max_bytes):
+            self._remove(next(iter(self._cache)))
+            self._evictions += 1
+        timestamp = now + expire_time
+        self._cache[key] = timestamp, value
+        self._sizes[key] = size
+        self._bytes += size
+        self._wheel[int(timestamp) % len(self._wheel)].add(key)
 
     async def set(self, key: CacheKey, value: CacheValue, expire_time: CacheTTLValue) -> NoReturn:
         return self.sets(key, value, expire_time)
 
     def set_manys(self, data: CachePairs, expire_time: CacheTTLValue) -> NoReturn:
         _ = [self.sets(k, v, expire_time) for k, v, in data.items()]
-        return
 
     async def set_many(self, data: CachePairs, expire_time: CacheTTLValue) -> NoReturn:
         _ = [self.sets(k, v, expire_time) for k, v, in data.items()]
-        return
 
     def deletes(self, key: CacheKey) -> NoReturn:
-        if key in self._cache:
-            del self._cache[key]
+        self._remove(key)
 
     async def delete(self, key: CacheKey) -> NoReturn:
+        self.deletes(key)
+
+    def _remove(self, key: CacheKey) -> NoReturn:
         if key in self._cache:
             del self._cache[key]
-
-    def prune(self) -> NoReturn:
-        now = perf_counter()
-        pruned = [k for k, v in self._items if (v[0] - now) < 0]
-        for k in pruned:
-            del self._cache[k]
-        if len(self._items) >= self._max_size:
-            del self._cache[next(iter(self._cache))]
-        return
+            self._bytes -= self._sizes.pop(key)
+
+    def prune(self, now: float = None) -> NoReturn:
+        """remove the items in every wheel slot which has passed since the last prune"""
+        now = now or perf_counter()
+        current_second = int(now)
+        wheel_size = len(self._wheel)
+        slots = min(current_second - self._wheel_second, wheel_size)
+        for second in range(current_second - slots, current_second):
+            index = second % wheel_size
+            slot = self._wheel[index]
+            for key in list(slot):
+                entry = self._cache.get(key)
+                if entry is not None and entry[0] <= now:
+                    self._remove(key)
+                    self._expirations += 1
+                elif entry is not None and int(entry[0]) % wheel_size == index:
+                    # expires on a later turn of the wheel
+                    continue
+                # expired, deleted, or rewritten into another slot
+                slot.discard(key)
+        self._wheel_second = current_second
 
     def clears(self) -> NoReturn:
-        self._cache = {}
-        return
+        self._cache.clear()
+        self._sizes.clear()
+        self._bytes = 0
+        for slot in self._wheel:
+            slot.clear()
 
     async def clear(self) -> NoReturn:
         return self.clears()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'keys': len(self._cache),
+            'bytes': self._bytes,
+            'max_bytes': self._max_bytes,
+            'hits': self._hits,
+            'misses': self._misses,
+            'evictions': self._evictions,
+            'expirations': self._expirations
+        }
+
+
+def sizeof(value: CacheValue) -> int:
+    """approximate memory cost of a cached value as its serialized size"""
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, tuple):
+        return getsizeof(value) + sum(sizeof(item) for item in value)
+    try:
+        return len(dumps(value, ensure_ascii=False))
+    except Exception:
+        return getsizeof(value)
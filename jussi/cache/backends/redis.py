@@ -23,6 +23,10 @@ CacheResult = Optional[CacheResultValue]
 CacheResults = List[CacheResult]
 
 
+# marks values stored as given instead of ujson encoded, zlib data never starts with it
+RAW_BYTES_PREFIX = b'B'
+
+
 class Cache:
     """cache provides basic function"""
 
@@ -31,11 +35,15 @@ class Cache:
 
     # pylint: disable=no-self-use
     def _pack(self, value) -> bytes:
+        if isinstance(value, bytes):
+            return RAW_BYTES_PREFIX + compress(value)
         return compress(dumps(value, ensure_ascii=False).encode('utf8'))
 
     def _unpack(self, value: bytes) -> CacheResult:
         if not value:
             return None
+        if value.startswith(RAW_BYTES_PREFIX):
+            return decompress(value[1:])
         return loads(decompress(value))
 
     # pylint: enable=no-self-use
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+from hashlib import blake2b
+from time import monotonic
+from typing import Dict
+from typing import List
+from typing import NoReturn
+from typing import Optional
+from typing import Tuple
+from typing import TypeVar
+
+import structlog
+from ujson import dumps
+from ujson import loads
+
+logger = structlog.get_logger(__name__)
+
+'''
+A cache shared by every worker process on a host, stored in a memory-mapped
+file (eg, under /dev/shm).
+
+Layout of the file:
+
+    | header | size class table | page table | hash slots | slab pages |
+
+- hash slots are grouped into buckets of SLOTS_PER_BUCKET, a key may live
+  in any slot of its bucket. A slot holds the key hash, the expiry
+  (a CLOCK_MONOTONIC timestamp, 0 means no expiration), the address of the
+  chunk holding the key and value, and a sequence number.
+- slab pages are PAGE_SIZE bytes. A page is assigned to a size class the
+  first time the class needs memory and is carved into chunks of that size.
+  Free chunks of a class form a linked list. When a class has no free chunks
+  and no unassigned pages remain, a clock hand over the class's chunks
+  picks the chunk to evict.
+
+Writers serialize on a lockf lock over the file. Readers don't lock: a
+writer makes a slot's sequence number odd while it changes the slot or its
+chunk, and a reader discards anything it read if the sequence number was
+odd or changed while it was reading.
+
+CLOCK_MONOTONIC is system wide on linux, so expirations written by one
+worker are valid in every other worker.
+'''
+
+SHARED_MEMORY_CACHE_SIZE = 256 * 2**20
+
+MAGIC = b'JUSSISHM'
+LAYOUT_VERSION = 1
+
+PAGE_SIZE = 2**20
+MIN_CHUNK_SIZE = 256
+SIZE_CLASSES = tuple(MIN_CHUNK_SIZE * 2**i for i in range(13))  # 256B - 1MB
+SLOTS_PER_BUCKET = 4
+SLAB_BYTES_PER_SLOT = 4096
+NONE = 0xFFFFFFFF
+
+HEADER = struct.Struct('<8sIIII')  # magic, layout version, buckets, pages, next free page
+SIZE_CLASS = struct.Struct('<II')  # free list head chunk, clock hand chunk
+SLOT = struct.Struct('<QdII')  # key hash, expires at, chunk, sequence number
+# owner slot, next free chunk (flags while allocated), key length, value length
+CHUNK = struct.Struct('<IIII')
+RAW_BYTES = 1  # value was stored as given, not ujson encoded
+
+SIZE_CLASS_TABLE_OFFSET = 64
+PAGE_TABLE_OFFSET = SIZE_CLASS_TABLE_OFFSET + SIZE_CLASS.size * len(SIZE_CLASSES)
+
+
+CacheTTLValue = TypeVar('CacheTTL', int, float, type(None))
+CacheKey = str
+CacheKeys = List[CacheKey]
+CacheValue = TypeVar('CacheValue', int, float, str, dict)
+CachePair = Tuple[CacheKey, CacheValue]
+CachePairs = Dict[CacheKey, CacheValue]
+CacheResultValue = TypeVar('CacheValue', int, float, str, dict)
+CacheResult = Optional[CacheResultValue]
+CacheResults = List[CacheResult]
+
+
+def _align(offset: int, alignment: int = 4096) -> int:
+    return -(-offset // alignment) * alignment
+
+
+def _key_hash(key: bytes) -> int:
+    # 0 marks an empty slot
+    return int.from_bytes(blake2b(key, digest_size=8).digest(), 'little') or 1
+
+
+def _size_class(size: int) -> Optional[int]:
+    for i, chunk_size in enumerate(SIZE_CLASSES):
+        if size <= chunk_size:
+            return i
+    return None
+
+
+# pylint: disable=too-many-instance-attributes
+class SharedMemoryCache:
+    """cache shared between worker processes through a memory-mapped file
+
+    Every worker must open the file itself (eg, in a before_server_start
+    listener) rather than inherit an instance across fork.
+    """
+
+    def __init__(self, path: str, size: int = None) -> None:
+        size = size or SHARED_MEMORY_CACHE_SIZE
+        per_page = PAGE_SIZE + (PAGE_SIZE // SLAB_BYTES_PER_SLOT) * SLOT.size + 1
+        self._num_pages = (size - 2 * 4096) // per_page
+        if self._num_pages < 1:
+            raise ValueError(f'shared memory cache size must be at least {per_page + 8192}')
+        self._num_buckets = self._num_pages * PAGE_SIZE // SLAB_BYTES_PER_SLOT // SLOTS_PER_BUCKET
+        self._slots_offset = _align(PAGE_TABLE_OFFSET + self._num_pages)
+        self._slots_size = self._num_buckets * SLOTS_PER_BUCKET * SLOT.size
+        self._pages_offset = _align(self._slots_offset + self._slots_size)
+        self._size = self._pages_offset + self._num_pages * PAGE_SIZE
+        self._path = path
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._lock():
+            if not self._is_initialized():
+                logger.info('initializing shared memory cache', path=path, size=self._size)
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, self._size)
+            self._mmap = mmap.mmap(self._fd, self._size)
+            if not self._is_initialized():
+                self._reset()
+
+    def _is_initialized(self) -> bool:
+        if os.fstat(self._fd).st_size != self._size:
+            return False
+        header = HEADER.unpack(os.pread(self._fd, HEADER.size, 0))
+        return header[:4] == (MAGIC, LAYOUT_VERSION, self._num_buckets, self._num_pages)
+
+    def _reset(self) -> None:
+        mm = self._mmap
+        mm[0:self._pages_offset] = bytes(self._pages_offset)
+        for size_class in range(len(SIZE_CLASSES)):
+            SIZE_CLASS.pack_into(mm, self._size_class_offset(size_class), NONE, NONE)
+        HEADER.pack_into(mm, 0, MAGIC, LAYOUT_VERSION, self._num_buckets, self._num_pages, 0)
+
+    @contextmanager
+    def _lock(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    # offsets
+    @staticmethod
+    def _size_class_offset(size_class: int) -> int:
+        return SIZE_CLASS_TABLE_OFFSET + size_class * SIZE_CLASS.size
+
+    def _slot_offset(self, slot: int) -> int:
+        return self._slots_offset + slot * SLOT.size
+
+    def _chunk_offset(self, chunk: int) -> int:
+        return self._pages_offset + chunk * MIN_CHUNK_SIZE
+
+    def _bucket(self, key_hash: int) -> range:
+        first = (key_hash % self._num_buckets) * SLOTS_PER_BUCKET
+        return range(first, first + SLOTS_PER_BUCKET)
+
+    def _chunk_size_class(self, chunk: int) -> int:
+        page = chunk * MIN_CHUNK_SIZE // PAGE_SIZE
+        return self._mmap[PAGE_TABLE_OFFSET + page] - 1
+
+    def _chunk_key(self, chunk: int) -> bytes:
+        offset = self._chunk_offset(chunk)
+        _, _, key_length, _ = CHUNK.unpack_from(self._mmap, offset)
+        return self._mmap[offset + CHUNK.size:offset + CHUNK.size + key_length]
+
+    # reads
+    # pylint: disable=too-many-locals
+    def gets(self, key: CacheKey) -> CacheResult:
+        key_bytes = key.encode()
+        key_hash = _key_hash(key_bytes)
+        mm = self._mmap
+        for slot in self._bucket(key_hash):
+            slot_offset = self._slot_offset(slot)
+            slot_hash, expires_at, chunk, seq = SLOT.unpack_from(mm, slot_offset)
+            if slot_hash != key_hash or seq & 1 or chunk == NONE:
+                continue
+            if expires_at and expires_at <= monotonic():
+                return None
+            try:
+                offset = self._chunk_offset(chunk)
+                _, flags, key_length, value_length = CHUNK.unpack_from(mm, offset)
+                start = offset + CHUNK.size
+                stored_key = mm[start:start + key_length]
+                value = mm[start + key_length:start + key_length + value_length]
+            except (struct.error, ValueError, IndexError):
+                continue
+            if SLOT.unpack_from(mm, slot_offset)[3] != seq or stored_key != key_bytes:
+                continue
+            return value if flags & RAW_BYTES else loads(value)
+        return None
+
+    async def get(self, key: CacheKey) -> CacheResult:
+        return self.gets(key)
+
+    def mgets(self, keys: CacheKeys) -> CacheResults:
+        return [self.gets(k) for k in keys]
+
+    async def mget(self, keys: CacheKeys) -> CacheResults:
+        return [self.gets(k) for k in keys]
+
+    # writes
+    def sets(self, key: CacheKey, value: CacheValue, expire_time: CacheTTLValue) -> NoReturn:
+        key_bytes = key.encode()
+        if isinstance(value, bytes):
+            value_bytes, flags = value, RAW_BYTES
+        else:
+            value_bytes, flags = dumps(value, ensure_ascii=False).encode(), 0
+        size_class = _size_class(CHUNK.size + len(key_bytes) + len(value_bytes))
+        key_hash = _key_hash(key_bytes)
+        expires_at = 0.0 if expire_time is None else monotonic() + expire_time
+        with self._lock():
+            slot = self._select_slot(key_hash, key_bytes)
+            self._clear_slot(slot)
+            if size_class is None:
+                return
+            chunk = self._allocate(size_class)
+            if chunk is None:
+                return
+            mm = self._mmap
+            offset = self._chunk_offset(chunk)
+            CHUNK.pack_into(mm, offset, slot, flags, len(key_bytes), len(value_bytes))
+            start = offset + CHUNK.size
+            mm[start:start + len(key_bytes)] = key_bytes
+            mm[start + len(key_bytes):start + len(key_bytes) + len(value_bytes)] = value_bytes
+            self._write_slot(slot, key_hash, expires_at, chunk)
+
+    async def set(self, key: CacheKey, value: CacheValue, expire_time: CacheTTLValue) -> NoReturn:
+        return self.sets(key, value, expire_time)
+
+    def set_manys(self, data: CachePairs, expire_time: CacheTTLValue) -> NoReturn:
+        _ = [self.sets(k, v, expire_time) for k, v, in data.items()]
+
+    async def set_many(self, data: CachePairs, expire_time: CacheTTLValue) -> NoReturn:
+        _ = [self.sets(k, v, expire_time) for k, v, in data.items()]
+
+    def deletes(self, key: CacheKey) -> NoReturn:
+        key_bytes = key.encode()
+        key_hash = _key_hash(key_bytes)
+        with self._lock():
+            for slot in self._bucket(key_hash):
+                slot_hash, _, chunk, _ = SLOT.unpack_from(self._mmap, self._slot_offset(slot))
+                if slot_hash == key_hash and chunk != NONE and \
+                        self._chunk_key(chunk) == key_bytes:
+                    self._clear_slot(slot)
+
+    async def delete(self, key: CacheKey) -> NoReturn:
+        self.deletes(key)
+
+    def clears(self) -> NoReturn:
+        with self._lock():
+            self._reset()
+
+    async def clear(self) -> NoReturn:
+        return self.clears()
+
+    def close(self) -> NoReturn:
+        self._mmap.close()
+        os.close(self._fd)
+
+    # must be called while holding the lock
+    def _select_slot(self, key_hash: int, key_bytes: bytes) -> int:
+        now = monotonic()
+        slots = []
+        for slot in self._bucket(key_hash):
+            slot_hash, expires_at, chunk, _ = SLOT.unpack_from(self._mmap, self._slot_offset(slot))
+            if slot_hash == key_hash and chunk != NONE and \
+                    self._chunk_key(chunk) == key_bytes:
+                return slot
+            slots.append((slot_hash, expires_at, slot))
+        for slot_hash, expires_at, slot in slots:
+            if slot_hash == 0 or (expires_at and expires_at <= now):
+                return slot
+        # evict the entry expiring soonest, entries without expiration last
+        return min(slots, key=lambda s: s[1] or float('inf'))[2]
+
+    def _write_slot(self, slot: int, key_hash: int, expires_at: float, chunk: int) -> None:
+        offset = self._slot_offset(slot)
+        seq = SLOT.unpack_from(self._mmap, offset)[3]
+        SLOT.pack_into(self._mmap, offset, 0, 0.0, NONE, (seq + 1) | 1)
+        SLOT.pack_into(self._mmap, offset, key_hash, expires_at, chunk, (seq | 1) + 1)
+
+    def _clear_slot(self, slot: int, free_chunk: bool = True) -> None:
+        offset = self._slot_offset(slot)
+        slot_hash, _, chunk, seq = SLOT.unpack_from(self._mmap, offset)
+        if slot_hash == 0:
+            return
+        # an odd sequence number invalidates concurrent reads of the old chunk
+        SLOT.pack_into(self._mmap, offset, 0, 0.0, NONE, (seq + 1) | 1)
+        if free_chunk and chunk != NONE:
+            self._free(chunk)
+        SLOT.pack_into(self._mmap, offset, 0, 0.0, NONE, (seq | 1) + 1)
+
+    def _free(self, chunk: int) -> None:
+        class_offset = self._size_class_offset(self._chunk_size_class(chunk))
+        head, hand = SIZE_CLASS.unpack_from(self._mmap, class_offset)
+        CHUNK.pack_into(self._mmap, self._chunk_offset(chunk), NONE, head, 0, 0)
+        SIZE_CLASS.pack_into(self._mmap, class_offset, chunk, hand)
+
+    def _allocate(self, size_class: int) -> Optional[int]:
+        mm = self._mmap
+        class_offset = self._size_class_offset(size_class)
+        head, hand = SIZE_CLASS.unpack_from(mm, class_offset)
+
+        # reuse a free chunk
+        if head != NONE:
+            next_free = CHUNK.unpack_from(mm, self._chunk_offset(head))[1]
+            SIZE_CLASS.pack_into(mm, class_offset, next_free, hand)
+            return head
+
+        # assign a new page to this size class
+        header = HEADER.unpack_from(mm, 0)
+        page = header[4]
+        if page < self._num_pages:
+            HEADER.pack_into(mm, 0, *header[:4], page + 1)
+            mm[PAGE_TABLE_OFFSET + page] = size_class + 1
+            chunks_per_page = PAGE_SIZE // SIZE_CLASSES[size_class]
+            units_per_chunk = SIZE_CLASSES[size_class] // MIN_CHUNK_SIZE
+            first = page * PAGE_SIZE // MIN_CHUNK_SIZE
+            for i in range(chunks_per_page - 1, 0, -1):
+                self._free(first + i * units_per_chunk)
+            return first
+
+        # evict the chunk under the clock hand
+        if hand == NONE:
+            hand = self._next_chunk(size_class, None)
+            if hand is None:
+                return None
+        chunk = hand
+        owner = CHUNK.unpack_from(mm, self._chunk_offset(chunk))[0]
+        if owner != NONE and SLOT.unpack_from(mm, self._slot_offset(owner))[2] == chunk:
+            self._clear_slot(owner, free_chunk=False)
+        SIZE_CLASS.pack_into(mm, class_offset, NONE, self._next_chunk(size_class, chunk))
+        return chunk
+
+    def _next_chunk(self, size_class: int, chunk: Optional[int]) -> Optional[int]:
+        """the chunk after `chunk` in the pages assigned to `size_class`"""
+        units_per_page = PAGE_SIZE // MIN_CHUNK_SIZE
+        if chunk is not None:
+            next_chunk = chunk + SIZE_CLASSES[size_class] // MIN_CHUNK_SIZE
+            if next_chunk % units_per_page:
+                return next_chunk
+            page = chunk // units_per_page + 1
+        else:
+            page = 0
+        page_table = self._mmap[PAGE_TABLE_OFFSET:PAGE_TABLE_OFFSET + self._num_pages]
+        marker = bytes([size_class + 1])
+        next_page = page_table.find(marker, page)
+        if next_page == -1:
+            next_page = page_table.find(marker)
+        if next_page == -1:
+            return None
+        return next_page * units_per_page
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'path': self._path,
+            'bytes': self._size,
+            'pages': self._num_pages,
+            'pages_used': HEADER.unpack_from(self._mmap, 0)[4],
+            'slots': self._num_buckets * SLOTS_PER_BUCKET
+        }
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import asyncio
 from operator import itemgetter
+from time import perf_counter
 from typing import Any
 from typing import Dict
 from typing import List
@@ -16,20 +17,34 @@ from jussi.errors import JussiInteralError
 from jussi.validators import is_get_block_request
 from jussi.validators import is_valid_get_block_response
 
+from ..response import SerializedResponse
 from ..typedefs import BatchJrpcRequest
 from ..typedefs import BatchJrpcResponse
 from ..typedefs import JrpcRequest
 from ..typedefs import JrpcResponse
 from ..typedefs import SingleJrpcRequest
 from ..typedefs import SingleJrpcResponse
+from ..urn import URN
 from ..validators import is_valid_non_error_jussi_response
 from ..validators import is_valid_non_error_single_jsonrpc_response
-from .backends.max_ttl import SimplerMaxTTLMemoryCache
+from .backends.block_store import BlockStore
+from .backends.max_ttl import STALE_CACHE_MAX_BYTES
+from .backends.max_ttl import LRUMaxTTLMemoryCache
+from .backends.shared_memory import SharedMemoryCache
+from .canonical import canonical_urn
+from .canonical import from_canonical_result
+from .canonical import to_canonical_response
+from .derived import derived_responses
 from .ttl import TTL
+from .utils import block_from_jsonrpc_response
+from .utils import block_store_location
+from .utils import cached_response_from_block
 from .utils import irreversible_ttl
 from .utils import jsonrpc_cache_key
 from .utils import merge_cached_response
-from .utils import merge_cached_responses
+from .utils import serialized_result
+from .utils import urn_cache_key
+from .utils import urn_cache_key_digest
 
 logger = structlog.getLogger(__name__)
 
@@ -56,11 +71,40 @@ SLOW_TIER = 1
 FAST_TIER = 2
 
 
+# pylint: disable=too-many-instance-attributes
 class CacheGroup:
     # pylint: disable=unused-argument, too-many-arguments, no-else-return
-    def __init__(self, caches: List[Any]) -> None:
+    def __init__(self, caches: List[Any],
+                 memory_cache_max_ttl: int = None,
+                 memory_cache_max_size: int = None,
+                 memory_cache_max_bytes: int = None,
+                 stale_cache_max_bytes: int = None,
+                 stale_cache_max_ttl: int = None,
+                 shared_memory_cache: SharedMemoryCache = None,
+                 block_store: BlockStore = None,
+                 cache_key_digest: bool = False,
+                 canonical_cache_keys: bool = False) -> None:
         self._cache_group_items = caches
-        self._memory_cache = SimplerMaxTTLMemoryCache()
+        # keys with params are stored under a digest of the urn
+        self._urn_cache_key = urn_cache_key_digest if cache_key_digest else urn_cache_key
+        # equivalent spellings of a request share the key of one spelling
+        self._canonical_cache_keys = canonical_cache_keys
+        self._memory_cache = LRUMaxTTLMemoryCache(max_ttl=memory_cache_max_ttl,
+                                                  max_size=memory_cache_max_size,
+                                                  max_bytes=memory_cache_max_bytes)
+        # optional tier shared by all workers, read after the memory cache
+        self._shared_memory_cache = shared_memory_cache
+        # optional local store of irreversible blocks
+        self._block_store = block_store
+        # expired responses kept for their prefix's stale grace, as
+        # (fresh until, value), and the keys being refreshed upstream. It
+        # has its own budget, only responses with a grace are kept in it, for
+        # up to their ttl plus their grace
+        self._stale_cache = LRUMaxTTLMemoryCache(
+            max_ttl=stale_cache_max_ttl or memory_cache_max_ttl,
+            max_size=memory_cache_max_size,
+            max_bytes=stale_cache_max_bytes or STALE_CACHE_MAX_BYTES)
+        self._refreshing = set()
         self._read_cache_items = []
         self._read_caches = []
         self._write_cache_items = []
@@ -94,7 +138,11 @@ class CacheGroup:
                     read_items=self._read_cache_items,
                     write_items=self._write_cache_items,
                     read_caches=self._read_caches,
-                    write_caches=self._write_caches)
+                    write_caches=self._write_caches,
+                    shared_memory_cache=self._shared_memory_cache,
+                    block_store=self._block_store,
+                    cache_key_digest=cache_key_digest,
+                    canonical_cache_keys=canonical_cache_keys)
 
     async def get(self, key: CacheKey) -> CacheResult:
         # no memory cache read here for optimization, it has already happened
@@ -114,6 +162,15 @@ class CacheGroup:
         if all(results):
             return results
 
+        if self._shared_memory_cache is not None:
+            missing = [
+                key for key, response in zip(
+                    keys, results) if not response]
+            cache_iter = iter(self._shared_memory_cache.mgets(missing))
+            results = [existing or next(cache_iter) for existing in results]
+            if all(results):
+                return results
+
         # read from one cache at a time
         for cache in self._read_caches:
             missing = [
@@ -130,6 +187,8 @@ class CacheGroup:
         if isinstance(expire_time, TTL):
             expire_time = expire_time.value
         self._memory_cache.sets(key, value, expire_time=expire_time)
+        if self._shared_memory_cache is not None:
+            self._shared_memory_cache.sets(key, value, expire_time=expire_time)
         await asyncio.gather(*[cache.set(key, value, expire_time=expire_time) for cache
                                in self._write_caches], return_exceptions=False)
 
@@ -139,6 +198,8 @@ class CacheGroup:
         if isinstance(expire_time, TTL):
             expire_time = expire_time.value
         self._memory_cache.set_manys(data, expire_time)
+        if self._shared_memory_cache is not None:
+            self._shared_memory_cache.set_manys(data, expire_time)
 
         futures = [cache.set_many(data, expire_time=expire_time) for cache in self._write_caches]
         if futures:
@@ -146,39 +207,124 @@ class CacheGroup:
 
     async def clear(self) -> NoReturn:
         self._memory_cache.clears()
+        self._stale_cache.clears()
+        if self._shared_memory_cache is not None:
+            self._shared_memory_cache.clears()
         await asyncio.gather(*[cache.clear() for cache in self._write_caches])
 
     async def close(self) -> NoReturn:
         for cache in self._all_caches:
             cache.close()
+        if self._shared_memory_cache is not None:
+            self._shared_memory_cache.close()
+        if self._block_store is not None:
+            self._block_store.close()
 
     # jsonrpc related methods
     #
 
+    def cache_key(self, urn: URN) -> CacheKey:
+        """the key of a request's responses, built once as the request is parsed"""
+        if self._canonical_cache_keys:
+            return self._urn_cache_key(canonical_urn(urn))
+        return self._urn_cache_key(urn)
+
+    def _cache_key(self, request: SingleJrpcRequest) -> CacheKey:
+        if request.cache_key is not None:
+            return request.cache_key
+        return self.cache_key(request.urn)
+
+    def _merge_cached_response(self, request: SingleJrpcRequest,
+                               cached_response: CacheResult) -> Optional[SingleJrpcResponse]:
+        if self._canonical_cache_keys:
+            cached_response = from_canonical_result(request.urn, cached_response)
+        return merge_cached_response(request, cached_response)
+
+    def _serialized_result(self, request: SingleJrpcRequest,
+                           response: SingleJrpcResponse) -> bytes:
+        if self._canonical_cache_keys:
+            canonical_response = to_canonical_response(request.urn, response)
+            if canonical_response is None:
+                raise UncacheableResponse(reason='unexpected result for canonical cache key',
+                                          jrpc_request=request,
+                                          jrpc_response=response)
+            response = canonical_response
+        return serialized_result(response)
+
+    def _derived_pairs(self, request: SingleJrpcRequest,
+                       response: SingleJrpcResponse) -> CachePairs:
+        """cache entries of related requests answered by this response"""
+        pairs = {}
+        for urn, derived_response in derived_responses(request, response):
+            if self._canonical_cache_keys:
+                derived_response = to_canonical_response(urn, derived_response)
+                if derived_response is None:
+                    continue
+                urn = canonical_urn(urn)
+            pairs[self._urn_cache_key(urn)] = serialized_result(derived_response)
+        return pairs
+
     async def get_single_jsonrpc_response(self,
                                           request: SingleJrpcRequest) -> Optional[SingleJrpcResponse]:
         if request.upstream.ttl == TTL.NO_CACHE:
             return None
-        key = jsonrpc_cache_key(request)
+        key = self._cache_key(request)
 
         # try sync memory cache get first
         cached_response = self._memory_cache.gets(key)
         if cached_response is not None:
-            return merge_cached_response(request, cached_response)
+            return self._merge_cached_response(request, cached_response)
+
+        # then the memory cache shared by all workers
+        if self._shared_memory_cache is not None:
+            cached_response = self._shared_memory_cache.gets(key)
+            if cached_response is not None:
+                return self._merge_cached_response(request, cached_response)
+
+        cached_response = self.get_stored_block_response(request)
+        if cached_response is not None:
+            return cached_response
 
         # try async redis cache get
         cached_response = await self.get(key)
         if cached_response is not None:
-            return merge_cached_response(request, cached_response)
+            return self._merge_cached_response(request, cached_response)
         return None
 
+    def get_stale_jsonrpc_response(self, request: SingleJrpcRequest) -> \
+            Optional[Tuple[SingleJrpcResponse, float]]:
+        """an expired response within its stale grace, and its age past the ttl"""
+        if not request.upstream.stale_grace:
+            return None
+        entry = self._stale_cache.gets(self._cache_key(request))
+        if entry is None:
+            return None
+        fresh_until, value = entry
+        return self._merge_cached_response(request, value), max(0.0, perf_counter() - fresh_until)
+
+    def begin_refresh(self, request: SingleJrpcRequest) -> bool:
+        """False if the response is already being refreshed"""
+        key = self._cache_key(request)
+        if key in self._refreshing:
+            return False
+        self._refreshing.add(key)
+        return True
+
+    def end_refresh(self, request: SingleJrpcRequest) -> None:
+        self._refreshing.discard(self._cache_key(request))
+
     async def get_batch_jsonrpc_responses(self,
                                           requests: BatchJrpcRequest) -> \
             Optional[BatchJrpcResponse]:
-        keys = [jsonrpc_cache_key(request) for request in requests]
+        keys = [self._cache_key(request) for request in requests]
         # try async mget which include sync memory-cache mget
         cached_responses = await self.mget(keys)
-        return merge_cached_responses(requests, cached_responses)
+        cached_responses = [self._merge_cached_response(request, cached)
+                            for request, cached in zip(requests, cached_responses)]
+        if self._block_store is not None:
+            cached_responses = [cached or self.get_stored_block_response(request)
+                                for request, cached in zip(requests, cached_responses)]
+        return cached_responses
 
     async def cache_single_jsonrpc_response(self,
                                             request: SingleJrpcRequest = None,
@@ -186,7 +332,7 @@ class CacheGroup:
                                             ttl: str = None,
                                             last_irreversible_block_num: int = None
                                             ) -> None:
-        key = jsonrpc_cache_key(request)
+        key = self._cache_key(request)
         ttl = ttl or request.upstream.ttl
         if ttl == TTL.NO_EXPIRE_IF_IRREVERSIBLE:
             last_irreversible_block_num = last_irreversible_block_num or \
@@ -197,9 +343,28 @@ class CacheGroup:
                                    last_irreversible_block_num=last_irreversible_block_num)
         elif ttl == TTL.NO_CACHE:
             return
-        value = self.prepare_response_for_cache(request, response)
-        await self.set(key, value, expire_time=ttl)
+        value = self._serialized_result(request, self.prepare_response_for_cache(request, response))
+        if ttl is TTL.NO_EXPIRE and self.store_block(request, response):
+            # the block store replaces redis for irreversible blocks
+            self._memory_cache.sets(key, value, expire_time=None)
+            return
+        self._set_stale(request, key, value, ttl)
+        pairs = self._derived_pairs(request, response)
+        if pairs:
+            pairs[key] = value
+            await self.set_many(pairs, expire_time=ttl)
+        else:
+            await self.set(key, value, expire_time=ttl)
 
+    def _set_stale(self, request: SingleJrpcRequest, key: CacheKey, value: bytes,
+                   ttl: int) -> None:
+        """keep a response with a stale grace until its grace ends"""
+        stale_grace = request.upstream.stale_grace
+        if stale_grace and isinstance(ttl, int) and ttl > 0:
+            self._stale_cache.sets(key, (perf_counter() + ttl, value),
+                                   expire_time=ttl + stale_grace)
+
+    # pylint: disable=too-many-locals
     async def cache_batch_jsonrpc_response(self,
                                            requests: BatchJrpcRequest = None,
                                            responses: BatchJrpcResponse = None,
@@ -221,19 +386,64 @@ class CacheGroup:
                 if ttl == TTL.NO_EXPIRE_IF_IRREVERSIBLE:
                     ttl = irreversible_ttl(responses[i], last_irreversible_block_num)
                 new_ttls.append(ttl)
-            triplets = filter(lambda p: p[0] != TTL.NO_CACHE, zip(ttls, requests, responses))
+            triplets = filter(lambda p: p[0] != TTL.NO_CACHE, zip(new_ttls, requests, responses))
+
+        if self._block_store is not None:
+            triplets = [(ttl, req, resp) for ttl, req, resp in triplets
+                        if not (ttl is TTL.NO_EXPIRE and self.store_block(req, resp))]
 
         futures = []
         # pylint: disable=no-member
         for ttl, grouped_triplets in cytoolz.groupby(itemgetter(0), triplets).items():
             if isinstance(ttl, TTL):
                 ttl = ttl.value
-            pairs = {jsonrpc_cache_key(req): resp for ttl, req, resp in grouped_triplets}
+            pairs = {}
+            for _, req, resp in grouped_triplets:
+                try:
+                    resp = self.prepare_response_for_cache(req, resp)
+                    key = self._cache_key(req)
+                    pairs[key] = self._serialized_result(req, resp)
+                except UncacheableResponse:
+                    continue
+                self._set_stale(req, key, pairs[key], ttl)
+                pairs.update(self._derived_pairs(req, resp))
+            if not pairs:
+                continue
             self._memory_cache.set_manys(pairs, expire_time=ttl)
             futures.append(self.set_many(pairs, expire_time=ttl))
         if futures:
             await asyncio.gather(*futures, return_exceptions=True)
 
+    def get_stored_block_response(self, request: SingleJrpcRequest) -> \
+            Optional[SingleJrpcResponse]:
+        if self._block_store is None:
+            return None
+        location = block_store_location(request)
+        if location is None:
+            return None
+        flavor, block_num = location
+        block = self._block_store.get_serialized(flavor, block_num)
+        if block is None:
+            return None
+        return cached_response_from_block(request, flavor, block)
+
+    def store_block(self, request: SingleJrpcRequest, response: SingleJrpcResponse) -> bool:
+        """add an irreversible get_block response to the block store"""
+        if self._block_store is None or not is_get_block_request(request):
+            return False
+        location = block_store_location(request)
+        if location is None:
+            return False
+        flavor, block_num = location
+        try:
+            block = block_from_jsonrpc_response(flavor, response)
+            if block is None or not is_valid_get_block_response(request, response):
+                return False
+        except Exception:
+            return False
+        self._block_store.put(flavor, block_num, block)
+        return True
+
     # pylint: disable=no-self-use
     def prepare_response_for_cache(self,
                                    request: SingleJrpcRequest,
@@ -256,8 +466,27 @@ class CacheGroup:
     @staticmethod
     def is_complete_response(request: JrpcRequest,
                              cached_response: JrpcResponse) -> bool:
+        # serialized responses were validated before they were cached
+        if isinstance(cached_response, SerializedResponse):
+            return True
+        if isinstance(request, list) and isinstance(cached_response, list):
+            return len(cached_response) > 0 and \
+                len(request) == len(cached_response) and \
+                all(CacheGroup.is_complete_response(req, resp)
+                    for req, resp in zip(request, cached_response))
         return is_valid_non_error_jussi_response(request, cached_response)
 
+    @staticmethod
+    def partial_batch_response(requests: BatchJrpcRequest,
+                               cached_responses: BatchJrpcResponse) -> \
+            Optional[BatchJrpcResponse]:
+        # keep only usable cached elements, None marks an index to fetch upstream
+        partial = [resp if resp and CacheGroup.is_complete_response(req, resp) else None
+                   for req, resp in zip(requests, cached_responses)]
+        if any(partial):
+            return partial
+        return None
+
     @staticmethod
     def x_jussi_cache_key(request: JrpcRequest) -> str:
         if isinstance(request, SingleJrpcRequest):
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from typing import Optional
+from typing import Union
+
+from ..empty import _empty
+from ..typedefs import CachedSingleResponse
+from ..typedefs import SingleJrpcResponse
+from ..urn import URN
+
+'''
+Canonical cache keys for equivalent spellings of the same request.
+
+The same data can be requested as a bare steemd method, as `call` with
+condenser_api or database_api, as `condenser_api.<method>` or for some
+methods through an appbase api. Each spelling has its own URN, so with
+canonical keys enabled they are cached under the URN of one canonical
+spelling instead:
+
+- steemd requests return the same results as condenser_api, the api appbase
+  translation sends them to, they share condenser_api keys
+- condenser_api requests without params are the same as with empty params
+- block_api.get_block_header returns the condenser_api header under a
+  "header" field, it shares the condenser_api key and its results are
+  adapted to and from the canonical form
+
+block_api.get_block isn't equivalent to condenser_api.get_block, the
+operations in its blocks are in the appbase format, so it keeps its own key.
+'''
+
+CANONICAL_NAMESPACE = 'appbase'
+CANONICAL_API = 'condenser_api'
+
+# (api, method) -> params field holding the block num, and the result field
+# holding the canonical result
+WRAPPED_RESULTS = {
+    ('block_api', 'get_block_header'): ('block_num', 'header')
+}
+
+
+def canonical_urn(urn: URN) -> URN:
+    if urn.namespace == 'steemd' or \
+            (urn.namespace == CANONICAL_NAMESPACE and urn.api == CANONICAL_API):
+        params = urn.params
+        if params is _empty:
+            params = []
+        if not isinstance(params, list):
+            return urn
+        return URN(CANONICAL_NAMESPACE, CANONICAL_API, urn.method, params)
+    if urn.namespace == CANONICAL_NAMESPACE and (urn.api, urn.method) in WRAPPED_RESULTS:
+        param, _ = WRAPPED_RESULTS[(urn.api, urn.method)]
+        try:
+            return URN(CANONICAL_NAMESPACE, CANONICAL_API, urn.method, [urn.params[param]])
+        except (KeyError, TypeError):
+            return urn
+    return urn
+
+
+def result_field(urn: URN) -> Optional[str]:
+    """the field of the result holding the canonical result, if it is wrapped"""
+    if urn.namespace != CANONICAL_NAMESPACE:
+        return None
+    wrapped = WRAPPED_RESULTS.get((urn.api, urn.method))
+    if wrapped is None:
+        return None
+    return wrapped[1]
+
+
+def to_canonical_response(urn: URN,
+                          response: SingleJrpcResponse) -> Optional[SingleJrpcResponse]:
+    """None if the result doesn't have the expected shape"""
+    field = result_field(urn)
+    if field is None:
+        return response
+    result = response['result']
+    if not isinstance(result, dict) or field not in result:
+        return None
+    return dict(response, result=result[field])
+
+
+def from_canonical_result(urn: URN,
+                          cached_response: Union[bytes, CachedSingleResponse]
+                          ) -> Union[bytes, CachedSingleResponse]:
+    field = result_field(urn)
+    if field is None or not cached_response:
+        return cached_response
+    if isinstance(cached_response, bytes):
+        if cached_response == b'null':
+            # the spelling with a wrapped result has no null results
+            return None
+        return b''.join((b'{"', field.encode(), b'":', cached_response, b'}'))
+    if cached_response.get('result') is None:
+        return None
+    return dict(cached_response, result={field: cached_response['result']})
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+from ..typedefs import SingleJrpcRequest
+from ..typedefs import SingleJrpcResponse
+from ..urn import URN
+from .backends.block_store import BLOCK_API_FLAVOR
+from .utils import BLOCK_HEADER_FIELDS
+from .utils import block_from_jsonrpc_response
+from .utils import block_store_location
+
+'''
+Cache entries derived from the responses of related requests.
+
+Some responses contain everything needed to answer other requests, eg a
+get_block response holds the header get_block_header returns. When such a
+response is cached, the rule for its method returns the URNs and responses
+of the related requests, which are cached along with it, with the same ttl.
+A rule must be cheap, it runs every time a response of its method is cached.
+'''
+
+DerivedResponses = List[Tuple[URN, SingleJrpcResponse]]
+
+
+def block_header_from_block(request: SingleJrpcRequest,
+                            response: SingleJrpcResponse) -> DerivedResponses:
+    """get_block -> get_block_header, in the spelling of the get_block request"""
+    location = block_store_location(request)
+    if location is None:
+        return []
+    flavor, block_num = location
+    block = block_from_jsonrpc_response(flavor, response)
+    if block is None:
+        return []
+    header = {k: block[k] for k in BLOCK_HEADER_FIELDS if k in block}
+    urn = request.urn
+    if flavor == BLOCK_API_FLAVOR:
+        params, result = {'block_num': block_num}, {'header': header}
+    else:
+        params, result = [block_num], header
+    header_urn = URN(urn.namespace, urn.api, 'get_block_header', params)
+    return [(header_urn, {'id': response.get('id'), 'jsonrpc': '2.0', 'result': result})]
+
+
+# method -> rule
+DERIVED_ENTRY_RULES = {
+    'get_block': block_header_from_block
+}  # type: Dict[str, Callable[[SingleJrpcRequest, SingleJrpcResponse], DerivedResponses]]
+
+
+def derived_responses(request: SingleJrpcRequest,
+                      response: SingleJrpcResponse) -> DerivedResponses:
+    rule = DERIVED_ENTRY_RULES.get(request.urn.method)
+    if rule is None:
+        return []
+    return rule(request, response)
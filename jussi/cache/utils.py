@@ -1,25 +1,52 @@
 # -*- coding: utf-8 -*-
-import functools
+from hashlib import blake2b
 from typing import Optional
+from typing import Tuple
+from typing import Union
 
 import cytoolz
 import structlog
+from ujson import dumps
+from ujson import loads
 
+from ..empty import _empty
+from ..response import SerializedResponse
 from ..typedefs import BatchJrpcRequest
 from ..typedefs import CachedBatchResponse
 from ..typedefs import CachedSingleResponse
 from ..typedefs import SingleJrpcRequest
 from ..typedefs import SingleJrpcResponse
+from ..urn import URN
+from .backends.block_store import BLOCK_API_FLAVOR
+from .backends.block_store import CONDENSER_FLAVOR
 from .ttl import TTL
 
 logger = structlog.get_logger(__name__)
 
+CACHE_KEY_DIGEST_SIZE = 16
+
 
-@functools.lru_cache(8192)
 def jsonrpc_cache_key(single_jsonrpc_request: SingleJrpcRequest) -> str:
     return str(single_jsonrpc_request.urn)
 
 
+def jsonrpc_cache_key_digest(single_jsonrpc_request: SingleJrpcRequest) -> str:
+    return urn_cache_key_digest(single_jsonrpc_request.urn)
+
+
+def urn_cache_key(urn: URN) -> str:
+    return str(urn)
+
+
+def urn_cache_key_digest(urn: URN) -> str:
+    """a fixed length key, the namespace, api and method stay readable"""
+    if urn.params is _empty:
+        return str(urn)
+    digest = blake2b(str(urn).encode(), digest_size=CACHE_KEY_DIGEST_SIZE).hexdigest()
+    return '.'.join(str(p) for p in (urn.namespace, urn.api, urn.method, f'digest={digest}')
+                    if p is not _empty)
+
+
 def irreversible_ttl(jsonrpc_response: dict=None,
                      last_irreversible_block_num: int=None) -> TTL:
     if not jsonrpc_response:
@@ -69,11 +96,66 @@ def block_num_from_jsonrpc_response(
     return None
 
 
+BLOCK_HEADER_FIELDS = ('previous', 'timestamp', 'witness', 'transaction_merkle_root',
+                       'extensions')
+
+
+def block_store_location(request: SingleJrpcRequest) -> Optional[Tuple[str, int]]:
+    """block store flavor and block num of get_block/get_block_header requests"""
+    urn = request.urn
+    if urn.method not in ('get_block', 'get_block_header'):
+        return None
+    try:
+        if urn.namespace == 'steemd' and urn.api == 'database_api':
+            flavor, block_num = CONDENSER_FLAVOR, urn.params[0]
+        elif urn.namespace == 'appbase' and urn.api == 'condenser_api':
+            flavor, block_num = CONDENSER_FLAVOR, urn.params[0]
+        elif urn.namespace == 'appbase' and urn.api == 'block_api':
+            flavor, block_num = BLOCK_API_FLAVOR, urn.params['block_num']
+        else:
+            return None
+    except (KeyError, IndexError, TypeError):
+        return None
+    if not isinstance(block_num, int) or isinstance(block_num, bool) or block_num < 1:
+        return None
+    return flavor, block_num
+
+
+def block_from_jsonrpc_response(flavor: str, jsonrpc_response: dict) -> Optional[dict]:
+    result = jsonrpc_response.get('result')
+    if flavor == BLOCK_API_FLAVOR:
+        result = result.get('block') if isinstance(result, dict) else None
+    if not isinstance(result, dict) or 'block_id' not in result:
+        return None
+    return result
+
+
+def cached_response_from_block(request: SingleJrpcRequest,
+                               flavor: str,
+                               block: bytes) -> SerializedResponse:
+    if request.urn.method == 'get_block_header':
+        block = loads(block)
+        result = {k: block[k] for k in BLOCK_HEADER_FIELDS if k in block}
+        if flavor == BLOCK_API_FLAVOR:
+            result = {'header': result}
+        return SerializedResponse(request.id, dumps(result, ensure_ascii=False).encode())
+    if flavor == BLOCK_API_FLAVOR:
+        return SerializedResponse(request.id, b''.join((b'{"block":', block, b'}')))
+    return SerializedResponse(request.id, block)
+
+
+def serialized_result(jsonrpc_response: SingleJrpcResponse) -> bytes:
+    """the cached form of a jsonrpc response, its serialized result"""
+    return dumps(jsonrpc_response['result'], ensure_ascii=False).encode()
+
+
 def merge_cached_response(request: SingleJrpcRequest,
-                          cached_response: CachedSingleResponse,
-                          ) -> Optional[SingleJrpcResponse]:
+                          cached_response: Union[bytes, CachedSingleResponse],
+                          ) -> Optional[Union[SerializedResponse, SingleJrpcResponse]]:
     if not cached_response:
         return None
+    if isinstance(cached_response, bytes):
+        return SerializedResponse(request.id, cached_response)
     return {'id': request.id, 'jsonrpc': '2.0', 'result': cached_response['result']}
 
 
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from collections import deque
+from time import perf_counter
+from typing import NamedTuple
+from typing import Optional
+
+import structlog
+
+from .errors import UpstreamOverloadError
+
+logger = structlog.get_logger(__name__)
+
+'''
+Admission control for the requests sent to one upstream.
+
+At most `limit` requests to an upstream are in flight at once. Requests
+over the limit wait in a queue of at most `max_queue` requests, once the
+queue is full they are rejected immediately with UpstreamOverloadError
+instead of piling up on the connection pools until they time out.
+
+The limit adapts to the upstream's latency (AIMD):
+
+- a failed request, or one slower than `latency_tolerance` times the
+  baseline latency of its method, multiplies the limit by `backoff_ratio`
+- otherwise, while at least half the limit is in use, each response raises
+  the limit by one
+
+The baselines are slow moving averages of the latency of successful
+requests, one per method, so naturally slow methods aren't mistaken for an
+overloaded upstream. The latency of batches depends on their size, only
+their failures are recorded. Cancelled requests, eg when a client
+disconnects, say nothing about the upstream and aren't recorded.
+'''
+
+# weight of the newest latency sample in the baseline
+BASELINE_ALPHA = 0.05
+
+# methods with a baseline per limiter, latencies of other methods aren't checked
+MAX_BASELINES = 256
+
+
+class ConcurrencyPolicy(NamedTuple):
+    initial_limit: int = 32
+    min_limit: int = 1
+    max_limit: int = 1000
+    # requests waiting for a slot, 0 rejects as soon as the limit is reached
+    max_queue: int = 100
+    backoff_ratio: float = 0.9
+    latency_tolerance: float = 2.0
+
+
+class Admission:
+    """async context manager holding one slot of a limiter"""
+    __slots__ = ('limiter', 'method', '_start')
+
+    def __init__(self, limiter: 'ConcurrencyLimiter', method: Optional[str] = None) -> None:
+        self.limiter = limiter
+        self.method = method
+        self._start = None
+
+    async def __aenter__(self) -> None:
+        await self.limiter.acquire()
+        self._start = perf_counter()
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is not None and issubclass(exc_type, asyncio.CancelledError):
+            self.limiter.release()
+            return
+        self.limiter.release(perf_counter() - self._start,
+                             failed=exc_type is not None,
+                             method=self.method)
+
+
+class ConcurrencyLimiter:
+    __slots__ = ('url', 'policy', 'limit', 'in_flight', 'baselines',
+                 'rejected', '_waiters')
+
+    def __init__(self, url: str, policy: ConcurrencyPolicy) -> None:
+        self.url = url
+        self.policy = policy
+        self.limit = policy.initial_limit
+        self.in_flight = 0
+        self.baselines = {}
+        self.rejected = 0
+        self._waiters = deque()
+
+    def admit(self, method: Optional[str] = None) -> Admission:
+        return Admission(self, method)
+
+    async def acquire(self) -> None:
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.policy.max_queue:
+            self.rejected += 1
+            raise UpstreamOverloadError(url=self.url, limit=self.limit,
+                                        queued=len(self._waiters))
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            # the slot is handed over by release
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # cancelled after being handed a slot, pass it on
+                self.in_flight -= 1
+                self._wake()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self, latency: Optional[float] = None, failed: bool = False,
+                method: Optional[str] = None) -> None:
+        """latency is None when the request was cancelled"""
+        if latency is not None:
+            self.record(latency, failed=failed, method=method)
+        self.in_flight -= 1
+        self._wake()
+
+    def record(self, latency: float, failed: bool = False,
+               method: Optional[str] = None) -> None:
+        policy = self.policy
+        baseline = self.baselines.get(method, 0.0) if method is not None else 0.0
+        if not failed and baseline and latency > policy.latency_tolerance * baseline:
+            failed = True
+        if failed:
+            limit = max(policy.min_limit, int(self.limit * policy.backoff_ratio))
+            if limit < self.limit:
+                logger.debug('upstream concurrency limit decreased', url=self.url,
+                             limit=limit, latency=latency)
+            self.limit = limit
+            return
+        if baseline:
+            self.baselines[method] = baseline + BASELINE_ALPHA * (latency - baseline)
+        elif method is not None and len(self.baselines) < MAX_BASELINES:
+            self.baselines[method] = latency
+        if self.in_flight * 2 >= self.limit:
+            self.limit = min(policy.max_limit, self.limit + 1)
+
+    def _wake(self) -> None:
+        waiters = self._waiters
+        while waiters and self.in_flight < self.limit:
+            waiter = waiters.popleft()
+            if waiter.done():
+                # cancelled, before its acquire could remove it
+                continue
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'queued': len(self._waiters),
+            'rejected': self.rejected,
+            'baseline_latency': dict(self.baselines)
+        }
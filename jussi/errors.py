@@ -334,3 +334,13 @@ class JussiLimitsError(JsonRpcError):
 class JussiCustomJsonOpLengthError(JsonRpcError):
     code = 1800
     message = 'Custom JSON operation size limit of {size_limit} exceeded'
+
+
+class UpstreamUnavailableError(JsonRpcError):
+    code = 1900
+    message = 'Upstream {url} unavailable, every endpoint has been ejected'
+
+
+class UpstreamOverloadError(JsonRpcError):
+    code = 2000
+    message = 'Upstream {url} overloaded, request rejected'
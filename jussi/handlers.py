@@ -2,24 +2,42 @@
 import asyncio
 import concurrent.futures
 import datetime
+from functools import partial
 from time import perf_counter as perf
+from typing import Callable
 from typing import Coroutine
+from typing import Optional
+from typing import Union
 
+import aiohttp
 import cytoolz
 import structlog
 
 from async_timeout import timeout
 from sanic import response
+from ujson import dumps
 from ujson import loads
 from websockets.exceptions import ConnectionClosed
 
+from .cache.ttl import TTL
+from .cache.utils import jsonrpc_cache_key
+from .concurrency import ConcurrencyLimiter
+from .empty import _empty
 from .errors import InvalidUpstreamURL
 from .errors import RequestTimeoutError
 from .errors import UpstreamResponseError
+from .response import RawResponse
+from .response import dumps_jsonrpc_response
+from .retries import TRANSIENT_ERRORS
+from .typedefs import BatchJrpcRequest
+from .typedefs import BatchJrpcResponse
 from .typedefs import HTTPRequest
 from .typedefs import HTTPResponse
+from .typedefs import JrpcRequest
+from .typedefs import JrpcResponse
 from .typedefs import SingleJrpcRequest
 from .typedefs import SingleJrpcResponse
+from .ws.multiplex import MultiplexedPool
 
 logger = structlog.get_logger(__name__)
 
@@ -35,13 +53,24 @@ async def handle_jsonrpc(http_request: HTTPRequest) -> HTTPResponse:
 
             jsonrpc_response = await dispatch_single(http_request,
                                                      http_request.jsonrpc)
+        elif http_request.cached_batch_responses:
+            # only fetch batch items which were not found in cache
+            cached_responses = http_request.cached_batch_responses
+            requests = [request for request, cached in
+                        zip(http_request.jsonrpc, cached_responses) if cached is None]
+            upstream_responses = iter(await dispatch_batch(http_request, requests))
+            jsonrpc_response = [cached if cached is not None else next(upstream_responses)
+                                for cached in cached_responses]
         else:
 
-            futures = [dispatch_single(http_request, request)
-                       for request in http_request.jsonrpc]
-            jsonrpc_response = await asyncio.gather(*futures)
+            jsonrpc_response = await dispatch_batch(http_request,
+                                                    http_request.jsonrpc)
+        if isinstance(jsonrpc_response, dict):
+            # already decoded, the response middlewares don't decode it again
+            http_request.jsonrpc_response = jsonrpc_response
         http_request.timings.append((perf(), 'handle_jsonrpc.exit'))
-        return response.json(jsonrpc_response)
+        return response.HTTPResponse(body_bytes=dumps_jsonrpc_response(jsonrpc_response),
+                                     content_type='application/json')
 
 
 async def healthcheck(http_request: HTTPRequest) -> HTTPResponse:
@@ -57,6 +86,7 @@ async def healthcheck(http_request: HTTPRequest) -> HTTPResponse:
 
 
 async def monitor(http_request: HTTPRequest) -> HTTPResponse:
+    # pylint: disable=too-many-branches,too-many-statements
     app = http_request.app
     import inspect
 
@@ -64,10 +94,12 @@ async def monitor(http_request: HTTPRequest) -> HTTPResponse:
     try:
         cache_group = app.config.cache_group
         cache_data.append({
-            'cache.memory_cache': {
-                'keys': len(cache_group._memory_cache._keys)
-            }
+            'cache.memory_cache': cache_group._memory_cache.stats
         })
+        if cache_group._shared_memory_cache is not None:
+            cache_data.append({
+                'cache.shared_memory_cache': cache_group._shared_memory_cache.stats
+            })
         for i, cache in enumerate(cache_group._read_caches):
             data = {
                 'read_cache.pool.available': len(cache.client.connection_pool._available_connections),
@@ -99,16 +131,41 @@ async def monitor(http_request: HTTPRequest) -> HTTPResponse:
     except Exception as e:
         logger.error('error adding cache info', e=e)
 
+    upstreams = {}
+    try:
+        upstreams = {group: http_request.app.config.upstreams.balancer(group).stats()
+                     for group in http_request.app.config.upstreams.url_groups}
+    except Exception as e:
+        logger.error('error adding upstreams info', e=e)
+
+    retry_budget = {}
+    try:
+        retry_budget = http_request.app.config.upstream_retry_budget.stats()
+    except Exception as e:
+        logger.error('error adding retry budget info', e=e)
+
+    block_prefetch = {}
+    try:
+        if http_request.app.config.block_prefetcher is not None:
+            block_prefetch = http_request.app.config.block_prefetcher.stats()
+    except Exception as e:
+        logger.error('error adding block prefetch info', e=e)
+
     ws_pools = []
     pools = http_request.app.config.websocket_pools
     try:
         for url, pool in pools.items():
+            if isinstance(pool, MultiplexedPool):
+                ws_pools.append({
+                    'url': url,
+                    'in_flight': pool.in_flight
+                })
+                continue
             data = {
                 'url': url,
-                'queue': pool._queue.qsize,
-                'in_use': len([ch._in_use for ch in pool._holders if ch._in_use is not None]),
                 'ws_read_q_sizes': [ch._con.messages.qsize() for ch in pool._holders if ch._con]
             }
+            data.update(pool.stats())
             ws_pools.append(data)
     except Exception as e:
         logger.error('error adding cache info', e=e)
@@ -132,8 +189,10 @@ async def monitor(http_request: HTTPRequest) -> HTTPResponse:
         'asyncio': async_data,
         'cache': cache_data,
         'server': server_data,
-        'ws_pools': ws_pools
-
+        'ws_pools': ws_pools,
+        'upstreams': upstreams,
+        'retry_budget': retry_budget,
+        'block_prefetch': block_prefetch
     }
     return response.json(data)
 # pylint: enable=protected-access, too-many-locals, no-member, unused-variable
@@ -145,58 +204,388 @@ async def fetch_ws(http_request: HTTPRequest,
                    jrpc_request: SingleJrpcRequest) -> SingleJrpcResponse:
     jrpc_request.timings.append((perf(), 'fetch_ws.enter'))
     pools = http_request.app.config.websocket_pools
-    pool = pools[jrpc_request.upstream.url]
+    balancer = http_request.app.config.upstreams.balancer(jrpc_request.upstream.url)
     upstream_request = jrpc_request.to_upstream_request()
-    try:
-        conn = await pool.acquire()
-        jrpc_request.timings.append((perf(), 'fetch_ws.acquire'))
-        await conn.send(upstream_request)
-        jrpc_request.timings.append((perf(), 'fetch_ws.send'))
-        upstream_response_json = await conn.recv()
-        jrpc_request.timings.append((perf(), 'fetch_ws.response'))
-        upstream_response = loads(upstream_response_json)
-        await pool.release(conn)
-        assert int(upstream_response.get('id')) == jrpc_request.upstream_id
-        upstream_response['id'] = jrpc_request.id
-        jrpc_request.timings.append((perf(), 'fetch_ws.exit'))
-        return upstream_response
-
-    except Exception as e:
+    with balancer.request(upstream_timeout(http_request)) as url:
+        pool = pools[url]
         try:
-            conn.terminate()
-        except NameError:
-            pass
+            conn = await pool.acquire()
+            jrpc_request.timings.append((perf(), 'fetch_ws.acquire'))
+            await conn.send(upstream_request)
+            jrpc_request.timings.append((perf(), 'fetch_ws.send'))
+            upstream_response_json = await conn.recv()
+            jrpc_request.timings.append((perf(), 'fetch_ws.response'))
+            await pool.release(conn)
+            upstream_response = raw_upstream_response(http_request, jrpc_request,
+                                                      upstream_response_json)
+            if upstream_response is None:
+                upstream_response = loads(upstream_response_json)
+                assert int(upstream_response.get('id')) == jrpc_request.upstream_id
+                upstream_response['id'] = jrpc_request.id
+            jrpc_request.timings.append((perf(), 'fetch_ws.exit'))
+            return upstream_response
+
         except Exception as e:
-            logger.error('error while closing connection', e=e)
-        raise e
+            try:
+                conn.terminate()
+            except NameError:
+                pass
+            except Exception as e:
+                logger.error('error while closing connection', e=e)
+            raise e
+
+
+async def fetch_ws_multiplexed(http_request: HTTPRequest,
+                               jrpc_request: SingleJrpcRequest) -> SingleJrpcResponse:
+    jrpc_request.timings.append((perf(), 'fetch_ws_multiplexed.enter'))
+    pools = http_request.app.config.websocket_pools
+    balancer = http_request.app.config.upstreams.balancer(jrpc_request.upstream.url)
+    upstream_request = jrpc_request.to_upstream_request()
+    with balancer.request(upstream_timeout(http_request)) as url:
+        upstream_response = await pools[url].request(jrpc_request.upstream_id,
+                                                     upstream_request)
+    jrpc_request.timings.append((perf(), 'fetch_ws_multiplexed.response'))
+    upstream_response['id'] = jrpc_request.id
+    jrpc_request.timings.append((perf(), 'fetch_ws_multiplexed.exit'))
+    return upstream_response
 
 # pylint: enable=no-value-for-parameter, too-many-locals, too-many-branches, too-many-statements
 
 
+async def fetch_ws_batch(http_request: HTTPRequest,
+                         jrpc_requests: BatchJrpcRequest) -> BatchJrpcResponse:
+    _ = [r.timings.append((perf(), 'fetch_ws_batch.enter')) for r in jrpc_requests]
+    pools = http_request.app.config.websocket_pools
+    balancer = http_request.app.config.upstreams.balancer(jrpc_requests[0].upstream.url)
+    upstream_request = upstream_batch_request(jrpc_requests)
+    with balancer.request(upstream_timeout(http_request)) as url:
+        pool = pools[url]
+        try:
+            conn = await pool.acquire()
+            await conn.send(upstream_request)
+            upstream_response = loads(await conn.recv())
+            await pool.release(conn)
+        except Exception as e:
+            try:
+                conn.terminate()
+            except NameError:
+                pass
+            except Exception as e:
+                logger.error('error while closing connection', e=e)
+            raise e
+    _ = [r.timings.append((perf(), 'fetch_ws_batch.response')) for r in jrpc_requests]
+    return split_upstream_batch_response(jrpc_requests, upstream_response)
+
+
+async def fetch_ws_multiplexed_batch(http_request: HTTPRequest,
+                                     jrpc_requests: BatchJrpcRequest) -> BatchJrpcResponse:
+    _ = [r.timings.append((perf(), 'fetch_ws_multiplexed_batch.enter')) for r in jrpc_requests]
+    pools = http_request.app.config.websocket_pools
+    balancer = http_request.app.config.upstreams.balancer(jrpc_requests[0].upstream.url)
+    upstream_request = upstream_batch_request(jrpc_requests)
+    with balancer.request(upstream_timeout(http_request)) as url:
+        upstream_response = await pools[url].request_batch(
+            [r.upstream_id for r in jrpc_requests], upstream_request)
+    _ = [r.timings.append((perf(), 'fetch_ws_multiplexed_batch.response'))
+         for r in jrpc_requests]
+    return split_upstream_batch_response(jrpc_requests, upstream_response)
+
+
+async def fetch_http_batch(http_request: HTTPRequest,
+                           jrpc_requests: BatchJrpcRequest) -> BatchJrpcResponse:
+    _ = [r.timings.append((perf(), 'fetch_http_batch.enter')) for r in jrpc_requests]
+    balancer = http_request.app.config.upstreams.balancer(jrpc_requests[0].upstream.url)
+    upstream_request = [r.to_upstream_request(as_json=False) for r in jrpc_requests]
+
+    with balancer.request(upstream_timeout(http_request)) as url:
+        async with http_session(http_request, url).post(
+                url,
+                json=upstream_request,
+                headers=jrpc_requests[0].upstream_headers) as resp:
+            upstream_response = await resp.json(encoding='utf-8', content_type=None)
+    _ = [r.timings.append((perf(), 'fetch_http_batch.response')) for r in jrpc_requests]
+    return split_upstream_batch_response(jrpc_requests, upstream_response)
+
+
+def upstream_timeout(http_request: HTTPRequest) -> Optional[float]:
+    """seconds left before the request times out
+
+    Upstream requests time out inside their endpoint context, before the
+    request itself does, so a hanging endpoint counts the timeout as a failure.
+    """
+    request_timeout = http_request.request_timeout
+    if not request_timeout:
+        return None
+    return max(0.0, http_request.request_start_time + request_timeout - perf())
+
+
+def upstream_batch_request(jrpc_requests: BatchJrpcRequest) -> str:
+    return dumps([r.to_upstream_request(as_json=False) for r in jrpc_requests],
+                 ensure_ascii=False)
+
+
+def split_upstream_batch_response(jrpc_requests: BatchJrpcRequest,
+                                  upstream_response: BatchJrpcResponse) -> BatchJrpcResponse:
+    """match upstream batch responses to requests by upstream id,
+    upstreams may return batch responses in any order
+    """
+    if not isinstance(upstream_response, list):
+        raise UpstreamResponseError(jrpc_request=jrpc_requests[0],
+                                    reason='expected jsonrpc batch response',
+                                    upstream_response=upstream_response)
+    try:
+        responses_by_id = {int(r['id']): r for r in upstream_response}
+        responses = [responses_by_id[r.upstream_id] for r in jrpc_requests]
+    except Exception as e:
+        raise UpstreamResponseError(jrpc_request=jrpc_requests[0],
+                                    reason='unmatched jsonrpc batch response ids',
+                                    exception=e) from e
+    for jrpc_request, batch_response in zip(jrpc_requests, responses):
+        batch_response['id'] = jrpc_request.id
+    return responses
+
+
+def http_session(http_request: HTTPRequest, url: str) -> aiohttp.ClientSession:
+    """the session for an http endpoint, each endpoint has its own connection pool"""
+    aio = http_request.app.config.aiohttp
+    return aio.get('sessions', {}).get(url) or aio['session']
+
+
 async def fetch_http(http_request: HTTPRequest,
                      jrpc_request: SingleJrpcRequest) -> SingleJrpcResponse:
     jrpc_request.timings.append((perf(), 'fetch_http.enter'))
-    session = http_request.app.config.aiohttp['session']
+    balancer = http_request.app.config.upstreams.balancer(jrpc_request.upstream.url)
     upstream_request = jrpc_request.to_upstream_request(as_json=False)
 
-    async with session.post(jrpc_request.upstream.url,
-                            json=upstream_request,
-                            headers=jrpc_request.upstream_headers) as resp:
-        jrpc_request.timings.append((perf(), 'fetch_http.response'))
-        upstream_response = await resp.json(encoding='utf-8', content_type=None)
-    upstream_response['id'] = jrpc_request.id
+    with balancer.request(upstream_timeout(http_request)) as url:
+        async with http_session(http_request, url).post(
+                url,
+                json=upstream_request,
+                headers=jrpc_request.upstream_headers) as resp:
+            jrpc_request.timings.append((perf(), 'fetch_http.response'))
+            upstream_response_bytes = await resp.read()
+    upstream_response = raw_upstream_response(http_request, jrpc_request,
+                                              upstream_response_bytes)
+    if upstream_response is None:
+        upstream_response = loads(upstream_response_bytes.decode('utf-8'))
+        upstream_response['id'] = jrpc_request.id
     jrpc_request.timings.append((perf(), 'fetch_http.exit'))
     return upstream_response
+
+
+def raw_upstream_response(http_request: HTTPRequest,
+                          jrpc_request: SingleJrpcRequest,
+                          upstream_response: Union[str, bytes]) -> Optional[RawResponse]:
+    """the upstream response bytes with the id rewritten, when passthrough is enabled"""
+    if not http_request.app.config.args.upstream_response_passthrough:
+        return None
+    return RawResponse.from_upstream(upstream_response,
+                                     jrpc_request.upstream_id,
+                                     jrpc_request.id)
 # pylint: enable=no-value-for-parameter
 
 
+async def fetch_coalesced(http_request: HTTPRequest,
+                          jrpc_request: SingleJrpcRequest,
+                          fetch: Callable) -> SingleJrpcResponse:
+    # identical requests in flight share a single upstream request
+    in_flight = http_request.app.config.upstream_requests_in_flight
+    key = jsonrpc_cache_key(jrpc_request)
+    shared = in_flight.get(key)
+    if shared is None:
+        shared = asyncio.ensure_future(fetch(http_request, jrpc_request))
+        in_flight[key] = shared
+        shared.add_done_callback(partial(_remove_in_flight, in_flight, key))
+    else:
+        jrpc_request.timings.append((perf(), 'fetch_coalesced.shared'))
+    upstream_response = await asyncio.shield(shared)
+    if isinstance(upstream_response, RawResponse):
+        return upstream_response.with_id(jrpc_request.id)
+    return dict(upstream_response, id=jrpc_request.id)
+
+
+async def fetch_hedged(http_request: HTTPRequest,
+                       jrpc_request: SingleJrpcRequest,
+                       fetch: Callable) -> SingleJrpcResponse:
+    # a duplicate request is sent when the first is slower than the hedge
+    # delay, the first successful response wins
+    first = asyncio.ensure_future(fetch(http_request, jrpc_request))
+    try:
+        return await asyncio.wait_for(asyncio.shield(first), jrpc_request.upstream.hedge)
+    except asyncio.TimeoutError:
+        pass
+    except asyncio.CancelledError:
+        first.cancel()
+        raise
+    jrpc_request.timings.append((perf(), 'fetch_hedged.hedge'))
+    hedge = asyncio.ensure_future(fetch(http_request, jrpc_request))
+    pending = {first, hedge}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.exception():
+                    return task.result()
+        return first.result()
+    except asyncio.CancelledError:
+        for task in pending:
+            task.cancel()
+        raise
+    finally:
+        # the slower request finishes in the background so its connection
+        # isn't torn down, its result is discarded
+        for task in pending:
+            task.add_done_callback(_discard_result)
+            if jrpc_request.upstream.timeout:
+                asyncio.get_event_loop().call_later(jrpc_request.upstream.timeout,
+                                                    task.cancel)
+
+
+async def fetch_limited(http_request: HTTPRequest,
+                        jrpc_request: JrpcRequest,
+                        fetch: Callable,
+                        limiter: ConcurrencyLimiter) -> JrpcResponse:
+    # requests over the upstream's concurrency limit wait in a bounded queue,
+    # or are rejected with UpstreamOverloadError when it is full
+    async with limiter.admit(limiter_method(jrpc_request)):
+        return await fetch(http_request, jrpc_request)
+
+
+def limiter_method(jrpc_request: JrpcRequest) -> Optional[str]:
+    """the method whose baseline latency a request is compared with"""
+    if isinstance(jrpc_request, list):
+        # batch latency depends on its size, only its failures are recorded
+        return None
+    urn = jrpc_request.urn
+    return '.'.join(str(p) for p in (urn.api, urn.method) if p is not _empty)
+
+
+async def fetch_retried(http_request: HTTPRequest,
+                        jrpc_request: JrpcRequest,
+                        fetch: Callable) -> JrpcResponse:
+    # transient failures are retried while the retry budget allows and a
+    # retry can finish before the request times out
+    budget = http_request.app.config.upstream_retry_budget
+    request_timeout = http_request.request_timeout
+    if isinstance(jrpc_request, list):
+        # a forwarded batch is retried as a whole
+        jrpc_requests = jrpc_request
+        retries = min(r.upstream.retries for r in jrpc_requests)
+    else:
+        jrpc_requests = [jrpc_request]
+        retries = jrpc_request.upstream.retries
+    while True:
+        attempt_start = perf()
+        try:
+            return await fetch(http_request, jrpc_request)
+        except TRANSIENT_ERRORS as e:
+            if retries <= 0:
+                raise
+            if request_timeout:
+                remaining = http_request.request_start_time + request_timeout - perf()
+                if remaining < perf() - attempt_start:
+                    raise
+            if not budget.withdraw(len(jrpc_requests)):
+                logger.info('retry budget exhausted', e=e)
+                raise
+            retries -= 1
+            _ = [r.timings.append((perf(), 'fetch_retried.retry')) for r in jrpc_requests]
+            logger.debug('retrying upstream request', e=e, retries_left=retries)
+
+
+def _discard_result(future: asyncio.Future) -> None:
+    if not future.cancelled():
+        future.exception()
+
+
+def _remove_in_flight(in_flight: dict, key: str, future: asyncio.Future) -> None:
+    if in_flight.get(key) is future:
+        del in_flight[key]
+    # mark exceptions as retrieved, they are raised to every waiting request
+    if not future.cancelled():
+        future.exception()
+
+
 def dispatch_single(http_request: HTTPRequest,
                     jrpc_request) -> Coroutine:
     # pylint: disable=unexpected-keyword-arg
     if jrpc_request.upstream.url.startswith('ws'):
-        response = fetch_ws(http_request, jrpc_request)
+        if http_request.app.config.args.websocket_multiplex:
+            fetch = fetch_ws_multiplexed
+        else:
+            fetch = fetch_ws
     elif jrpc_request.upstream.url.startswith('http'):
-        response = fetch_http(http_request, jrpc_request)
+        fetch = fetch_http
     else:
         raise InvalidUpstreamURL(url=jrpc_request.upstream.url, reason='scheme')
-    return response
+
+    limiter = http_request.app.config.upstreams.balancer(jrpc_request.upstream.url).limiter
+    if limiter is not None:
+        fetch = partial(fetch_limited, fetch=fetch, limiter=limiter)
+
+    if jrpc_request.upstream.hedge:
+        fetch = partial(fetch_hedged, fetch=fetch)
+
+    # every upstream request adds to the retry budget
+    http_request.app.config.upstream_retry_budget.deposit()
+    if jrpc_request.upstream.retries:
+        fetch = partial(fetch_retried, fetch=fetch)
+
+    # uncacheable requests, eg broadcasts, are never coalesced
+    if http_request.app.config.args.upstream_request_coalescing and \
+            jrpc_request.upstream.ttl != TTL.NO_CACHE:
+        return fetch_coalesced(http_request, jrpc_request, fetch)
+    return fetch(http_request, jrpc_request)
+
+
+def dispatch_upstream_batch(http_request: HTTPRequest,
+                            jrpc_requests: BatchJrpcRequest) -> Coroutine:
+    url = jrpc_requests[0].upstream.url
+    if url.startswith('ws'):
+        if http_request.app.config.args.websocket_multiplex:
+            fetch = fetch_ws_multiplexed_batch
+        else:
+            fetch = fetch_ws_batch
+    elif url.startswith('http'):
+        fetch = fetch_http_batch
+    else:
+        raise InvalidUpstreamURL(url=url, reason='scheme')
+
+    # a forwarded batch takes one slot of the upstream's concurrency limit
+    limiter = http_request.app.config.upstreams.balancer(url).limiter
+    if limiter is not None:
+        fetch = partial(fetch_limited, fetch=fetch, limiter=limiter)
+
+    # every request in the batch adds to the retry budget, as it would sent
+    # on its own, the batch is retried if all of its requests are, so
+    # batches with writes never are
+    http_request.app.config.upstream_retry_budget.deposit(len(jrpc_requests))
+    if all(r.upstream.retries for r in jrpc_requests):
+        fetch = partial(fetch_retried, fetch=fetch)
+
+    # forwarded batches aren't hedged or coalesced, a duplicate batch costs
+    # the upstream as much as the batch and identical batches are rare
+    return fetch(http_request, jrpc_requests)
+
+
+async def dispatch_batch(http_request: HTTPRequest,
+                         jrpc_requests: BatchJrpcRequest) -> BatchJrpcResponse:
+    if not http_request.app.config.args.upstream_batch_forwarding:
+        futures = [dispatch_single(http_request, request)
+                   for request in jrpc_requests]
+        return await asyncio.gather(*futures)
+
+    # send requests for the same upstream url as one jsonrpc batch
+    # pylint: disable=no-member
+    groups = list(cytoolz.groupby(lambda r: r.upstream.url, jrpc_requests).values())
+    futures = [dispatch_upstream_batch(http_request, group) if len(group) > 1
+               else dispatch_single(http_request, group[0])
+               for group in groups]
+    responses_by_index = {}
+    for group, responses in zip(groups, await asyncio.gather(*futures)):
+        if len(group) == 1:
+            responses = [responses]
+        responses_by_index.update(
+            (request.batch_index, response) for request, response in zip(group, responses))
+    return [responses_by_index[request.batch_index] for request in jrpc_requests]
@@ -9,12 +9,21 @@ import aiohttp
 import async_timeout
 import ujson
 
+from jussi.ws.multiplex import MultiplexedPool
 from jussi.ws.pool import Pool
 
+from .balancer import HealthPolicy
 from .cache import setup_caches
+from .concurrency import ConcurrencyPolicy
+from .prefetch import BlockPrefetcher
+from .refresher import run_refresher
+from .retries import RetryBudget
 from .typedefs import WebApp
 from .upstream import _Upstreams
 
+# seconds between websocket pool stats sent to statsd
+POOL_STATS_INTERVAL = 10
+
 
 def setup_listeners(app: WebApp) -> WebApp:
     # pylint: disable=unused-argument, unused-variable
@@ -37,11 +46,30 @@ def setup_listeners(app: WebApp) -> WebApp:
         with open(upstream_config_file) as f:
             upstream_config = json.load(f)
         try:
+            health_policy = HealthPolicy(
+                consecutive_failures=args.upstream_ejection_consecutive_failures,
+                ejection_time=args.upstream_ejection_time,
+                max_latency=args.upstream_ejection_max_latency,
+                max_ejection_percent=args.upstream_max_ejection_percent)
+            concurrency_policy = None
+            if args.upstream_concurrency_limit:
+                concurrency_policy = ConcurrencyPolicy(
+                    initial_limit=args.upstream_concurrency_limit,
+                    max_limit=max(args.upstream_concurrency_limit,
+                                  args.upstream_concurrency_max_limit),
+                    max_queue=args.upstream_concurrency_max_queue,
+                    latency_tolerance=args.upstream_concurrency_latency_tolerance)
             app.config.upstreams = _Upstreams(upstream_config,
-                                              validate=args.test_upstream_urls)
+                                              validate=args.test_upstream_urls,
+                                              health_policy=health_policy,
+                                              concurrency_policy=concurrency_policy)
         except Exception as e:
             logger.error('Bad upstream in config', e=e)
             sys.exit(127)
+        app.config.upstream_requests_in_flight = {}
+        app.config.upstream_retry_budget = RetryBudget(
+            ratio=args.upstream_retry_budget_ratio,
+            burst=args.upstream_retry_budget_burst)
 
     @app.listener('before_server_start')
     def setup_aiohttp_session(app: WebApp, loop) -> None:
@@ -49,14 +77,19 @@ def setup_listeners(app: WebApp) -> WebApp:
         """
         logger = app.config.logger
         logger.info('setup_aiohttp_session', when='before_server_start')
-        tcp_connector = aiohttp.TCPConnector()
-
-        aio = dict(session=aiohttp.ClientSession(
-            connector=tcp_connector,
-            skip_auto_headers=['User-Agent'],
-            loop=loop,
-            json_serialize=partial(ujson.dumps, ensure_ascii=False),
-            headers={'Content-Type': 'application/json'}))
+
+        def client_session():
+            return aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(),
+                skip_auto_headers=['User-Agent'],
+                loop=loop,
+                json_serialize=partial(ujson.dumps, ensure_ascii=False),
+                headers={'Content-Type': 'application/json'})
+
+        # each http endpoint gets its own session and connection pool
+        aio = dict(session=client_session(),
+                   sessions={url: client_session() for url in app.config.upstreams.urls
+                             if url.startswith('http')})
         app.config.aiohttp = aio
 
     @app.listener('before_server_start')
@@ -74,7 +107,20 @@ def setup_listeners(app: WebApp) -> WebApp:
             write_limit=args.websocket_write_limit
         )
         for url in upstream_urls:
-            if url.startswith('ws'):
+            if url.startswith('ws') and args.websocket_multiplex:
+                logger.info('creating multiplexed websocket pool',
+                            pool_size=args.websocket_pool_maxsize,
+                            url=url,
+                            **ws_connect_kwargs
+                            )
+                pools[url] = await MultiplexedPool(
+                    args.websocket_pool_maxsize,  # connections in pool
+                    loop,  # event_loop
+                    url,  # connection url
+                    # all kwargs are passed to websocket connection
+                    **ws_connect_kwargs
+                )
+            elif url.startswith('ws'):
                 logger.info('creating websocket pool',
                             pool_min_size=args.websocket_pool_minsize,
                             pool_maxsize=args.websocket_pool_maxsize,
@@ -88,6 +134,10 @@ def setup_listeners(app: WebApp) -> WebApp:
                     0,  # max queries per conn (0 means unlimited)
                     loop,  # event_loop
                     url,  # connection url
+                    ping_interval=args.websocket_pool_ping_interval,
+                    ping_timeout=args.websocket_pool_ping_timeout,
+                    max_age=args.websocket_pool_max_age,
+                    idle_timeout=args.websocket_pool_idle_timeout,
                     # all kwargs are passed to websocket connection
                     **ws_connect_kwargs
                 )
@@ -112,6 +162,11 @@ def setup_listeners(app: WebApp) -> WebApp:
         logger.info('setup_caching',
                     lirb=app.config.last_irreversible_block_num)
         app.config.cache_read_timeout = args.cache_read_timeout
+        app.config.block_prefetcher = None
+        if args.block_prefetch_depth:
+            app.config.block_prefetcher = BlockPrefetcher(
+                depth=args.block_prefetch_depth,
+                max_distance=args.block_prefetch_max_distance)
 
     @app.listener('before_server_start')
     async def setup_limits(app: WebApp, loop) -> None:
@@ -144,11 +199,33 @@ def setup_listeners(app: WebApp) -> WebApp:
                         statsd_port=port,
                         prefix='jussi',
                         client=app.config.statsd_client)
+            app.config.pool_stats_task = asyncio.ensure_future(
+                report_pool_stats(app, app.config.statsd_client))
+
+    @app.listener('after_server_start')
+    async def start_refresher(app: WebApp, loop) -> None:
+        logger = app.config.logger
+        args = app.config.args
+        app.config.refresher_task = None
+        if args.head_state_refresh_interval:
+            logger.info('start_refresher', when='after_server_start',
+                        interval=args.head_state_refresh_interval,
+                        hot_requests=len(args.cache_hot_requests))
+            app.config.refresher_task = asyncio.ensure_future(run_refresher(app))
+
+    @app.listener('before_server_stop')
+    async def stop_refresher(app: WebApp, loop) -> None:
+        refresher_task = getattr(app.config, 'refresher_task', None)
+        if refresher_task is not None:
+            refresher_task.cancel()
 
     @app.listener('after_server_stop')
     async def close_websocket_connection_pools(app: WebApp, loop) -> None:
         logger = app.config.logger
         logger.info('close_websocket_connection_pools', when='after_server_stop')
+        pool_stats_task = getattr(app.config, 'pool_stats_task', None)
+        if pool_stats_task is not None:
+            pool_stats_task.cancel()
         pools = app.config.websocket_pools
         for url, pool in pools.items():
             logger.info('closing websocket pool for %s', url)
@@ -158,8 +235,9 @@ def setup_listeners(app: WebApp) -> WebApp:
     async def close_aiohttp_session(app: WebApp, loop) -> None:
         logger = app.config.logger
         logger.info('close_aiohttp_session', when='after_server_stop')
-        session = app.config.aiohttp['session']
-        await session.close()
+        await app.config.aiohttp['session'].close()
+        for session in app.config.aiohttp['sessions'].values():
+            await session.close()
 
     @app.listener('after_server_stop')
     async def shutdown_caching(app: WebApp, loop) -> None:
@@ -169,3 +247,25 @@ def setup_listeners(app: WebApp) -> WebApp:
         await cache_group.close()
 
     return app
+
+
+async def report_pool_stats(app: WebApp, statsd_client) -> None:
+    """send websocket pool sizes and acquire waits to statsd"""
+    reported_waits = {}
+    while True:
+        await asyncio.sleep(POOL_STATS_INTERVAL)
+        try:
+            for url, pool in app.config.websocket_pools.items():
+                if not isinstance(pool, Pool):
+                    continue
+                name = 'ws_pool.' + urlparse(url).hostname.replace('.', '_')
+                stats = pool.stats()
+                for key in ('size', 'in_use', 'waiters'):
+                    statsd_client.gauge(f'{name}.{key}', stats[key])
+                for bucket, count in stats['acquire_wait'].items():
+                    stat = f'{name}.acquire_wait.{bucket.replace(".", "_")}'
+                    statsd_client.incr(stat, count - reported_waits.get(stat, 0))
+                    reported_waits[stat] = count
+            statsd_client.flush()
+        except Exception as e:
+            app.config.logger.error('error reporting websocket pool stats', e=e)
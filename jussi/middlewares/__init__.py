@@ -5,6 +5,7 @@ from .jussi import finalize_jussi_response
 from .limits import check_limits
 from .caching import get_response
 from .caching import cache_response
+from .prefetch import prefetch_blocks
 from .update_block_num import update_last_irreversible_block_num
 from .statsd import send_stats
 from .statsd import log_stats
@@ -25,6 +26,8 @@ def setup_middlewares(app):
     app.response_middleware.append(finalize_jussi_response)
     app.response_middleware.append(update_last_irreversible_block_num)
     app.response_middleware.append(cache_response)
+    if app.config.args.block_prefetch_depth:
+        app.response_middleware.append(prefetch_blocks)
 
     if app.config.args.statsd_url is not None:
         app.response_middleware.append(send_stats)
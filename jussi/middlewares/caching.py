@@ -7,9 +7,11 @@ import structlog
 
 from async_timeout import timeout
 from sanic import response
-from ujson import loads
 
 from ..cache.cache_group import UncacheableResponse
+from ..handlers import dispatch_single
+from ..response import RawResponse
+from ..response import dumps_jsonrpc_response
 from ..typedefs import HTTPRequest
 from ..typedefs import HTTPResponse
 from ..utils import async_nowait_middleware
@@ -46,8 +48,29 @@ async def get_response(request: HTTPRequest) -> None:
                 cache_group.is_complete_response(request.jsonrpc, cached_response):
             jussi_cache_key = cache_group.x_jussi_cache_key(request.jsonrpc)
             request.timings.append((perf(), 'get_cached_response.exit'))
-            return response.json(cached_response,
-                                 headers={'x-jussi-cache-hit': jussi_cache_key})
+            return response.HTTPResponse(body_bytes=dumps_jsonrpc_response(cached_response),
+                                         content_type='application/json',
+                                         headers={'x-jussi-cache-hit': jussi_cache_key})
+
+        # keep partial batch hits so only the missing items are fetched upstream
+        if cached_response and request.is_batch_jrpc:
+            request.cached_batch_responses = \
+                cache_group.partial_batch_response(request.jsonrpc, cached_response)
+
+        # serve an expired response within its grace while one request refreshes it
+        if request.is_single_jrpc:
+            stale = cache_group.get_stale_jsonrpc_response(request.jsonrpc)
+            if stale is not None:
+                stale_response, stale_age = stale
+                if cache_group.begin_refresh(request.jsonrpc):
+                    asyncio.ensure_future(refresh_stale_response(request))
+                jussi_cache_key = cache_group.x_jussi_cache_key(request.jsonrpc)
+                request.timings.append((perf(), 'get_cached_response.exit'))
+                return response.HTTPResponse(
+                    body_bytes=dumps_jsonrpc_response(stale_response),
+                    content_type='application/json',
+                    headers={'x-jussi-cache-hit': jussi_cache_key,
+                             'x-jussi-cache-stale-age': f'{stale_age:.3f}'})
 
     except ConnectionRefusedError as e:
         logger.error('error connecting to redis cache', e=e)
@@ -60,6 +83,26 @@ async def get_response(request: HTTPRequest) -> None:
     request.timings.append((perf(), 'get_cached_response.exit'))
 
 
+async def refresh_stale_response(request: HTTPRequest) -> None:
+    cache_group = request.app.config.cache_group
+    try:
+        async with timeout(request.request_timeout):
+            jsonrpc_response = await dispatch_single(request, request.jsonrpc)
+        if isinstance(jsonrpc_response, RawResponse):
+            jsonrpc_response = jsonrpc_response.to_dict()
+        await cache_group.cache_single_jsonrpc_response(
+            request=request.jsonrpc,
+            response=jsonrpc_response,
+            last_irreversible_block_num=request.app.config.last_irreversible_block_num)
+    except UncacheableResponse:
+        pass
+    except Exception as e:
+        logger.warning('error refreshing stale response', e=e,
+                       request_id=request.jussi_request_id)
+    finally:
+        cache_group.end_refresh(request.jsonrpc)
+
+
 @async_nowait_middleware
 async def cache_response(request: HTTPRequest, response: HTTPResponse) -> None:
     try:
@@ -67,7 +110,7 @@ async def cache_response(request: HTTPRequest, response: HTTPResponse) -> None:
             return
         if 'x-jussi-error-id' in response.headers:
             return
-        jsonrpc_response = loads(response.body)
+        jsonrpc_response = request.decoded_jsonrpc_response(response)
         if not jsonrpc_response:
             return
         cache_group = request.app.config.cache_group
@@ -77,8 +120,18 @@ async def cache_response(request: HTTPRequest, response: HTTPResponse) -> None:
                                                             response=jsonrpc_response,
                                                             last_irreversible_block_num=last_irreversible_block_num)
         elif request.is_batch_jrpc:
-            await cache_group.cache_batch_jsonrpc_response(requests=request.jsonrpc,
-                                                           responses=jsonrpc_response,
+            requests = request.jsonrpc
+            responses = jsonrpc_response
+            if request.cached_batch_responses:
+                # only cache the items that were fetched from upstream
+                uncached = [(req, resp) for req, resp, cached in
+                            zip(requests, responses, request.cached_batch_responses)
+                            if cached is None]
+                if not uncached:
+                    return
+                requests, responses = map(list, zip(*uncached))
+            await cache_group.cache_batch_jsonrpc_response(requests=requests,
+                                                           responses=responses,
                                                            last_irreversible_block_num=last_irreversible_block_num)
 
     except UncacheableResponse:
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import structlog
+
+from ..typedefs import HTTPRequest
+from ..typedefs import HTTPResponse
+from ..utils import async_nowait_middleware
+
+logger = structlog.get_logger(__name__)
+
+
+@async_nowait_middleware
+async def prefetch_blocks(request: HTTPRequest, response: HTTPResponse) -> None:
+    if not request.jsonrpc or 'x-jussi-error-id' in response.headers:
+        return
+    try:
+        block_prefetcher = request.app.config.block_prefetcher
+        if request.is_single_jrpc:
+            block_prefetcher.schedule(request.app, request.jsonrpc)
+        elif request.is_batch_jrpc:
+            for jsonrpc_request in request.jsonrpc:
+                block_prefetcher.schedule(request.app, jsonrpc_request)
+    except Exception as e:
+        logger.warning('error prefetching blocks', e=e,
+                       request_id=request.jussi_request_id)
@@ -3,8 +3,8 @@ import asyncio
 from time import perf_counter
 
 import structlog
-import ujson
 
+from ..prefetch import advance_head_block
 from ..typedefs import HTTPRequest
 from ..typedefs import HTTPResponse
 from ..utils import async_nowait_middleware
@@ -19,11 +19,12 @@ async def update_last_irreversible_block_num(request: HTTPRequest, response: HTT
         return
     request.timings.append((perf_counter(), 'update_last_irreversible_block_num.enter'))
     try:
-        jsonrpc_response = ujson.loads(response.body)
         if is_get_dynamic_global_properties_request(request.jsonrpc):
+            jsonrpc_response = request.decoded_jsonrpc_response(response)
             last_irreversible_block_num = jsonrpc_response['result']['last_irreversible_block_num']
             cache_group = request.app.config.cache_group
             request.app.config.last_irreversible_block_num = last_irreversible_block_num
+            advance_head_block(request.app, jsonrpc_response['result'].get('head_block_number'))
             await asyncio.shield(cache_group.set('last_irreversible_block_num',
                                                  last_irreversible_block_num,
                                                  expire_time=180))
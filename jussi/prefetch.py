@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from collections import defaultdict
+from typing import Optional
+
+import structlog
+
+from .cache.utils import BLOCK_API_FLAVOR
+from .cache.utils import block_store_location
+from .request.jsonrpc import JSONRPCRequest
+from .typedefs import WebApp
+
+logger = structlog.get_logger(__name__)
+
+'''
+Speculative prefetch of the blocks after the ones clients ask for.
+
+Clients following the chain request get_block(n), then get_block(n+1) and
+so on. When a get_block near the head block is served, the next `depth`
+blocks are fetched from upstream and cached, so the first client to ask for
+each of them hits the cache instead of every worker missing at once.
+
+Blocks after the head block don't exist yet, they are held back and fetched
+as the head block advances. Each block is prefetched once per worker and
+spelling (steemd, condenser_api or block_api). Requests for blocks more than
+`max_distance` behind the head or more than `depth` past it don't trigger
+prefetches, so the blocks waiting for the head stay bounded.
+'''
+
+
+class BlockPrefetcher:
+    __slots__ = ('depth', 'max_distance', 'head_block_number', '_scheduled', '_pending')
+
+    def __init__(self, depth: int = 3, max_distance: int = 20) -> None:
+        self.depth = depth
+        self.max_distance = max_distance
+        self.head_block_number = None
+        # (namespace, api, block_num) already fetched or waiting
+        self._scheduled = set()
+        # block_num -> requests waiting for the block to exist
+        self._pending = defaultdict(list)
+
+    def schedule(self, app: WebApp, request: JSONRPCRequest) -> None:
+        """prefetch the blocks after a get_block request near the head block"""
+        head_block_number = self.head_block_number
+        if head_block_number is None or request.urn.method != 'get_block':
+            return
+        location = block_store_location(request)
+        if location is None:
+            return
+        flavor, block_num = location
+        # far behind the head, or past blocks that may exist soon
+        if not head_block_number - self.max_distance <= block_num <= \
+                head_block_number + self.depth:
+            return
+        urn = request.urn
+        for next_block_num in range(block_num + 1, block_num + self.depth + 1):
+            key = (urn.namespace, urn.api, next_block_num)
+            if key in self._scheduled:
+                continue
+            self._scheduled.add(key)
+            next_request = get_block_request(urn.namespace, urn.api, flavor, next_block_num)
+            if next_block_num <= head_block_number:
+                self._fetch(app, next_request)
+            else:
+                self._pending[next_block_num].append(next_request)
+
+    def advance(self, app: WebApp, head_block_number: int) -> None:
+        """fetch the blocks waiting for the new head block"""
+        if self.head_block_number is not None and \
+                head_block_number <= self.head_block_number:
+            return
+        self.head_block_number = head_block_number
+        for block_num in sorted(self._pending):
+            if block_num > head_block_number:
+                break
+            for request in self._pending.pop(block_num):
+                self._fetch(app, request)
+        oldest = head_block_number - self.max_distance
+        self._scheduled = {key for key in self._scheduled if key[2] > oldest}
+
+    @staticmethod
+    def _fetch(app: WebApp, request: dict) -> None:
+        # pylint: disable=import-outside-toplevel
+        # the refresher imports this module
+        from .refresher import fetch_and_cache
+        asyncio.ensure_future(fetch_and_cache(app, request))
+
+    def stats(self) -> dict:
+        return {
+            'head_block_number': self.head_block_number,
+            'scheduled': len(self._scheduled),
+            'pending': sum(len(requests) for requests in self._pending.values())
+        }
+
+
+def get_block_request(namespace: str, api: str, flavor: str, block_num: int) -> dict:
+    if flavor == BLOCK_API_FLAVOR:
+        params = {'block_num': block_num}
+    else:
+        params = [block_num]
+    method = 'get_block' if namespace == 'steemd' else f'{api}.get_block'
+    return {'id': block_num, 'jsonrpc': '2.0', 'method': method, 'params': params}
+
+
+def advance_head_block(app: WebApp, head_block_number: Optional[int]) -> None:
+    block_prefetcher = getattr(app.config, 'block_prefetcher', None)
+    if block_prefetcher is not None and head_block_number is not None:
+        block_prefetcher.advance(app, head_block_number)
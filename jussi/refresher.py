@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from random import getrandbits
+from typing import Optional
+
+import structlog
+from async_timeout import timeout
+from ujson import dumps
+
+from .cache.cache_group import UncacheableResponse
+from .handlers import dispatch_single
+from .prefetch import advance_head_block
+from .request.http import HTTPRequest
+from .response import RawResponse
+from .typedefs import SingleJrpcResponse
+from .typedefs import WebApp
+
+logger = structlog.get_logger(__name__)
+
+'''
+Background refresh of the head state and of hot cache keys.
+
+When `head_state_refresh_interval` is set, eg to the 3 second block
+interval, each worker polls get_dynamic_global_properties that often and
+updates `app.config.last_irreversible_block_num` from it. Whenever the head
+block changes, the `cache_hot_requests` are sent upstream and their
+responses cached, so client requests for them are served from the cache
+instead of waiting on an upstream round trip when their TTL expires. Every
+worker runs its own refresher, so upstream load grows with the worker count.
+'''
+
+HEAD_STATE_REQUEST = {'id': 0, 'jsonrpc': '2.0', 'method': 'get_dynamic_global_properties'}
+
+
+def refresher_request(app: WebApp, jsonrpc_request: dict) -> HTTPRequest:
+    """an http request for the upstream pipeline, as if a client had sent it"""
+    # upstream ids are derived from the numeric request id
+    headers = {'x-jussi-request-id': f'{getrandbits(50):018d}'}
+    http_request = HTTPRequest(b'/', headers, '1.1', 'POST', None)
+    http_request.app = app
+    http_request.body = dumps(jsonrpc_request, ensure_ascii=False).encode()
+    return http_request
+
+
+async def fetch_and_cache(app: WebApp, jsonrpc_request: dict) -> Optional[SingleJrpcResponse]:
+    http_request = refresher_request(app, jsonrpc_request)
+    try:
+        async with timeout(http_request.request_timeout):
+            jsonrpc_response = await dispatch_single(http_request, http_request.jsonrpc)
+        if isinstance(jsonrpc_response, RawResponse):
+            jsonrpc_response = jsonrpc_response.to_dict()
+        await app.config.cache_group.cache_single_jsonrpc_response(
+            request=http_request.jsonrpc,
+            response=jsonrpc_response,
+            last_irreversible_block_num=app.config.last_irreversible_block_num)
+        return jsonrpc_response
+    except UncacheableResponse:
+        pass
+    except Exception as e:
+        logger.warning('error refreshing cached response', e=e,
+                       method=jsonrpc_request.get('method'))
+    return None
+
+
+async def refresh_head_state(app: WebApp) -> Optional[int]:
+    """update last_irreversible_block_num, returns the head block number"""
+    jsonrpc_response = await fetch_and_cache(app, HEAD_STATE_REQUEST)
+    try:
+        result = jsonrpc_response['result']
+        last_irreversible_block_num = result['last_irreversible_block_num']
+        head_block_number = result['head_block_number']
+    except Exception:
+        return None
+    app.config.last_irreversible_block_num = last_irreversible_block_num
+    advance_head_block(app, head_block_number)
+    await app.config.cache_group.set('last_irreversible_block_num',
+                                     last_irreversible_block_num,
+                                     expire_time=180)
+    return head_block_number
+
+
+async def refresh_hot_requests(app: WebApp) -> None:
+    await asyncio.gather(*[fetch_and_cache(app, dict(request, id=i, jsonrpc='2.0'))
+                           for i, request in enumerate(app.config.args.cache_hot_requests)])
+
+
+async def run_refresher(app: WebApp) -> None:
+    interval = app.config.args.head_state_refresh_interval
+    head_block_number = None
+    while True:
+        try:
+            new_head_block_number = await refresh_head_state(app)
+            if new_head_block_number is not None and \
+                    new_head_block_number != head_block_number:
+                head_block_number = new_head_block_number
+                await refresh_hot_requests(app)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error('head state refresh error', e=e)
+        await asyncio.sleep(interval)
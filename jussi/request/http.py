@@ -14,7 +14,7 @@ from ujson import loads as json_loads
 
 from jussi.empty import _empty
 from jussi.request.jsonrpc import JSONRPCRequest
-from jussi.request.jsonrpc import from_http_request as jsonrpc_from_request
+from jussi.request.jsonrpc import from_http_request_json as jsonrpc_from_request_json
 
 # pylint: enable=no-name-in-module
 
@@ -45,7 +45,7 @@ class HTTPRequest:
         'body', '_parsed_json', '_parsed_jsonrpc',
         '_ip', '_parsed_url', 'uri_template', 'stream',
         '_socket', '_port', 'timings', '_log', 'is_batch_jrpc',
-        'is_single_jrpc'
+        'is_single_jrpc', 'cached_batch_responses', 'jsonrpc_response'
     )
 
     def __init__(self, url_bytes: bytes, headers: dict,
@@ -66,6 +66,8 @@ class HTTPRequest:
         self.stream = None
         self.is_batch_jrpc = False
         self.is_single_jrpc = False
+        self.cached_batch_responses = None
+        self.jsonrpc_response = None
 
         self.timings = [(perf_counter(), 'http_create')]
         self._log = _empty
@@ -80,7 +82,6 @@ class HTTPRequest:
             self._parsed_jsonrpc = None
             from jussi.errors import ParseError
             from jussi.errors import InvalidRequest
-            from jussi.validators import validate_jsonrpc_request
             try:
                 # raise ParseError for blank/empty body
                 if self.body is _empty:
@@ -91,26 +92,25 @@ class HTTPRequest:
                 except Exception as e:
                     raise ParseError(http_request=self, exception=e)
 
-                # validate jsonrpc
-                jsonrpc_request = self._parsed_json
-                validate_jsonrpc_request(jsonrpc_request)
-
-                if isinstance(jsonrpc_request, dict):
-                    self._parsed_jsonrpc = jsonrpc_from_request(self, 0,
-                                                                jsonrpc_request)
-                    self.is_single_jrpc = True
-                elif isinstance(jsonrpc_request, list):
-                    self._parsed_jsonrpc = [
-                        jsonrpc_from_request(self, batch_index, req)
-                        for batch_index, req in enumerate(jsonrpc_request)
-                    ]
+                # validate and build jsonrpc requests in one pass
+                jsonrpc_request = jsonrpc_from_request_json(self, self._parsed_json)
+                if isinstance(jsonrpc_request, list):
                     self.is_batch_jrpc = True
+                else:
+                    self.is_single_jrpc = True
+                self._parsed_jsonrpc = jsonrpc_request
             except ParseError as e:
                 raise e
             except Exception as e:
                 raise InvalidRequest(http_request=self, exception=e)
         return self._parsed_jsonrpc
 
+    def decoded_jsonrpc_response(self, response) -> Optional[Union[dict, list]]:
+        """the jsonrpc response sent for this request, decoded at most once"""
+        if self.jsonrpc_response is None:
+            self.jsonrpc_response = json_loads(response.body)
+        return self.jsonrpc_response
+
     @property
     def ip(self):
         if not hasattr(self, '_socket'):
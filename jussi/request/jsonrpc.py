@@ -39,7 +39,8 @@ class JSONRPCRequest:
                  'jussi_request_id',
                  'batch_index',
                  'original_request',
-                 'timings')
+                 'timings',
+                 'cache_key')
 
     # pylint: disable=too-many-arguments
     def __init__(self,
@@ -53,7 +54,8 @@ class JSONRPCRequest:
                  jussi_request_id: str,
                  batch_index: int,
                  original_request: SingleRawRequest,
-                 timings: List[Tuple[float, str]]) -> None:
+                 timings: List[Tuple[float, str]],
+                 cache_key: str = None) -> None:
         self.id = _id
         self.jsonrpc = jsonrpc
         self.method = method
@@ -65,6 +67,8 @@ class JSONRPCRequest:
         self.batch_index = batch_index
         self.original_request = original_request
         self.timings = timings
+        # the key of the cache group that parsed the request, if any
+        self.cache_key = cache_key
 
     def to_dict(self):
         return {k: getattr(self, k) for k in
@@ -114,10 +118,50 @@ class JSONRPCRequest:
 # pylint: disable=no-member
 
 def from_http_request(http_request, batch_index: int, request: SingleRawRequest):
+    return _from_raw_request(http_request.app.config.upstreams,
+                             http_request.amzn_trace_id,
+                             http_request.jussi_request_id,
+                             batch_index,
+                             request)
+
+
+def from_http_request_json(http_request, request_json: Union[SingleRawRequest,
+                                                             List[SingleRawRequest]]):
+    """validate a decoded request body and build its JSONRPCRequests in one pass
+
+    Each request is validated, given its URN, its cache key and routed to its
+    upstream as it is built, the per-body values are read once per body.
+    Raises on an invalid request or batch.
+    """
+    # pylint: disable=import-outside-toplevel
+    # the validators import this module
+    from jussi.validators import validate_single_jsonrpc_request
+    upstreams = http_request.app.config.upstreams
+    amzn_trace_id = http_request.amzn_trace_id
+    jussi_request_id = http_request.jussi_request_id
+    cache_key = getattr(getattr(http_request.app.config, 'cache_group', None),
+                        'cache_key', None)
+    if isinstance(request_json, dict):
+        validate_single_jsonrpc_request(request_json)
+        return _from_raw_request(upstreams, amzn_trace_id, jussi_request_id,
+                                 0, request_json, cache_key)
+    assert isinstance(request_json, list) and request_json
+    jsonrpc_requests = []
+    for batch_index, request in enumerate(request_json):
+        validate_single_jsonrpc_request(request)
+        jsonrpc_requests.append(_from_raw_request(upstreams, amzn_trace_id,
+                                                  jussi_request_id, batch_index,
+                                                  request, cache_key))
+    return jsonrpc_requests
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def _from_raw_request(upstreams, amzn_trace_id: str, jussi_request_id: str,
+                      batch_index: int, request: SingleRawRequest,
+                      cache_key=None) -> JSONRPCRequest:
     from ..urn import from_request as urn_from_request
     from ..upstream import Upstream
 
-    upstreams = http_request.app.config.upstreams
     urn = urn_from_request(request)  # type:URN
     upstream = Upstream.from_urn(urn, upstreams=upstreams)  # type: Upstream
     original_request = None
@@ -139,8 +183,9 @@ def from_http_request(http_request, batch_index: int, request: SingleRawRequest)
                           params,
                           urn,
                           upstream,
-                          http_request.amzn_trace_id,
-                          http_request.jussi_request_id,
+                          amzn_trace_id,
+                          jussi_request_id,
                           batch_index,
                           original_request,
-                          timings)
+                          timings,
+                          cache_key(urn) if cache_key is not None else None)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from typing import Any
+from typing import Optional
+from typing import Union
+
+from ujson import dumps
+from ujson import loads
+
+from .typedefs import SingleJrpcResponse
+
+'''
+JSONRPC responses which are written to the client from bytes they were
+already serialized as, with the client's request id spliced in.
+'''
+
+
+class SerializedResponse:
+    """a jsonrpc response whose result is kept as serialized json
+
+    The request id is spliced in when the response is written, so a cached
+    result is never deserialized and serialized again.
+    """
+    __slots__ = ('id', 'result')
+
+    def __init__(self, id: Any, result: bytes) -> None:
+        # pylint: disable=redefined-builtin
+        self.id = id
+        self.result = result
+
+    def to_bytes(self) -> bytes:
+        return b''.join((b'{"id":', dumps(self.id).encode(),
+                         b',"jsonrpc":"2.0","result":', self.result, b'}'))
+
+    def to_dict(self) -> SingleJrpcResponse:
+        return {'id': self.id, 'jsonrpc': '2.0', 'result': loads(self.result)}
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, SerializedResponse):
+            return self.id == other.id and self.result == other.result
+        return self.to_dict() == other
+
+    def __repr__(self) -> str:
+        return f'SerializedResponse(id={self.id!r}, result={self.result[:50]!r})'
+
+
+class RawResponse:
+    """an upstream jsonrpc response kept as the bytes it was received as
+
+    The upstream id is cut out of the bytes, the request id is written in
+    its place without decoding the response.
+    """
+    __slots__ = ('id', '_head', '_tail')
+
+    def __init__(self, id: Any, head: bytes, tail: bytes) -> None:
+        # pylint: disable=redefined-builtin
+        self.id = id
+        self._head = head
+        self._tail = tail
+
+    @classmethod
+    def from_upstream(cls, upstream_response: Union[str, bytes],
+                      upstream_id: int, id: Any) -> Optional['RawResponse']:
+        """None unless the upstream id is the first or last top level member"""
+        # pylint: disable=redefined-builtin
+        if isinstance(upstream_response, str):
+            upstream_response = upstream_response.encode()
+        body = upstream_response.strip()
+        id_member = b'"id":' + str(upstream_id).encode()
+        if body.startswith(b'{' + id_member + b','):
+            return cls(id, b'{"id":', body[len(id_member) + 1:])
+        # a number just before the final brace belongs to the top level object
+        if body.endswith(id_member + b'}') and \
+                body[-len(id_member) - 2:-len(id_member) - 1] in (b',', b'{'):
+            return cls(id, body[:-len(id_member) - 1] + b'"id":', b'}')
+        return None
+
+    def with_id(self, id: Any) -> 'RawResponse':
+        # pylint: disable=redefined-builtin
+        return RawResponse(id, self._head, self._tail)
+
+    def to_bytes(self) -> bytes:
+        return b''.join((self._head, dumps(self.id).encode(), self._tail))
+
+    def to_dict(self) -> SingleJrpcResponse:
+        return loads(self.to_bytes())
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, RawResponse):
+            return self.to_bytes() == other.to_bytes()
+        return self.to_dict() == other
+
+    def __repr__(self) -> str:
+        return f'RawResponse(id={self.id!r}, head={self._head[:50]!r})'
+
+
+def dumps_jsonrpc_response(jsonrpc_response: Union[SingleJrpcResponse,
+                                                   SerializedResponse,
+                                                   RawResponse,
+                                                   list]) -> bytes:
+    if isinstance(jsonrpc_response, (SerializedResponse, RawResponse)):
+        return jsonrpc_response.to_bytes()
+    if isinstance(jsonrpc_response, list):
+        return b''.join((b'[', b','.join(dumps_jsonrpc_response(r) for r in jsonrpc_response),
+                         b']'))
+    return dumps(jsonrpc_response).encode()
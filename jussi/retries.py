@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import aiohttp
+import structlog
+from websockets.exceptions import ConnectionClosed
+
+logger = structlog.get_logger(__name__)
+
+'''
+Retries of upstream requests which failed for transient reasons.
+
+Only idempotent requests are retried, the number of retries is configured
+per prefix with the "retries" upstream config key. Every upstream request
+adds `ratio` to a budget shared by the worker and every retry spends one
+from it, so retries are limited to `ratio` of the upstream traffic and
+can't multiply the load on upstreams during an outage. The budget holds at
+most `burst` retries, which is also what it starts with.
+'''
+
+# errors worth retrying, the connection failed rather than the request
+TRANSIENT_ERRORS = (ConnectionClosed,
+                    ConnectionError,
+                    aiohttp.ClientConnectionError,
+                    asyncio.TimeoutError)
+
+
+class RetryBudget:
+    """limits retries to a fraction of upstream requests"""
+    __slots__ = ('ratio', 'burst', 'balance', 'retries', 'exhausted')
+
+    def __init__(self, ratio: float = 0.1, burst: int = 10) -> None:
+        self.ratio = ratio
+        self.burst = burst
+        self.balance = float(burst)
+        self.retries = 0
+        self.exhausted = 0
+
+    def deposit(self, requests: int = 1) -> None:
+        self.balance = min(self.balance + self.ratio * requests, self.burst)
+
+    def withdraw(self, requests: int = 1) -> bool:
+        """a retried batch withdraws one retry per request in it"""
+        if self.balance < requests:
+            self.exhausted += 1
+            return False
+        self.balance -= requests
+        self.retries += requests
+        return True
+
+    def stats(self) -> dict:
+        return {
+            'ratio': self.ratio,
+            'balance': self.balance,
+            'retries': self.retries,
+            'exhausted': self.exhausted
+        }
@@ -1,18 +1,25 @@
 # -*- coding: utf-8 -*-
-import functools
+import ast
+import collections
 import itertools as it
 import json
 import os
 import re
 import socket
 from typing import NamedTuple
+from typing import Optional
 from urllib.parse import urlparse
 
 import jsonschema
-import pygtrie
 import structlog
 import ujson
 
+from .balancer import DEFAULT_HEALTH_POLICY
+from .balancer import ROUND_ROBIN
+from .balancer import Balancer
+from .balancer import url_group
+from .balancer import url_group_urls
+from .empty import _empty
 from .errors import InvalidUpstreamHost
 from .errors import InvalidUpstreamURL
 
@@ -20,6 +27,15 @@ logger = structlog.get_logger(__name__)
 
 ACCOUNT_TRANSFER_PATTERN = re.compile(r'^\/?(@([^\/\s]+)/transfers|~?witnesses)$')
 
+# requests which change state upstream are never sent twice
+WRITE_APIS = frozenset(['network_broadcast_api'])
+WRITE_METHOD_PREFIX = 'broadcast_'
+
+
+def is_write(request_urn) -> bool:
+    return str(request_urn.api) in WRITE_APIS or \
+        str(request_urn.method).startswith(WRITE_METHOD_PREFIX)
+
 
 # -------------------
 # TTLS
@@ -33,6 +49,12 @@ ACCOUNT_TRANSFER_PATTERN = re.compile(r'^\/?(@([^\/\s]+)/transfers|~?witnesses)$
 #  RETRIES
 #  NO RETRIES: 0
 # -------------------
+#  HEDGES
+#  NO HEDGING: 0
+# -------------------
+#  STALE GRACE
+#  NO STALE RESPONSES: 0
+# -------------------
 
 
 UPSTREAM_SCHEMA_FILE = 'upstreams_schema.json'
@@ -42,15 +64,84 @@ jsonschema.Draft4Validator.check_schema(UPSTREAM_SCHEMA)
 #CONFIG_VALIDATOR = jsonschema.Draft4Validator(UPSTREAM_SCHEMA)
 
 
+class _RoutingTable:
+    """longest prefix match of urns against the config prefixes
+
+    Prefixes which end at or before the method are found with at most three
+    dict lookups. Prefixes which go on into the params are only compared for
+    the methods which have them, so the cost of a lookup doesn't depend on
+    the params of the request.
+    """
+    __slots__ = ('_prefixes', '_params_prefixes')
+
+    def __init__(self, items) -> None:
+        self._prefixes = {}
+        self._params_prefixes = collections.defaultdict(list)
+        for prefix, value in items:
+            segments = tuple(_canonical_prefix(prefix).split('.'))
+            self._prefixes[segments] = value
+            for i in range(1, len(segments)):
+                self._params_prefixes[segments[:i]].append(
+                    ('.'.join(segments[i:]), value))
+        for params_prefixes in self._params_prefixes.values():
+            params_prefixes.sort(key=lambda item: len(item[0]), reverse=True)
+        self._params_prefixes = dict(self._params_prefixes)
+
+    def longest_prefix(self, request_urn):
+        segments = tuple(str(s) if not isinstance(s, str) else s
+                         for s in (request_urn.namespace, request_urn.api, request_urn.method)
+                         if s is not _empty)
+        if request_urn.params is not _empty and segments in self._params_prefixes:
+            key = str(request_urn)
+            params = key[len('.'.join(segments)) + 1:]
+            for params_prefix, value in self._params_prefixes[segments]:
+                if params == params_prefix or params.startswith(params_prefix + '.'):
+                    return value
+        for i in range(len(segments), 0, -1):
+            value = self._prefixes.get(segments[:i], _empty)
+            if value is not _empty:
+                return value
+        return None
+
+    def values(self):
+        return self._prefixes.values()
+
+
+def _canonical_prefix(prefix: str) -> str:
+    """write the params of a prefix the way they appear in a urn"""
+    method_prefix, sep, params = prefix.partition('.params=')
+    if not sep:
+        return prefix
+    try:
+        parsed = ujson.loads(params)
+    except ValueError:
+        try:
+            # prefixes written with python style quotes
+            parsed = ast.literal_eval(params)
+        except (ValueError, SyntaxError):
+            return prefix
+    if isinstance(parsed, dict):
+        parsed = dict(sorted(parsed.items()))
+    return f'{method_prefix}.params={ujson.dumps(parsed, ensure_ascii=False)}'
+
+
+# pylint: disable=too-many-instance-attributes
 class _Upstreams(object):
     __NAMESPACES = None
     __URLS = None
     __TTLS = None
     __TIMEOUTS = None
+    __RETRIES = None
+    __HEDGES = None
+    __STALE_GRACES = None
     __TRANSLATE_TO_APPBASE = None
+    __BALANCERS = None
 
-    def __init__(self, config, validate=True):
+    def __init__(self, config, validate=True, health_policy=DEFAULT_HEALTH_POLICY,
+                 concurrency_policy=None):
         upstream_config = config['upstreams']
+        self.health_policy = health_policy
+        self.concurrency_policy = concurrency_policy
         # CONFIG_VALIDATOR.validate(upstream_config)
         self.config = upstream_config
         self.__hash = hash(ujson.dumps(self.config))
@@ -62,9 +153,13 @@ class _Upstreams(object):
             assert not namespace == 'jsonrpc',\
                 f'Invalid namespace {namespace} : Namespace "jsonrpc" is not allowed'
 
-        self.__URLS = self.__build_trie('urls')
-        self.__TTLS = self.__build_trie('ttls')
-        self.__TIMEOUTS = self.__build_trie('timeouts')
+        self.__URLS = self.__build_table('urls')
+        self.__BALANCERS = self.__build_balancers()
+        self.__TTLS = self.__build_table('ttls')
+        self.__TIMEOUTS = self.__build_table('timeouts')
+        self.__RETRIES = self.__build_table('retries')
+        self.__HEDGES = self.__build_table('hedges')
+        self.__STALE_GRACES = self.__build_table('stale_grace')
 
         self.__TRANSLATE_TO_APPBASE = frozenset(
             c['name'] for c in self.config if c.get('translate_to_appbase', False) is True)
@@ -72,9 +167,9 @@ class _Upstreams(object):
         if validate:
             self.validate_urls()
 
-    def __build_trie(self, key):
-        trie = pygtrie.StringTrie(separator='.')
-        for item in it.chain.from_iterable(c[key] for c in self.config):
+    @staticmethod
+    def __config_items(config, key):
+        for item in config.get(key, []):
             if isinstance(item, list):
                 prefix, value = item
             else:
@@ -83,22 +178,51 @@ class _Upstreams(object):
                 value_key = keys[keys.index(prefix_key) - 1]
                 prefix = item[prefix_key]
                 value = item[value_key]
-            trie[prefix] = value
-        return trie
+            # a prefix may be served by several urls
+            if key == 'urls' and isinstance(value, list):
+                value = url_group(value)
+            yield prefix, value
+
+    def __build_table(self, key):
+        return _RoutingTable(it.chain.from_iterable(
+            self.__config_items(c, key) for c in self.config))
+
+    def __build_balancers(self):
+        balancers = {}
+        for c in self.config:
+            strategy = c.get('load_balancing', ROUND_ROBIN)
+            for _, group in self.__config_items(c, 'urls'):
+                urls = url_group_urls(group)
+                if len({url.startswith('ws') for url in urls}) > 1:
+                    raise InvalidUpstreamURL(url=group, reason='mixed url schemes')
+                balancers[group] = Balancer(urls, strategy=strategy,
+                                            policy=self.health_policy,
+                                            concurrency=self.concurrency_policy)
+        return balancers
+
+    def balancer(self, url: str) -> Balancer:
+        """the balancer for the url, or url group, returned by `url`"""
+        try:
+            return self.__BALANCERS[url]
+        except KeyError:
+            return self.__BALANCERS.setdefault(
+                url, Balancer(url_group_urls(url), policy=self.health_policy,
+                              concurrency=self.concurrency_policy))
 
-    @functools.lru_cache(8192)
     def url(self, request_urn) -> str:
+        # pylint: disable=too-many-boolean-expressions
         # certain steemd.get_state paths must be routed differently
-        if (request_urn.api in ['database_api', 'condenser_api']
-                and request_urn.method == 'get_state'
+        if (request_urn.method == 'get_state'
+                and request_urn.api in ['database_api', 'condenser_api']
                 and isinstance(request_urn.params, list)
                 and len(request_urn.params) == 1
+                and isinstance(request_urn.params[0], str)
                 and ACCOUNT_TRANSFER_PATTERN.match(request_urn.params[0])):
             url = os.environ.get('JUSSI_ACCOUNT_TRANSFER_STEEMD_URL')
             if url:
                 return url
 
-        _, url = self.__URLS.longest_prefix(str(request_urn))
+        url = self.__URLS.longest_prefix(request_urn)
         if not url:
             raise InvalidUpstreamURL(
                 url=url, reason='No matching url found', urn=str(request_urn))
@@ -106,21 +230,48 @@ class _Upstreams(object):
             return url
         raise InvalidUpstreamURL(url=url, reason='invalid format', urn=str(request_urn))
 
-    @functools.lru_cache(8192)
     def ttl(self, request_urn) -> int:
-        _, ttl = self.__TTLS.longest_prefix(str(request_urn))
-        return ttl
+        return self.__TTLS.longest_prefix(request_urn)
 
-    @functools.lru_cache(8192)
     def timeout(self, request_urn) -> int:
-        _, timeout = self.__TIMEOUTS.longest_prefix(str(request_urn))
+        timeout = self.__TIMEOUTS.longest_prefix(request_urn)
         if timeout is 0:
             timeout = None
         return timeout
 
+    def retries(self, request_urn) -> int:
+        """retries after transient upstream failures, writes are never retried"""
+        if is_write(request_urn):
+            return 0
+        return self.__RETRIES.longest_prefix(request_urn) or 0
+
+    def hedge(self, request_urn) -> Optional[float]:
+        """seconds before a duplicate request is sent, None never hedges"""
+        if is_write(request_urn):
+            return None
+        return self.__HEDGES.longest_prefix(request_urn) or None
+
+    def stale_grace(self, request_urn) -> int:
+        """seconds an expired response may still be served while it is refreshed"""
+        return self.__STALE_GRACES.longest_prefix(request_urn) or 0
+
+    @property
+    def max_stale_time(self) -> int:
+        """the longest a response with a stale grace is kept, its ttl plus its grace"""
+        stale_graces = [grace for grace in self.__STALE_GRACES.values() if grace]
+        if not stale_graces:
+            return 0
+        ttls = [ttl for ttl in self.__TTLS.values() if isinstance(ttl, int) and ttl > 0]
+        return max(ttls, default=0) + max(stale_graces)
+
     @property
     def urls(self) -> frozenset:
-        return frozenset(u for u in self.__URLS.values())
+        return frozenset(it.chain.from_iterable(
+            url_group_urls(group) for group in self.__URLS.values()))
+
+    @property
+    def url_groups(self) -> frozenset:
+        return frozenset(self.__URLS.values())
 
     @property
     def namespaces(self)-> frozenset:
@@ -151,10 +302,15 @@ class Upstream(NamedTuple):
     url: str
     ttl: int
     timeout: int
+    hedge: Optional[float] = None
+    retries: int = 0
+    stale_grace: int = 0
 
     @classmethod
-    @functools.lru_cache(4096)
     def from_urn(cls, urn, upstreams: _Upstreams=None):
         return Upstream(upstreams.url(urn),
                         upstreams.ttl(urn),
-                        upstreams.timeout(urn))
+                        upstreams.timeout(urn),
+                        upstreams.hedge(urn),
+                        upstreams.retries(urn),
+                        upstreams.stale_grace(urn))
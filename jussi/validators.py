@@ -13,6 +13,7 @@ from .typedefs import JrpcRequest
 from .typedefs import JrpcResponse
 from .typedefs import RawRequest
 from .typedefs import SingleJrpcResponse
+from .typedefs import SingleRawRequest
 
 logger = structlog.get_logger(__name__)
 
@@ -48,21 +49,21 @@ BROADCAST_TRANSACTION_METHODS = {
 #
 
 
+def validate_single_jsonrpc_request(request: SingleRawRequest) -> NoReturn:
+    assert JSONRPC_REQUEST_KEYS.issuperset(request.keys()) and \
+        request['jsonrpc'] == '2.0' and \
+        isinstance(request['method'], str) and \
+        isinstance(request.get('id'), ID_TYPES) and \
+        isinstance(request.get('params'), PARAMS_TYPES)
+
+
 def validate_jsonrpc_request(request: RawRequest) -> NoReturn:
     from .errors import InvalidRequest
     if isinstance(request, dict):
-        assert JSONRPC_REQUEST_KEYS.issuperset(request.keys()) and \
-            request['jsonrpc'] == '2.0' and \
-            isinstance(request['method'], str) and \
-            isinstance(request.get('id', None), ID_TYPES) and \
-            isinstance(request.get('params', None), (list, dict, type(None)))
+        validate_single_jsonrpc_request(request)
     elif isinstance(request, list) and request:
         for r in request:
-            assert JSONRPC_REQUEST_KEYS.issuperset(r.keys()) and \
-                r['jsonrpc'] == '2.0' and \
-                isinstance(r['method'], str) and \
-                isinstance(r.get('id'), ID_TYPES) and \
-                isinstance(r.get('params'), PARAMS_TYPES)
+            validate_single_jsonrpc_request(r)
     elif isinstance(request, JSONRPCRequest):
         pass  # already be validated
     else:
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import structlog
+from ujson import loads
+# pylint: disable=no-name-in-module
+from websockets import WebSocketClientProtocol as WSConn
+from websockets import connect as websockets_connect
+
+# pylint: enable=no-name-in-module
+logger = structlog.get_logger(__name__)
+
+'''
+A multiplexed websocket connection keeps many jsonrpc requests in flight on a
+single upstream websocket. Each request registers a future under its upstream
+jsonrpc id before it is sent, and one reader task per connection hands every
+upstream response to the future waiting for its id.
+
+Upstream ids are ``JSONRPCRequest.upstream_id``, so an id may only be in flight
+once per connection. The pool routes a request to the least loaded connection
+which isn't already waiting on the same id. When every connection is waiting
+on it, eg for clients sending the same request id, the request waits for one
+of them to be answered.
+'''
+
+
+class MultiplexedConnection:
+    __slots__ = ('_con',
+                 '_loop',
+                 '_pending',
+                 '_reader')
+
+    def __init__(self, pool: 'MultiplexedPool', con: WSConn) -> None:
+        self._loop = pool._loop
+        self._con = con
+        self._pending = {}  # type: Dict[int, asyncio.Future]
+        self._reader = self._loop.create_task(self._read())
+
+    @property
+    def open(self) -> bool:
+        return self._con.open and not self._reader.done()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    def is_pending(self, upstream_id: int) -> bool:
+        return upstream_id in self._pending
+
+    def pending(self, upstream_ids: List[int]) -> List[asyncio.Future]:
+        return [self._pending[upstream_id] for upstream_id in upstream_ids
+                if upstream_id in self._pending]
+
+    async def request(self, upstream_id: int, upstream_request: str) -> dict:
+        if upstream_id in self._pending:
+            raise ValueError(f'upstream id {upstream_id} is already in flight')
+        future = self._loop.create_future()
+        self._pending[upstream_id] = future
+        try:
+            await self._con.send(upstream_request)
+            return await future
+        finally:
+            self._pending.pop(upstream_id, None)
+
+    async def request_batch(self, upstream_ids: List[int], upstream_request: str) -> List[dict]:
+        if any(upstream_id in self._pending for upstream_id in upstream_ids):
+            raise ValueError(f'upstream ids {upstream_ids} are already in flight')
+        futures = [self._loop.create_future() for _ in upstream_ids]
+        self._pending.update(zip(upstream_ids, futures))
+        try:
+            await self._con.send(upstream_request)
+            return await asyncio.gather(*futures, loop=self._loop)
+        finally:
+            for upstream_id in upstream_ids:
+                self._pending.pop(upstream_id, None)
+
+    async def _read(self) -> None:
+        try:
+            while True:
+                upstream_response = loads(await self._con.recv())
+                # batch responses resolve each element's future separately
+                if isinstance(upstream_response, list):
+                    for response in upstream_response:
+                        self._resolve(response)
+                else:
+                    self._resolve(upstream_response)
+        except asyncio.CancelledError:
+            self._fail_pending(ConnectionError('websocket connection closed'))
+            raise
+        except Exception as e:
+            self._fail_pending(e)
+
+    def _resolve(self, upstream_response: dict) -> None:
+        try:
+            future = self._pending.pop(int(upstream_response['id']))
+        except (KeyError, TypeError, ValueError):
+            logger.warning('dropping unmatched upstream response',
+                           upstream_id=upstream_response.get('id'))
+            return
+        if not future.done():
+            future.set_result(upstream_response)
+
+    def _fail_pending(self, exception: Exception) -> None:
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(exception)
+
+    def terminate(self) -> None:
+        self._reader.cancel()
+        self._con.fail_connection()
+
+
+# pylint: disable=too-many-instance-attributes,too-many-arguments,protected-access
+class MultiplexedPool:
+    """A pool of multiplexed websocket connections to an upstream.
+
+    Unlike :class:`jussi.ws.pool.Pool`, connections are never checked out,
+    requests are spread across all connections and any number of them may
+    be in flight on a connection at once.
+    """
+
+    __slots__ = ('_loop',
+                 '_size',
+                 '_connect_url',
+                 '_connect_kwargs',
+                 '_connections',
+                 '_connecting',
+                 '_initialized',
+                 '_closed')
+
+    def __init__(self,
+                 pool_size: int,
+                 pool_loop,
+                 connect_url: str,
+                 **connect_kwargs):
+        if pool_loop is None:
+            pool_loop = asyncio.get_event_loop()
+        self._loop = pool_loop
+
+        if pool_size <= 0:
+            raise ValueError('pool_size is expected to be greater than zero')
+
+        self._size = pool_size
+        self._connect_url = connect_url
+        self._connect_kwargs = connect_kwargs
+        self._connections = [None] * pool_size
+        self._connecting = [None] * pool_size
+        self._initialized = False
+        self._closed = False
+
+    async def _async__init__(self):
+        if self._initialized:
+            return self
+        if self._closed:
+            raise ValueError('pool is closed')
+        await asyncio.gather(*[self._connection(i) for i in range(self._size)],
+                             loop=self._loop)
+        self._initialized = True
+        return self
+
+    async def _get_new_connection(self) -> WSConn:
+        logger.debug('spawning new multiplexed ws conn')
+        return await websockets_connect(self._connect_url, loop=self._loop,
+                                        **self._connect_kwargs)
+
+    async def _connection(self, index: int) -> MultiplexedConnection:
+        conn = self._connections[index]
+        if conn is not None and conn.open:
+            return conn
+        # share one reconnect between every request waiting on this slot
+        if self._connecting[index] is None:
+            self._connecting[index] = asyncio.ensure_future(self._reconnect(index),
+                                                            loop=self._loop)
+        return await asyncio.shield(self._connecting[index], loop=self._loop)
+
+    async def _reconnect(self, index: int) -> MultiplexedConnection:
+        try:
+            if self._connections[index] is not None:
+                self._connections[index].terminate()
+            con = await self._get_new_connection()
+            self._connections[index] = MultiplexedConnection(self, con)
+            return self._connections[index]
+        finally:
+            self._connecting[index] = None
+
+    def _select(self, upstream_ids: List[int]) -> Optional[int]:
+        candidates = [(conn.in_flight if conn is not None else 0, i)
+                      for i, conn in enumerate(self._connections)
+                      if conn is None or not any(conn.is_pending(upstream_id)
+                                                 for upstream_id in upstream_ids)]
+        if not candidates:
+            return None
+        return min(candidates)[1]
+
+    async def _free_connection(self, upstream_ids: List[int]) -> MultiplexedConnection:
+        """the least loaded connection without any of the ids in flight"""
+        while True:
+            index = self._select(upstream_ids)
+            if index is None:
+                await self._wait_for_ids(upstream_ids)
+                continue
+            conn = await self._connection(index)
+            # the ids may have been sent on it while it was connecting
+            if not conn.pending(upstream_ids):
+                return conn
+
+    async def _wait_for_ids(self, upstream_ids: List[int]) -> None:
+        futures = [future for conn in self._connections if conn is not None
+                   for future in conn.pending(upstream_ids) if not future.done()]
+        if futures:
+            await asyncio.wait(futures, loop=self._loop,
+                               return_when=asyncio.FIRST_COMPLETED)
+        else:
+            # answered, but not yet removed by the request waiting on it
+            await asyncio.sleep(0, loop=self._loop)
+
+    async def request(self, upstream_id: int, upstream_request: str) -> dict:
+        if not self._initialized:
+            raise ValueError('pool is not initialized')
+        if self._closed:
+            raise ValueError('pool is closed')
+        conn = await self._free_connection([upstream_id])
+        return await conn.request(upstream_id, upstream_request)
+
+    async def request_batch(self, upstream_ids: List[int], upstream_request: str) -> List[dict]:
+        if not self._initialized:
+            raise ValueError('pool is not initialized')
+        if self._closed:
+            raise ValueError('pool is closed')
+        conn = await self._free_connection(upstream_ids)
+        return await conn.request_batch(upstream_ids, upstream_request)
+
+    @property
+    def in_flight(self) -> list:
+        return [conn.in_flight if conn else 0 for conn in self._connections]
+
+    def terminate(self) -> None:
+        """Terminate all connections in the pool."""
+        if self._closed:
+            return
+        for conn in self._connections:
+            if conn is not None:
+                conn.terminate()
+        self._closed = True
+
+    def __await__(self):
+        return self._async__init__().__await__()
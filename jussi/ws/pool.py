@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 import asyncio
+from collections import deque
+from random import uniform
+from time import perf_counter
 
 import structlog
 # pylint: disable=no-name-in-module
@@ -54,6 +57,30 @@ STEEMIT_MAX_BLOCK_SIZE = 65536  # get_dynamic_global_properties['maximum_block_s
 MAX_WEBSOCKET_RECV_SIZE = None  # no limit
 MAX_WEBSOCKET_READ_LIMIT = STEEMIT_MAX_BLOCK_SIZE + 1000
 
+'''
+Pool maintenance
+
+Requests only ever acquire connections which are already open. A
+maintenance task owned by the pool:
+
+- opens connections when fewer than `min_size` are open, or when requests
+  are waiting and no open connection is free, so the pool grows towards
+  `max_size` as soon as requests queue for connections
+- closes connections beyond `min_size` which have been idle for
+  `idle_timeout` seconds, so the pool shrinks back when load drops
+- reconnects after failures with jittered exponential backoff, so workers
+  don't all reconnect at the same moment after an upstream blip
+- pings idle connections every `ping_interval` seconds and replaces those
+  which don't answer within `ping_timeout`
+- replaces idle connections older than `max_age` seconds, opening the new
+  connection before the old one is closed
+'''
+RECONNECT_BACKOFF_BASE = 0.1
+RECONNECT_BACKOFF_MAX = 10.0
+
+# upper bounds, in seconds, of the acquire wait histogram buckets
+ACQUIRE_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float('inf'))
+
 
 # pylint: disable=protected-access
 class PoolConnectionProxy:
@@ -81,6 +108,7 @@ class PoolConnectionProxy:
         return await self._holder.close()
 
 
+# pylint: disable=too-many-instance-attributes
 class PoolConnectionHolder:
     __slots__ = ('_con',
                  '_pool',
@@ -88,7 +116,9 @@ class PoolConnectionHolder:
                  '_max_queries',
                  '_in_use',
                  '_queries',
-                 '_timeout'
+                 '_timeout',
+                 '_connected_at',
+                 '_released_at'
                  )
 
     def __init__(self, pool, *, max_queries: int):
@@ -100,6 +130,20 @@ class PoolConnectionHolder:
         self._proxy = None
         self._timeout = None
         self._queries = 0
+        self._connected_at = 0.0
+        self._released_at = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return self._con is not None and bool(self._con.open)
+
+    @property
+    def age(self) -> float:
+        return perf_counter() - self._connected_at
+
+    @property
+    def idle_time(self) -> float:
+        return perf_counter() - max(self._connected_at, self._released_at)
 
     async def connect(self):
         if self._con is not None:
@@ -107,11 +151,16 @@ class PoolConnectionHolder:
                 'PoolConnectionHolder.connect() called while another '
                 'connection already exists')
         self._con = await self._pool._get_new_connection()
+        self._connected_at = perf_counter()
 
-    async def acquire(self) -> PoolConnectionProxy:
-        if self._con is None or not self._con.open:
-            self._con = None
-            await self.connect()
+    def replace(self, con: WSConn) -> WSConn:
+        """swap in a new connection, returns the old one"""
+        old_con, self._con = self._con, con
+        self._connected_at = perf_counter()
+        return old_con
+
+    def acquire(self) -> PoolConnectionProxy:
+        # the pool only hands out holders with open connections
         self._in_use = self._pool._loop.create_future()
         self._proxy = PoolConnectionProxy(self, self._con)
         return self._proxy
@@ -159,8 +208,8 @@ class PoolConnectionHolder:
             self._release_on_close()
 
     def _release_on_close(self):
-        self._release()
         self._con = None
+        self._release()
 
     def _release(self):
         """Release this connection holder."""
@@ -171,9 +220,10 @@ class PoolConnectionHolder:
         if not self._in_use.done():
             self._in_use.set_result(None)
         self._in_use = None
+        self._released_at = perf_counter()
 
-        # Put ourselves back to the pool queue.
-        self._pool._queue.put_nowait(self)
+        # Put ourselves back to the pool queue, or up for reconnection
+        self._pool._put(self)
 
 # pylint: disable=too-many-instance-attributes,too-many-arguments,protected-access
 
@@ -192,6 +242,17 @@ class Pool:
                  '_connect_url',
                  '_connect_kwargs',
                  '_holders',
+                 '_unconnected',
+                 '_waiters',
+                 '_wakeup',
+                 '_maintainer',
+                 '_checker',
+                 '_reconnect_failures',
+                 '_ping_interval',
+                 '_ping_timeout',
+                 '_max_age',
+                 '_idle_timeout',
+                 '_acquire_waits',
                  '_initialized',
                  '_closing',
                  '_closed')
@@ -202,6 +263,10 @@ class Pool:
                  pool_max_queries: int,
                  pool_loop,
                  connect_url: str,
+                 ping_interval: float = 20.0,
+                 ping_timeout: float = 5.0,
+                 max_age: float = 0.0,
+                 idle_timeout: float = 0.0,
                  **connect_kwargs):
 
         if pool_loop is None:
@@ -226,7 +291,22 @@ class Pool:
 
         self._holders = []
         self._initialized = False
+        # holders with open connections, ready to be acquired
         self._queue = asyncio.LifoQueue(loop=self._loop)
+        # holders waiting for the maintainer to connect them
+        self._unconnected = deque()
+        self._waiters = 0
+        self._wakeup = asyncio.Event(loop=self._loop)
+        self._maintainer = None
+        # health check of idle connections, separate from reconnects
+        self._checker = None
+        self._reconnect_failures = 0
+
+        self._ping_interval = ping_interval
+        self._ping_timeout = ping_timeout
+        self._max_age = max_age
+        self._idle_timeout = idle_timeout
+        self._acquire_waits = [0] * len(ACQUIRE_WAIT_BUCKETS)
 
         self._closing = False
         self._closed = False
@@ -237,7 +317,7 @@ class Pool:
         for _ in range(pool_max_size):
             ch = PoolConnectionHolder(self, max_queries=pool_max_queries)
             self._holders.append(ch)
-            self._queue.put_nowait(ch)
+            self._unconnected.append(ch)
 
     async def _async__init__(self):
         if self._initialized:
@@ -246,18 +326,8 @@ class Pool:
             raise ValueError('pool is closed')
 
         if self._minsize:
-            # Since we use a LIFO queue, the first items in the queue will be
-            # the last ones in `self._holders`.  We want to pre-connect the
-            # first few connections in the queue, therefore we want to walk
-            # `self._holders` in reverse.
-
-            if self._minsize > 1:
-                connect_tasks = []
-                for i, ch in enumerate(reversed(self._holders)):
-                    if i >= self._minsize:
-                        break
-                    connect_tasks.append(ch.connect())
-                await asyncio.gather(*connect_tasks, loop=self._loop)
+            await self._connect(self._minsize)
+        self._maintainer = asyncio.ensure_future(self._maintain(), loop=self._loop)
         self._initialized = True
         return self
 
@@ -267,20 +337,180 @@ class Pool:
         return await websockets_connect(self._connect_url, loop=self._loop,
                                         **self._connect_kwargs)
 
-    async def acquire(self, timeout: int=None) -> PoolConnectionProxy:
-        async def _acquire_impl(timeout=None) -> PoolConnectionProxy:
-            ch = await self._queue.get()  # type: PoolConnectionHolder
+    def _put(self, ch: PoolConnectionHolder) -> None:
+        if ch.is_open:
+            self._queue.put_nowait(ch)
+        else:
+            ch._con = None
+            self._unconnected.append(ch)
+            self._wakeup.set()
+
+    @property
+    def _open_count(self) -> int:
+        return sum(1 for ch in self._holders if ch.is_open)
+
+    async def _connect(self, count: int) -> None:
+        holders = [self._unconnected.popleft()
+                   for _ in range(min(count, len(self._unconnected)))]
+        results = await asyncio.gather(*[ch.connect() for ch in holders],
+                                       loop=self._loop, return_exceptions=True)
+        for ch, result in zip(holders, results):
+            if isinstance(result, Exception):
+                logger.warning('websocket connect failed', url=self._connect_url,
+                               e=result)
+                self._unconnected.append(ch)
+            else:
+                self._queue.put_nowait(ch)
+        if any(isinstance(result, Exception) for result in results):
+            self._reconnect_failures += 1
+        elif results:
+            self._reconnect_failures = 0
+
+    def _backoff(self) -> float:
+        # equal jitter, between half and all of the exponential delay
+        delay = min(RECONNECT_BACKOFF_MAX,
+                    RECONNECT_BACKOFF_BASE * 2 ** self._reconnect_failures)
+        return uniform(delay / 2, delay)
+
+    def _needed(self) -> int:
+        """connections to open, for min_size and for waiting requests"""
+        missing = self._minsize - self._open_count
+        waiting = self._waiters - self._queue.qsize()
+        return min(max(missing, waiting, 0), len(self._unconnected))
+
+    async def _ping(self, ch: PoolConnectionHolder) -> bool:
+        try:
+            pong_waiter = await ch._con.ping()
+            await asyncio.wait_for(pong_waiter, self._ping_timeout, loop=self._loop)
+            return True
+        except Exception as e:
+            logger.warning('websocket ping failed', url=self._connect_url, e=e)
+        return False
+
+    async def _check_idle(self) -> None:
+        """close surplus idle connections, replace those which are closed,
+        expired or don't answer pings"""
+        if self._idle_timeout:
+            self._shrink_idle()
+        replace = []
+        ping = []
+        for ch in list(self._holders):
+            if ch._in_use is not None or ch._con is None:
+                continue
+            if not ch.is_open or (self._max_age and ch.age > self._max_age):
+                replace.append(ch)
+            elif self._ping_interval:
+                ping.append(ch)
+        # pings run at once, so an unresponsive upstream costs one ping_timeout
+        if ping:
+            answered = await asyncio.gather(*[self._ping(ch) for ch in ping],
+                                            loop=self._loop)
+            replace.extend(ch for ch, ok in zip(ping, answered) if not ok)
+        if replace:
+            await asyncio.gather(*[self._replace(ch) for ch in replace],
+                                 loop=self._loop)
+
+    def _shrink_idle(self) -> None:
+        """close the connections over min_size idle for idle_timeout"""
+        surplus = self._open_count - self._minsize
+        if surplus <= 0:
+            return
+        # the queue is a LIFO, the least recently used holders are last out
+        queued = []
+        while not self._queue.empty():
+            queued.append(self._queue.get_nowait())
             self._queue.task_done()
+        keep = []
+        for ch in reversed(queued):
+            if surplus > 0 and ch.is_open and ch.idle_time > self._idle_timeout:
+                # back with the maintainer until it is needed again
+                con, ch._con = ch._con, None
+                asyncio.ensure_future(con.close(), loop=self._loop)
+                self._unconnected.append(ch)
+                surplus -= 1
+            else:
+                keep.append(ch)
+        for ch in keep:
+            self._queue.put_nowait(ch)
+
+    async def _replace(self, ch: PoolConnectionHolder) -> None:
+        # the new connection is opened before the old one is closed, so the
+        # holder stays available meanwhile
+        try:
+            con = await self._get_new_connection()
+        except Exception as e:
+            logger.warning('websocket connect failed', url=self._connect_url, e=e)
+            return
+        if ch._in_use is not None or ch._con is None:
+            # acquired or sent for reconnection meanwhile
+            asyncio.ensure_future(con.close(), loop=self._loop)
+            return
+        old_con = ch.replace(con)
+        asyncio.ensure_future(old_con.close(), loop=self._loop)
+
+    async def _maintain(self) -> None:
+        last_check = perf_counter()
+        check_interval = min(i for i in (self._ping_interval, self._max_age,
+                                         self._idle_timeout, 60) if i)
+        while not self._closing and not self._closed:
             try:
-                proxy = await ch.acquire()  # type: # type: PoolConnectionProxy
-            except Exception:
-                self._queue.put_nowait(ch)
+                await asyncio.wait_for(self._wakeup.wait(), check_interval,
+                                       loop=self._loop)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                needed = self._needed()
+                if needed:
+                    if self._reconnect_failures:
+                        await asyncio.sleep(self._backoff(), loop=self._loop)
+                    await self._connect(needed)
+                    if self._needed():
+                        self._wakeup.set()
+                if perf_counter() - last_check >= check_interval and \
+                        (self._checker is None or self._checker.done()):
+                    # checked in its own task, so reconnects for waiting
+                    # requests aren't held up by pings
+                    last_check = perf_counter()
+                    self._checker = asyncio.ensure_future(self._checked_idle(),
+                                                          loop=self._loop)
+            except asyncio.CancelledError:
                 raise
-            else:
-                # Record the timeout, as we will apply it by default
-                # in release().
-                ch._timeout = timeout
-                return proxy
+            except Exception as e:
+                logger.error('websocket pool maintenance error',
+                             url=self._connect_url, e=e)
+
+    async def _checked_idle(self) -> None:
+        try:
+            await self._check_idle()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error('websocket pool health check error',
+                         url=self._connect_url, e=e)
+
+    async def acquire(self, timeout: int = None) -> PoolConnectionProxy:
+        async def _acquire_impl(timeout=None) -> PoolConnectionProxy:
+            start = perf_counter()
+            while True:
+                if self._queue.empty():
+                    self._wakeup.set()
+                self._waiters += 1
+                try:
+                    ch = await self._queue.get()  # type: PoolConnectionHolder
+                finally:
+                    self._waiters -= 1
+                self._queue.task_done()
+                if ch.is_open:
+                    break
+                # closed while idle, the maintainer reconnects it
+                self._put(ch)
+            self._record_acquire_wait(perf_counter() - start)
+            proxy = ch.acquire()  # type: PoolConnectionProxy
+            # Record the timeout, as we will apply it by default
+            # in release().
+            ch._timeout = timeout
+            return proxy
 
         if self._closing:
             raise ValueError('pool is closing')
@@ -295,6 +525,23 @@ class Pool:
             return await asyncio.wait_for(
                 _acquire_impl(), timeout=timeout, loop=self._loop)
 
+    def _record_acquire_wait(self, wait: float) -> None:
+        for i, bound in enumerate(ACQUIRE_WAIT_BUCKETS):
+            if wait <= bound:
+                self._acquire_waits[i] += 1
+                return
+
+    def stats(self) -> dict:
+        return {
+            'size': self._open_count,
+            'min_size': self._minsize,
+            'max_size': self._maxsize,
+            'in_use': sum(1 for ch in self._holders if ch._in_use is not None),
+            'waiters': self._waiters,
+            'acquire_wait': {f'le_{bound}': count for bound, count in
+                             zip(ACQUIRE_WAIT_BUCKETS, self._acquire_waits)}
+        }
+
     async def release(self, connection: PoolConnectionProxy, *, timeout: int=None):
         """Release a connection back to the pool.
         """
@@ -336,6 +583,7 @@ class Pool:
             raise ValueError('pool is closed')
 
         self._closing = True
+        self._stop_maintainer()
 
         try:
             release_coros = [
@@ -362,9 +610,18 @@ class Pool:
             raise ValueError('pool is not initialized')
         if self._closed:
             raise ValueError('pool is closed')
+        self._stop_maintainer()
         for ch in self._holders:
             ch.terminate()
         self._closed = True
 
+    def _stop_maintainer(self):
+        if self._maintainer is not None:
+            self._maintainer.cancel()
+            self._maintainer = None
+        if self._checker is not None:
+            self._checker.cancel()
+            self._checker = None
+
     def __await__(self):
         return self._async__init__().__await__()
@@ -24,7 +24,7 @@ import jussi.listeners
 import jussi.logging_config
 import jussi.middlewares
 import jussi.serve
-from jussi.cache.backends.max_ttl import SimplerMaxTTLMemoryCache
+from jussi.cache.backends.max_ttl import LRUMaxTTLMemoryCache
 from jussi.cache.backends.redis import Cache
 from jussi.cache.backends.redis import MockClient
 from jussi.urn import URN
@@ -116,7 +116,12 @@ with open(os.path.join(CONFIGS_DIR, 'TEST_UPSTREAM_CONFIG.json')) as f:
 # ------------------------
 
 def steemd_requests_and_responses():
-    with open(os.path.join(REQS_AND_RESPS_DIR, 'steemd.json')) as f:
+    path = os.path.join(REQS_AND_RESPS_DIR, 'steemd.json')
+    if not os.path.exists(path):
+        # the recorded steemd requests and responses aren't in every
+        # checkout, tests parametrized with them are reported as skipped
+        return []
+    with open(path) as f:
         return ujson.load(f)
 
 
@@ -1685,7 +1690,7 @@ class AttrDict(dict):
 
 
 def build_mocked_cache():
-    mock_client = MockClient(cache=SimplerMaxTTLMemoryCache())
+    mock_client = MockClient(cache=LRUMaxTTLMemoryCache())
     return Cache(client=mock_client)
 
 
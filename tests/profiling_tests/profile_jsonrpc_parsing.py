@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""per request CPU time of turning a request body into JSONRPCRequests and keys
+
+Compares the previous separate passes (validate the decoded body, build each
+request, then build its cache key every time the cache group looks it up)
+with the single pass in `from_http_request_json`, which builds each request's
+cache key once as it is parsed. Each request's key is looked up twice, as on
+a cache miss: once to get the response and once to cache it. The cache group
+uses digest and canonical keys.
+
+    python -m tests.profiling_tests.profile_jsonrpc_parsing
+"""
+import timeit
+
+import ujson
+
+from jussi.cache.cache_group import CacheGroup
+from jussi.request.jsonrpc import from_http_request
+from jussi.request.jsonrpc import from_http_request_json
+from jussi.validators import validate_jsonrpc_request
+from tests.conftest import make_request
+
+NUMBER = 2000
+BATCH_SIZE = 50
+KEY_LOOKUPS = 2
+
+http_request = make_request()
+cache_group = CacheGroup([], cache_key_digest=True, canonical_cache_keys=True)
+http_request.app.config.cache_group = cache_group
+
+
+def requests(count):
+    return [{'id': i, 'jsonrpc': '2.0', 'method': 'get_block', 'params': [i]}
+            for i in range(count)]
+
+
+def cache_keys(jsonrpc_requests):
+    for _ in range(KEY_LOOKUPS):
+        keys = [cache_group._cache_key(r) for r in jsonrpc_requests]
+    return keys
+
+
+def separate_passes(body):
+    request_json = ujson.loads(body)
+    validate_jsonrpc_request(request_json)
+    if isinstance(request_json, dict):
+        return cache_keys([from_http_request(http_request, 0, request_json)])
+    return cache_keys([from_http_request(http_request, batch_index, request)
+                       for batch_index, request in enumerate(request_json)])
+
+
+def single_pass(body):
+    jsonrpc_request = from_http_request_json(http_request, ujson.loads(body))
+    if isinstance(jsonrpc_request, list):
+        return cache_keys(jsonrpc_request)
+    return cache_keys([jsonrpc_request])
+
+
+def per_request_usec(func, body, number):
+    return min(timeit.repeat(lambda: func(body), number=number, repeat=5)) / number * 1e6
+
+
+if __name__ == "__main__":
+    single_body = ujson.dumps(requests(1)[0])
+    batch_body = ujson.dumps(requests(BATCH_SIZE))
+    for name, body, number in (('single', single_body, NUMBER),
+                               (f'batch of {BATCH_SIZE}', batch_body, NUMBER // BATCH_SIZE)):
+        assert separate_passes(body) == single_pass(body)
+        before = per_request_usec(separate_passes, body, number)
+        after = per_request_usec(single_pass, body, number)
+        print(f'{name:>12}: {before:8.1f}us -> {after:8.1f}us per body '
+              f'({before - after:.1f}us saved)')
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from copy import deepcopy
+
+import pytest
+from async_timeout import timeout
+
+from jussi.balancer import EWMA
+from jussi.balancer import LEAST_OUTSTANDING
+from jussi.balancer import ROUND_ROBIN
+from jussi.balancer import Balancer
+from jussi.balancer import HealthPolicy
+from jussi.errors import InvalidUpstreamURL
+from jussi.errors import UpstreamUnavailableError
+from jussi.handlers import fetch_ws
+from jussi.upstream import _Upstreams
+from jussi.urn import URN
+from jussi.urn import from_request
+
+from .conftest import make_request
+
+URLS = ['ws://a.com', 'ws://b.com', 'ws://c.com']
+
+BALANCED_CONFIG = {
+    "limits": {},
+    "upstreams": [
+        {
+            "name": "test",
+            "load_balancing": "least_outstanding",
+            "urls": [
+                ["test", URLS],
+                ["test.api.method", 'http://single.com']
+            ],
+            "ttls": [
+                ["test", 1]
+            ],
+            "timeouts": [
+                ["test", 1]
+            ]
+        }
+    ]}
+
+
+def test_round_robin():
+    balancer = Balancer(URLS, strategy=ROUND_ROBIN)
+    assert [balancer.select().url for _ in range(6)] == URLS * 2
+
+
+def test_single_url():
+    balancer = Balancer(URLS[:1], strategy=EWMA)
+    with balancer.request() as url:
+        assert url == URLS[0]
+        assert balancer.endpoints[0].outstanding == 1
+    assert balancer.endpoints[0].outstanding == 0
+    assert balancer.endpoints[0].requests == 1
+
+
+def test_least_outstanding():
+    balancer = Balancer(URLS, strategy=LEAST_OUTSTANDING)
+    requests = [balancer.request() for _ in range(3)]
+    assert sorted(r.__enter__() for r in requests) == URLS
+    requests[1].__exit__(None, None, None)
+    assert balancer.select() is requests[1].endpoint
+    assert balancer.select() is requests[1].endpoint
+
+
+def test_ewma():
+    balancer = Balancer(URLS, strategy=EWMA)
+    for endpoint, latency in zip(balancer.endpoints, (0.3, 0.1, 0.2)):
+        endpoint.record(latency)
+    assert balancer.select().url == 'ws://b.com'
+    # requests in flight weigh against an endpoint
+    balancer.endpoints[1].outstanding = 2
+    assert balancer.select().url == 'ws://c.com'
+    # the average moves towards new samples
+    balancer.endpoints[0].record(0.0)
+    assert balancer.endpoints[0].latency < 0.3
+
+
+def test_endpoint_request_counts_errors():
+    balancer = Balancer(URLS, strategy=LEAST_OUTSTANDING)
+    with pytest.raises(ValueError):
+        with balancer.request():
+            raise ValueError()
+    assert sum(e.outstanding for e in balancer.endpoints) == 0
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        Balancer(URLS, strategy='random')
+
+
+def test_upstreams_url_groups():
+    upstreams = _Upstreams(BALANCED_CONFIG, validate=False)
+    group = upstreams.url(URN('test', 'api', 'other', [1]))
+    assert upstreams.urls == frozenset(URLS + ['http://single.com'])
+    balancer = upstreams.balancer(group)
+    assert balancer.strategy == LEAST_OUTSTANDING
+    assert [e.url for e in balancer.endpoints] == URLS
+
+    single = upstreams.url(URN('test', 'api', 'method', [1]))
+    assert single == 'http://single.com'
+    assert [e.url for e in upstreams.balancer(single).endpoints] == [single]
+    # urls from outside the config are used as they are
+    assert [e.url for e in upstreams.balancer('ws://other.com').endpoints] == \
+        ['ws://other.com']
+
+
+def test_upstreams_mixed_schemes():
+    config = {"upstreams": [dict(BALANCED_CONFIG['upstreams'][0],
+                                 urls=[["test", ['ws://a.com', 'http://b.com']]])]}
+    with pytest.raises(InvalidUpstreamURL):
+        _Upstreams(config, validate=False)
+
+
+def fail(balancer):
+    with pytest.raises(ValueError):
+        with balancer.request():
+            raise ValueError()
+
+
+def test_ejection_and_probe():
+    balancer = Balancer(URLS[:2], policy=HealthPolicy(consecutive_failures=2,
+                                                      ejection_time=0.05,
+                                                      max_ejection_percent=100))
+    a, b = balancer.endpoints
+    for _ in range(2):
+        with balancer.request():
+            pass
+    for _ in range(4):
+        fail(balancer)
+    # the last endpoint in service is never ejected
+    assert a.state == 'open'
+    assert b.state == 'closed'
+    assert b.failures == 2
+    assert balancer.select() is b
+
+    time.sleep(0.06)
+    assert a.state == 'half_open'
+    requests = [balancer.request(), balancer.request()]
+    probe, = [r for r in requests if r.endpoint is a]
+    other, = [r for r in requests if r.endpoint is b]
+    probe.__enter__()
+    other.__enter__()
+    # only one probe at a time
+    assert balancer.select() is b
+
+    # a failed probe ejects again, a successful request restores the endpoint
+    probe.__exit__(ValueError, ValueError(), None)
+    other.__exit__(None, None, None)
+    assert a.state == 'open'
+    assert b.state == 'closed'
+    assert a.ejections == 2
+
+
+def test_single_url_is_never_ejected():
+    balancer = Balancer(URLS[:1], policy=HealthPolicy(consecutive_failures=1))
+    for _ in range(10):
+        fail(balancer)
+    assert balancer.endpoints[0].state == 'closed'
+    assert balancer.select() is balancer.endpoints[0]
+
+
+def test_max_ejection_percent():
+    balancer = Balancer(URLS, policy=HealthPolicy(consecutive_failures=1,
+                                                  max_ejection_percent=50))
+    for _ in range(6):
+        fail(balancer)
+    assert [e.state for e in balancer.endpoints].count('open') == 1
+
+
+def test_cancelled_requests_are_not_failures():
+    balancer = Balancer(URLS[:2], policy=HealthPolicy(consecutive_failures=1))
+    for _ in range(4):
+        with pytest.raises(asyncio.CancelledError):
+            with balancer.request():
+                raise asyncio.CancelledError()
+    assert all(e.state == 'closed' and e.failures == 0 for e in balancer.endpoints)
+    assert all(e.outstanding == 0 for e in balancer.endpoints)
+
+
+class HangingConnection:
+    async def send(self, message):
+        pass
+
+    async def recv(self):
+        await asyncio.Future()
+
+    def terminate(self):
+        pass
+
+
+class HangingPool:
+    async def acquire(self):
+        return HangingConnection()
+
+    async def release(self, connection):
+        pass
+
+
+async def test_hanging_requests_are_failures():
+    config = deepcopy(BALANCED_CONFIG)
+    config['upstreams'][0]['timeouts'] = [['test', 0.02]]
+    request = {'id': 1, 'jsonrpc': '2.0', 'method': 'test.api.other', 'params': []}
+    app = make_request(upstreams=config).app
+    app.config.websocket_pools = {url: HangingPool() for url in URLS}
+    for _ in range(15):
+        http_request = make_request(body=request, app=app)
+        with pytest.raises(asyncio.TimeoutError):
+            # as in handle_jsonrpc
+            async with timeout(http_request.request_timeout):
+                await fetch_ws(http_request, http_request.jsonrpc)
+    endpoints = app.config.upstreams.balancer(http_request.jsonrpc.upstream.url).endpoints
+    assert [e.state for e in endpoints].count('open') == 1
+    assert all(e.failures for e in endpoints)
+    assert all(e.outstanding == 0 for e in endpoints)
+
+
+def test_slow_requests_are_failures():
+    balancer = Balancer(URLS[:2], policy=HealthPolicy(consecutive_failures=1,
+                                                      max_latency=0.01))
+    with balancer.request() as url:
+        time.sleep(0.02)
+    endpoint, = [e for e in balancer.endpoints if e.url == url]
+    assert endpoint.state == 'open'
+
+
+def test_ejection_disabled():
+    balancer = Balancer(URLS[:1], policy=HealthPolicy(consecutive_failures=0))
+    for _ in range(10):
+        fail(balancer)
+    assert balancer.select() is balancer.endpoints[0]
+
+
+async def test_ejected_upstream_fails_fast(app, mocked_app_test_cli):
+    mocked_ws_conn, test_cli = mocked_app_test_cli
+    request = {'id': 1, 'jsonrpc': '2.0', 'method': 'get_block', 'params': [1000]}
+    group = app.config.upstreams.url(from_request(request))
+    for endpoint in app.config.upstreams.balancer(group).endpoints:
+        endpoint.eject()
+    response = await test_cli.post('/', json=request)
+    json_response = await response.json()
+    assert json_response['error']['code'] == UpstreamUnavailableError.code
+    mocked_ws_conn.send.assert_not_called()
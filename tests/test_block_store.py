@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from jussi.cache import CacheGroupItem
+from jussi.cache import SpeedTier
+from jussi.cache.backends.block_store import BLOCK_API_FLAVOR
+from jussi.cache.backends.block_store import CONDENSER_FLAVOR
+from jussi.cache.backends.block_store import BlockStore
+from jussi.cache.cache_group import CacheGroup
+from jussi.cache.ttl import TTL
+from jussi.cache.utils import block_store_location
+from jussi.cache.utils import jsonrpc_cache_key
+from jussi.cache.utils import serialized_result
+from jussi.request.jsonrpc import from_http_request as jsonrpc_from_request
+
+from .conftest import build_mocked_cache
+from .conftest import make_request
+
+dummy_request = make_request()
+
+block_1000 = {
+    "previous": "000003e7c4fd3221cf407efcf7c1730e2ca54b05",
+    "timestamp": "2016-03-24T16:55:30",
+    "witness": "initminer",
+    "transaction_merkle_root": "0000000000000000000000000000000000000000",
+    "extensions": [],
+    "witness_signature": ("207f15578cac20ac0e8af1ebb8f463106b8849577e21cca9fc60da146d1d95df88"
+                          "072dedc6ffb7f7f44a9185bbf9bf8139a5b4285c9f423843720296a44d428856"),
+    "transactions": [],
+    "block_id": "000003e8b922f4906a45af8e99d86b3511acd7a5",
+    "signing_key": "STM8GC13uCZbP44HzMLV6zPZGwVQ8Nt4Kji8PapsPiNq1BK153XTX",
+    "transaction_ids": []
+}
+header_1000 = {k: block_1000[k] for k in ('previous', 'timestamp', 'witness',
+                                          'transaction_merkle_root', 'extensions')}
+
+
+def jrpc(method, params):
+    return jsonrpc_from_request(dummy_request, 0, {
+        "id": 1, "jsonrpc": "2.0", "method": method, "params": params})
+
+
+@pytest.fixture
+def block_store(tmpdir):
+    store = BlockStore(str(tmpdir.join('blocks')))
+    yield store
+    store.close()
+
+
+def test_block_store_get_put(block_store, tmpdir):
+    assert block_store.get(CONDENSER_FLAVOR, 1000) is None
+    assert block_store.put(CONDENSER_FLAVOR, 1000, block_1000) is True
+    assert block_store.put(CONDENSER_FLAVOR, 1000, {'block_id': 'other'}) is False
+    assert block_store.put(CONDENSER_FLAVOR, 3, {'block_id': '00000003'}) is True
+    assert block_store.get(CONDENSER_FLAVOR, 1000) == block_1000
+    assert block_store.get(CONDENSER_FLAVOR, 3) == {'block_id': '00000003'}
+    assert block_store.get(CONDENSER_FLAVOR, 999) is None
+    assert block_store.get(CONDENSER_FLAVOR, 5000) is None
+    assert block_store.get(BLOCK_API_FLAVOR, 1000) is None
+
+    reopened = BlockStore(str(tmpdir.join('blocks')))
+    assert reopened.get(CONDENSER_FLAVOR, 1000) == block_1000
+    reopened.close()
+
+
+@pytest.mark.parametrize('method,params,expected', [
+    ('get_block', [1000], (CONDENSER_FLAVOR, 1000)),
+    ('get_block_header', [1000], (CONDENSER_FLAVOR, 1000)),
+    ('call', ['database_api', 'get_block', [1000]], (CONDENSER_FLAVOR, 1000)),
+    ('condenser_api.get_block', [1000], (CONDENSER_FLAVOR, 1000)),
+    ('block_api.get_block', {'block_num': 1000}, (BLOCK_API_FLAVOR, 1000)),
+    ('block_api.get_block_header', {'block_num': 1000}, (BLOCK_API_FLAVOR, 1000)),
+    ('get_block', ['1000'], None),
+    ('get_block', [0], None),
+    ('get_accounts', [['steemit']], None),
+])
+def test_block_store_location(method, params, expected):
+    assert block_store_location(jrpc(method, params)) == expected
+
+
+async def test_cache_group_block_store(block_store):
+    redis_cache = build_mocked_cache()
+    cache_group = CacheGroup([CacheGroupItem(redis_cache, True, True, SpeedTier.FAST)],
+                             block_store=block_store)
+    request = jrpc('get_block', [1000])
+    response = {'id': 1, 'jsonrpc': '2.0', 'result': block_1000}
+
+    # reversible blocks are not stored
+    await cache_group.cache_single_jsonrpc_response(request, response,
+                                                    last_irreversible_block_num=999)
+    assert block_store.get(CONDENSER_FLAVOR, 1000) is None
+
+    await cache_group.clear()
+    await cache_group.cache_single_jsonrpc_response(request, response,
+                                                    last_irreversible_block_num=1000)
+    assert block_store.get(CONDENSER_FLAVOR, 1000) == block_1000
+    assert await redis_cache.get(jsonrpc_cache_key(request)) is None
+
+    cache_group._memory_cache.clears()
+    assert await cache_group.get_single_jsonrpc_response(request) == response
+    header_request = jrpc('condenser_api.get_block_header', [1000])
+    assert await cache_group.get_single_jsonrpc_response(header_request) == {
+        'id': 1, 'jsonrpc': '2.0', 'result': header_1000}
+    assert await cache_group.get_single_jsonrpc_response(
+        jrpc('block_api.get_block', {'block_num': 1000})) is None
+
+
+async def test_cache_group_block_store_block_api(block_store):
+    cache_group = CacheGroup([], block_store=block_store)
+    request = jrpc('block_api.get_block', {'block_num': 1000})
+    response = {'id': 1, 'jsonrpc': '2.0', 'result': {'block': block_1000}}
+    await cache_group.cache_single_jsonrpc_response(request, response,
+                                                    ttl=TTL.NO_EXPIRE_IF_IRREVERSIBLE,
+                                                    last_irreversible_block_num=2000)
+    assert block_store.get(BLOCK_API_FLAVOR, 1000) == block_1000
+
+    cache_group._memory_cache.clears()
+    requests = [request, jrpc('block_api.get_block_header', {'block_num': 1000})]
+    assert await cache_group.get_batch_jsonrpc_responses(requests) == [
+        response, {'id': 1, 'jsonrpc': '2.0', 'result': {'header': header_1000}}]
+
+
+async def test_cache_group_block_store_batch(block_store):
+    redis_cache = build_mocked_cache()
+    cache_group = CacheGroup([CacheGroupItem(redis_cache, True, True, SpeedTier.FAST)],
+                             block_store=block_store)
+    requests = [jrpc('get_block', [1000]), jrpc('get_block', [1001])]
+    responses = [{'id': 1, 'jsonrpc': '2.0', 'result': block_1000},
+                 {'id': 1, 'jsonrpc': '2.0', 'result': dict(
+                     block_1000, block_id='000003e9' + block_1000['block_id'][8:])}]
+    await cache_group.cache_batch_jsonrpc_response(requests, responses,
+                                                   last_irreversible_block_num=1000)
+    assert block_store.get(CONDENSER_FLAVOR, 1000) == block_1000
+    assert block_store.get(CONDENSER_FLAVOR, 1001) is None
+    assert await redis_cache.get(jsonrpc_cache_key(requests[0])) is None
+    assert await redis_cache.get(jsonrpc_cache_key(requests[1])) == \
+        serialized_result(responses[1])
@@ -2,14 +2,14 @@
 
 import time
 import pytest
-from jussi.cache.backends.max_ttl import SimplerMaxTTLMemoryCache
+from jussi.cache.backends.max_ttl import LRUMaxTTLMemoryCache
 
 from .conftest import make_request
 from .conftest import build_mocked_cache
 dummy_request = make_request()
 
 
-@pytest.mark.parametrize('cache', [SimplerMaxTTLMemoryCache(), build_mocked_cache()])
+@pytest.mark.parametrize('cache', [LRUMaxTTLMemoryCache(), build_mocked_cache()])
 async def test_cache_clear(cache):
     await cache.clear()
     assert await cache.get('key') is None
@@ -19,27 +19,27 @@ async def test_cache_clear(cache):
     assert await cache.get('key') is None
 
 
-@pytest.mark.parametrize('cache', [SimplerMaxTTLMemoryCache()])
+@pytest.mark.parametrize('cache', [LRUMaxTTLMemoryCache()])
 def test_cache_gets(cache):
     cache.sets('key', 'value', None)
     assert cache.gets('key') == 'value'
 
 
-@pytest.mark.parametrize('cache', [SimplerMaxTTLMemoryCache(), build_mocked_cache()])
+@pytest.mark.parametrize('cache', [LRUMaxTTLMemoryCache(), build_mocked_cache()])
 async def test_cache_get(cache):
     await cache.clear()
     await cache.set('key', 'value', None)
     assert await cache.get('key') == 'value'
 
 
-@pytest.mark.parametrize('cache', [SimplerMaxTTLMemoryCache()])
+@pytest.mark.parametrize('cache', [LRUMaxTTLMemoryCache()])
 def test_cache_mgets(cache):
     cache.sets('key', 'value', None)
     cache.sets('key2', 'value2', None)
     assert cache.mgets(['key', 'key2']) == ['value', 'value2']
 
 
-@pytest.mark.parametrize('cache', [SimplerMaxTTLMemoryCache(), build_mocked_cache()])
+@pytest.mark.parametrize('cache', [LRUMaxTTLMemoryCache(), build_mocked_cache()])
 async def test_cache_mget(cache):
     await cache.clear()
     await cache.set('key', 'value', None)
@@ -47,14 +47,14 @@ async def test_cache_mget(cache):
     assert await cache.mget(['key', 'key2']) == ['value', 'value2']
 
 
-@pytest.mark.parametrize('cache', [SimplerMaxTTLMemoryCache()])
+@pytest.mark.parametrize('cache', [LRUMaxTTLMemoryCache()])
 def test_cache_set_manys(cache):
     cache.set_manys({'key1': 'value1', 'key2': 'value2'}, None)
     assert cache.gets('key1') == 'value1'
     assert cache.gets('key2') == 'value2'
 
 
-@pytest.mark.parametrize('cache', [SimplerMaxTTLMemoryCache(), build_mocked_cache()])
+@pytest.mark.parametrize('cache', [LRUMaxTTLMemoryCache(), build_mocked_cache()])
 async def test_cache_set_many(cache):
     await cache.clear()
     await cache.set_many({'key': 'value', 'key2': 'value2'}, 180)
@@ -62,21 +62,21 @@ async def test_cache_set_many(cache):
     assert await cache.get('key2') == 'value2'
 
 
-@pytest.mark.parametrize('cache', [SimplerMaxTTLMemoryCache()])
+@pytest.mark.parametrize('cache', [LRUMaxTTLMemoryCache()])
 def test_cache_deletes(cache):
     cache.sets('key', 'value', None)
     cache.deletes('key')
     assert cache.gets('key') is None
 
 
-@pytest.mark.parametrize('cache', [SimplerMaxTTLMemoryCache(), build_mocked_cache()])
+@pytest.mark.parametrize('cache', [LRUMaxTTLMemoryCache(), build_mocked_cache()])
 async def test_cache_delete(cache):
     await cache.set('key', 'value', None)
     await cache.delete('key')
     assert await cache.get('key') is None
 
 
-@pytest.mark.parametrize('cache', [SimplerMaxTTLMemoryCache()])
+@pytest.mark.parametrize('cache', [LRUMaxTTLMemoryCache()])
 def test_cache_ttl_none(cache):
     now = time.perf_counter()
     cache.sets('key', 'value', None)
@@ -84,13 +84,13 @@ def test_cache_ttl_none(cache):
     assert timestamp - (now + cache._max_ttl) < 5
 
 
-@pytest.mark.parametrize('cache', [SimplerMaxTTLMemoryCache()])
+@pytest.mark.parametrize('cache', [LRUMaxTTLMemoryCache()])
 def test_cache_ttl_expire(cache):
     cache.sets('key', 'value', 0)
     assert cache.gets('key') is None
 
 
-@pytest.mark.parametrize('cache', [SimplerMaxTTLMemoryCache()])
+@pytest.mark.parametrize('cache', [LRUMaxTTLMemoryCache()])
 def test_cache_ttl_large_ttl(cache):
     now = time.perf_counter()
     cache.sets('key', 'value', cache._max_ttl + 100)
@@ -98,9 +98,95 @@ def test_cache_ttl_large_ttl(cache):
     assert timestamp - (now + cache._max_ttl) < 5
 
 
-@pytest.mark.parametrize('cache', [SimplerMaxTTLMemoryCache()])
+@pytest.mark.parametrize('cache', [LRUMaxTTLMemoryCache()])
 def test_cache_max_size(cache):
     max_size = cache._max_size
     for i in range(max_size + 10):
         cache.sets(f'{i}', 'value', cache._max_ttl + 100)
     assert len(cache._cache) == max_size
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUMaxTTLMemoryCache(max_size=3)
+    cache.sets('a', 1, None)
+    cache.sets('b', 2, None)
+    cache.sets('c', 3, None)
+    assert cache.gets('a') == 1
+    cache.sets('d', 4, None)
+    assert cache.gets('b') is None
+    assert cache.mgets(['a', 'c', 'd']) == [1, 3, 4]
+
+
+def test_lru_cache_configurable_max_ttl():
+    cache = LRUMaxTTLMemoryCache(max_ttl=10)
+    now = time.perf_counter()
+    cache.sets('key', 'value', 100)
+    timestamp, value = cache._cache['key']
+    assert timestamp - now < 11
+
+
+def test_lru_cache_prune_removes_expired():
+    cache = LRUMaxTTLMemoryCache(max_ttl=10)
+    cache.sets('expired', 'value', 1)
+    cache.sets('live', 'value', 10)
+    cache.sets('rewritten', 'value', 1)
+    cache.sets('rewritten', 'value', 10)
+    cache.prune(time.perf_counter() + 3)
+    assert 'expired' not in cache._cache
+    assert 'live' in cache._cache
+    assert 'rewritten' in cache._cache
+
+    cache.prune(time.perf_counter() + 30)
+    assert len(cache._cache) == 0
+    assert not any(cache._wheel)
+
+
+def test_lru_cache_byte_budget():
+    cache = LRUMaxTTLMemoryCache(max_bytes=100)
+    cache.sets('a', 'x' * 40, None)
+    cache.sets('b', 'x' * 40, None)
+    assert cache._bytes == 84
+    cache.sets('c', 'x' * 40, None)
+    assert cache.gets('a') is None
+    assert cache.mgets(['b', 'c']) == ['x' * 40, 'x' * 40]
+    assert cache._bytes == 84
+
+    # values larger than the budget are not cached
+    cache.sets('d', 'x' * 200, None)
+    assert cache.gets('d') is None
+    assert cache._bytes == 84
+
+    cache.deletes('b')
+    assert cache._bytes == 42
+    cache.clears()
+    assert cache._bytes == 0
+
+
+def test_lru_cache_counts_tuple_items():
+    cache = LRUMaxTTLMemoryCache(max_bytes=1000)
+    value = b'x' * 450
+    cache.sets('a', (time.perf_counter(), value), None)
+    assert cache._bytes > len(value)
+    cache.sets('b', (time.perf_counter(), value), None)
+    assert cache.gets('a') is None
+    assert cache._bytes < 1000
+
+
+def test_lru_cache_stats():
+    cache = LRUMaxTTLMemoryCache(max_size=1)
+    cache.sets('a', 1, None)
+    cache.sets('b', 1, None)
+    assert cache.gets('b') == 1
+    assert cache.gets('a') is None
+    cache.sets('d', 1, None)
+    assert cache.gets('d') == 1
+    assert cache.gets('b') is None
+    assert cache.stats == {
+        'keys': 1,
+        'bytes': 1,
+        'max_bytes': cache._max_bytes,
+        'hits': 2,
+        'misses': 2,
+        'evictions': 2,
+        'expirations': 0
+    }
@@ -2,11 +2,11 @@
 import pytest
 from time import perf_counter
 
-from jussi.cache.backends.max_ttl import SimplerMaxTTLMemoryCache
 from jussi.cache import CacheGroupItem
 from jussi.cache import SpeedTier
 from jussi.cache.cache_group import CacheGroup
 from jussi.cache.utils import jsonrpc_cache_key
+from jussi.cache.utils import serialized_result
 
 
 from .conftest import make_request
@@ -257,13 +257,13 @@ async def test_cache_group_get_single_jsonrpc_response(
     assert await cache_group.get(key) is None
     await cache_group.set('last_irreversible_block_num', 15_000_000, 180)
     await cache_group.cache_single_jsonrpc_response(req, resp)
-    assert await cache_group.get(key) == resp
+    assert await cache_group.get(key) == serialized_result(resp)
     assert await cache_group.get_single_jsonrpc_response(req) == resp
     cache_group._memory_cache.clears()
     assert await cache_group.get_single_jsonrpc_response(req) == resp
 
     for cache_item in caches:
-        assert await cache_item.cache.get(key) == resp
+        assert await cache_item.cache.get(key) == serialized_result(resp)
 
 
 async def test_cache_group_get_batch_jsonrpc_responses():
@@ -281,7 +281,7 @@ async def test_cache_group_get_batch_jsonrpc_responses():
             "extensions": [],
             "witness_signature": "207f15578cac20ac0e8af1ebb8f463106b8849577e21cca9fc60da146d1d95df88072dedc6ffb7f7f44a9185bbf9bf8139a5b4285c9f423843720296a44d428856",
             "transactions": [],
-            "block_id": "000003e8b922f4906a45af8e99d86b3511acd7a5",
+            "block_id": f"{_id:08x}b922f4906a45af8e99d86b3511acd7a5",
             "signing_key": "STM8GC13uCZbP44HzMLV6zPZGwVQ8Nt4Kji8PapsPiNq1BK153XTX",
             "transaction_ids": []
         }
@@ -317,7 +317,7 @@ async def test_cache_group_cache_batch_jsonrpc_responses():
         "extensions": [],
         "witness_signature": "207f15578cac20ac0e8af1ebb8f463106b8849577e21cca9fc60da146d1d95df88072dedc6ffb7f7f44a9185bbf9bf8139a5b4285c9f423843720296a44d428856",
         "transactions": [],
-        "block_id": "000003e8b922f4906a45af8e99d86b3511acd7a5",
+        "block_id": f"{_id:08x}b922f4906a45af8e99d86b3511acd7a5",
         "signing_key": "STM8GC13uCZbP44HzMLV6zPZGwVQ8Nt4Kji8PapsPiNq1BK153XTX",
         "transaction_ids": []}} for _id in range(1, 10)]
 
@@ -333,11 +333,13 @@ async def test_cache_group_cache_batch_jsonrpc_responses():
     await cache_group.cache_batch_jsonrpc_response(batch_req, batch_resp)
 
     for i, key in enumerate(keys):
-        assert cache_group._memory_cache.gets(key) == batch_resp[i]
-        assert await caches[0].cache.get(key) == batch_resp[i]
-        assert await caches[1].cache.get(key) == batch_resp[i]
-        assert await caches[2].cache.get(key) == batch_resp[i]
-        assert await cache_group.get(key) == batch_resp[i]
+        # only the serialized result is cached
+        result = serialized_result(batch_resp[i])
+        assert cache_group._memory_cache.gets(key) == result
+        assert await caches[0].cache.get(key) == result
+        assert await caches[1].cache.get(key) == result
+        assert await caches[2].cache.get(key) == result
+        assert await cache_group.get(key) == result
 
 
 def test_cache_group_is_complete_response(steemd_request_and_response):
@@ -385,3 +387,105 @@ def test_cache_group_x_jussi_cache_key(steemd_request_and_response):
     batch_req = [req, req, req]
     assert jsonrpc_cache_key(req) == CacheGroup.x_jussi_cache_key(req)
     assert CacheGroup.x_jussi_cache_key(batch_req) == 'batch'
+
+
+def test_cache_group_partial_batch_response():
+    assert CacheGroup.partial_batch_response([request, request2],
+                                             [response, None]) == [response, None]
+    assert CacheGroup.partial_batch_response([request, request2],
+                                             [bad_response1, response]) == [None, response]
+    assert CacheGroup.partial_batch_response([request, request2],
+                                             [None, bad_response2]) is None
+
+
+def block_response(block_num, flavor_wrap=False):
+    block = {
+        'previous': f'{block_num - 1:08x}' + 'ab' * 16,
+        'timestamp': '2016-03-24T16:55:30',
+        'witness': 'initminer',
+        'transaction_merkle_root': '0000000000000000000000000000000000000000',
+        'extensions': [],
+        'witness_signature': '20' * 65,
+        'transactions': [],
+        'block_id': f'{block_num:08x}' + 'ab' * 16,
+        'signing_key': 'STM8GC13uCZbP44HzMLV6zPZGwVQ8Nt4Kji8PapsPiNq1BK153XTX',
+        'transaction_ids': []
+    }
+    header = {k: block[k] for k in ('previous', 'timestamp', 'witness',
+                                    'transaction_merkle_root', 'extensions')}
+    if flavor_wrap:
+        return {'id': 1, 'jsonrpc': '2.0', 'result': {'block': block}}, \
+            {'id': 1, 'jsonrpc': '2.0', 'result': {'header': header}}
+    return {'id': 1, 'jsonrpc': '2.0', 'result': block}, \
+        {'id': 1, 'jsonrpc': '2.0', 'result': header}
+
+
+@pytest.mark.parametrize('block_request,header_request,flavor_wrap', [
+    ({'method': 'get_block', 'params': [1000]},
+     {'method': 'get_block_header', 'params': [1000]}, False),
+    ({'method': 'condenser_api.get_block', 'params': [1000]},
+     {'method': 'condenser_api.get_block_header', 'params': [1000]}, False),
+    ({'method': 'block_api.get_block', 'params': {'block_num': 1000}},
+     {'method': 'block_api.get_block_header', 'params': {'block_num': 1000}}, True),
+])
+async def test_cache_group_derived_block_header(block_request, header_request, flavor_wrap):
+    cache_group = CacheGroup([])
+    block_request = jsonrpc_from_request(dummy_request, 0, dict(block_request, id=1, jsonrpc='2.0'))
+    header_request = jsonrpc_from_request(dummy_request, 0,
+                                          dict(header_request, id=1, jsonrpc='2.0'))
+    block, header = block_response(1000, flavor_wrap=flavor_wrap)
+
+    await cache_group.cache_single_jsonrpc_response(block_request, block,
+                                                    last_irreversible_block_num=2000)
+    assert await cache_group.get_single_jsonrpc_response(header_request) == header
+
+
+async def test_cache_group_derived_block_header_ttl_and_batch():
+    cache_group = CacheGroup([])
+    requests = [jsonrpc_from_request(dummy_request, i, {
+        'id': i, 'jsonrpc': '2.0', 'method': 'get_block', 'params': [block_num]})
+        for i, block_num in enumerate((1000, 1001))]
+    header_requests = [jsonrpc_from_request(dummy_request, i, {
+        'id': 1, 'jsonrpc': '2.0', 'method': 'get_block_header', 'params': [block_num]})
+        for i, block_num in enumerate((1000, 1001))]
+    blocks, headers = zip(block_response(1000), block_response(1001))
+    await cache_group.cache_batch_jsonrpc_response(requests, list(blocks),
+                                                   last_irreversible_block_num=1000)
+    cached = await cache_group.get_batch_jsonrpc_responses(header_requests)
+    assert cached == list(headers)
+
+    # headers expire with their blocks, irreversible ones later than reversible ones
+    expires = {key: timestamp for key, (timestamp, _) in cache_group._memory_cache._cache.items()}
+    for request, header_request in zip(requests, header_requests):
+        assert expires[jsonrpc_cache_key(header_request)] == \
+            pytest.approx(expires[jsonrpc_cache_key(request)], abs=0.1)
+    assert expires[jsonrpc_cache_key(header_requests[0])] > \
+        expires[jsonrpc_cache_key(header_requests[1])] + 1
+
+    # with canonical keys the header is stored under the canonical key
+    cache_group = CacheGroup([], canonical_cache_keys=True)
+    await cache_group.cache_single_jsonrpc_response(requests[0], blocks[0],
+                                                    last_irreversible_block_num=1000)
+    block_api_header_request = jsonrpc_from_request(dummy_request, 0, {
+        'id': 1, 'jsonrpc': '2.0', 'method': 'block_api.get_block_header',
+        'params': {'block_num': 1000}})
+    assert await cache_group.get_single_jsonrpc_response(block_api_header_request) == \
+        {'id': 1, 'jsonrpc': '2.0', 'result': {'header': headers[0]['result']}}
+
+
+async def test_cache_group_cache_batch_skips_uncacheable_items():
+    cache_group = CacheGroup([])
+    requests = [jsonrpc_from_request(dummy_request, i, {
+        'id': i, 'jsonrpc': '2.0', 'method': 'get_block', 'params': [block_num]})
+        for i, block_num in enumerate((1000, 1001, 1002))]
+    block, _ = block_response(1000)
+    responses = [block,
+                 # a block that doesn't exist yet
+                 {'id': 1, 'jsonrpc': '2.0', 'result': None},
+                 {'id': 2, 'jsonrpc': '2.0', 'error': {'code': -32000, 'message': 'error'}}]
+    await cache_group.cache_batch_jsonrpc_response(requests, responses,
+                                                   last_irreversible_block_num=2000)
+    cached = await cache_group.get_batch_jsonrpc_responses(requests)
+    assert cached[0] == dict(block, id=0)
+    assert cached[1:] == [None, None]
+    assert CacheGroup.is_complete_response(requests, cached) is False
@@ -1,8 +1,120 @@
 # -*- coding: utf-8 -*-
+import pytest
+
+from jussi.cache.cache_group import CacheGroup
+from jussi.cache.canonical import canonical_urn
 from jussi.cache.utils import jsonrpc_cache_key
+from jussi.cache.utils import jsonrpc_cache_key_digest
+from jussi.empty import _empty
+from jussi.request.jsonrpc import from_http_request as jsonrpc_from_request
+
+from .conftest import make_request
+
+
+def jrpc(method, params=None):
+    request = {'id': 1, 'jsonrpc': '2.0', 'method': method}
+    if params is not None:
+        request['params'] = params
+    return jsonrpc_from_request(make_request(), 0, request)
 
 
 def test_cache_key(urn_test_requests):
     jsonrpc_request, urn, url, ttl, timeout, jussi_request = urn_test_requests
     result = jsonrpc_cache_key(jussi_request)
     assert result == urn
+
+
+def test_cache_key_digest(urn_test_requests):
+    jsonrpc_request, urn, url, ttl, timeout, jussi_request = urn_test_requests
+    result = jsonrpc_cache_key_digest(jussi_request)
+    parsed = jussi_request.urn
+    if parsed.params is _empty:
+        assert result == urn
+    else:
+        prefix = '.'.join(p for p in (parsed.namespace, parsed.api, parsed.method)
+                          if p is not _empty)
+        assert result.startswith(prefix + '.digest=')
+
+
+def test_cache_key_digest_fixed_length():
+    names = [f'account{i}' for i in range(500)]
+    few = jsonrpc_cache_key_digest(jrpc('get_accounts', [['steemit']]))
+    many = jsonrpc_cache_key_digest(jrpc('get_accounts', [names]))
+    assert few.startswith('steemd.database_api.get_accounts.digest=')
+    assert len(few) == len(many) < 80
+    assert few != many
+    assert jsonrpc_cache_key_digest(jrpc('get_dynamic_global_properties')) == \
+        'steemd.database_api.get_dynamic_global_properties'
+    # equal urns share a key
+    assert jsonrpc_cache_key_digest(jrpc('call', ['database_api', 'get_accounts', [names]])) == many
+    assert jsonrpc_cache_key_digest(jrpc('block_api.get_block', {'block_num': 1})) \
+        .startswith('appbase.block_api.get_block.digest=')
+
+
+async def test_cache_group_cache_key_digest():
+    cache_group = CacheGroup([], cache_key_digest=True)
+    request = jrpc('get_block', [1000])
+    response = {'id': 1, 'jsonrpc': '2.0', 'result': {'block_id': '000003e8'}}
+    await cache_group.cache_single_jsonrpc_response(request, response, ttl=60)
+    assert cache_group._memory_cache.gets(jsonrpc_cache_key(request)) is None
+    assert cache_group._memory_cache.gets(jsonrpc_cache_key_digest(request)) is not None
+    assert await cache_group.get_single_jsonrpc_response(request) == response
+
+
+@pytest.mark.parametrize('method,params,expected', [
+    ('get_block', [1000], 'appbase.condenser_api.get_block.params=[1000]'),
+    ('call', ['database_api', 'get_block', [1000]],
+     'appbase.condenser_api.get_block.params=[1000]'),
+    ('condenser_api.get_block', [1000], 'appbase.condenser_api.get_block.params=[1000]'),
+    ('call', ['condenser_api', 'get_block', [1000]],
+     'appbase.condenser_api.get_block.params=[1000]'),
+    ('get_dynamic_global_properties', None,
+     'appbase.condenser_api.get_dynamic_global_properties.params=[]'),
+    ('condenser_api.get_dynamic_global_properties', [],
+     'appbase.condenser_api.get_dynamic_global_properties.params=[]'),
+    ('block_api.get_block_header', {'block_num': 1000},
+     'appbase.condenser_api.get_block_header.params=[1000]'),
+    # appbase formatted operations, not equivalent to condenser_api
+    ('block_api.get_block', {'block_num': 1000},
+     'appbase.block_api.get_block.params={"block_num":1000}'),
+    ('database_api.get_dynamic_global_properties', {},
+     'appbase.database_api.get_dynamic_global_properties.params={}'),
+])
+def test_canonical_urn(method, params, expected):
+    assert str(canonical_urn(jrpc(method, params).urn)) == expected
+
+
+async def test_cache_group_canonical_cache_keys():
+    cache_group = CacheGroup([], canonical_cache_keys=True)
+    header = {'previous': '000003e7c4fd3221cf407efcf7c1730e2ca54b05',
+              'timestamp': '2016-03-24T16:55:30',
+              'witness': 'initminer',
+              'transaction_merkle_root': '0000000000000000000000000000000000000000',
+              'extensions': []}
+    steemd_request = jrpc('get_block_header', [1000])
+    await cache_group.cache_single_jsonrpc_response(
+        steemd_request, {'id': 1, 'jsonrpc': '2.0', 'result': header}, ttl=60)
+
+    condenser_request = jrpc('call', ['condenser_api', 'get_block_header', [1000]])
+    cached = await cache_group.get_single_jsonrpc_response(condenser_request)
+    assert cached == {'id': 1, 'jsonrpc': '2.0', 'result': header}
+
+    # the block_api result is adapted from the canonical one
+    block_api_request = jrpc('block_api.get_block_header', {'block_num': 1000})
+    cached = await cache_group.get_single_jsonrpc_response(block_api_request)
+    assert cached == {'id': 1, 'jsonrpc': '2.0', 'result': {'header': header}}
+
+    # and back
+    await cache_group.clear()
+    await cache_group.cache_single_jsonrpc_response(
+        block_api_request, {'id': 1, 'jsonrpc': '2.0', 'result': {'header': header}}, ttl=60)
+    cached = await cache_group.get_batch_jsonrpc_responses([steemd_request, block_api_request])
+    assert cached == [{'id': 1, 'jsonrpc': '2.0', 'result': header},
+                      {'id': 1, 'jsonrpc': '2.0', 'result': {'header': header}}]
+
+    # without canonical keys each spelling has its own entry
+    cache_group = CacheGroup([])
+    await cache_group.cache_single_jsonrpc_response(
+        steemd_request, {'id': 1, 'jsonrpc': '2.0', 'result': header}, ttl=60)
+    assert await cache_group.get_single_jsonrpc_response(condenser_request) is None
+    assert await cache_group.get_single_jsonrpc_response(block_api_request) is None
@@ -98,3 +98,147 @@ async def test_mocked_cache_response_middleware(mocked_app_test_cli):
     response = await test_cli.post('/', json=req, headers={'x-jussi-request-id': '1'})
     assert response.headers['x-jussi-cache-hit'] == 'steemd.database_api.get_dynamic_global_properties'
     assert await response.json() == expected_response
+
+
+get_block_1000_response = {
+    "id": 1,
+    "jsonrpc": "2.0",
+    "result": {
+        "previous": "000003e7c4fd3221cf407efcf7c1730e2ca54b05",
+        "timestamp": "2016-03-24T16:55:30",
+        "witness": "initminer",
+        "transaction_merkle_root": "0000000000000000000000000000000000000000",
+        "extensions": [],
+        "witness_signature": ("207f15578cac20ac0e8af1ebb8f463106b8849577e21cca9fc60da146d1d95df88"
+                              "072dedc6ffb7f7f44a9185bbf9bf8139a5b4285c9f423843720296a44d428856"),
+        "transactions": [],
+        "block_id": "000003e8b922f4906a45af8e99d86b3511acd7a5",
+        "signing_key": "STM8GC13uCZbP44HzMLV6zPZGwVQ8Nt4Kji8PapsPiNq1BK153XTX",
+        "transaction_ids": []}}
+
+
+async def test_mocked_partial_batch_cache_response_middleware(app, mocked_app_test_cli):
+    mocked_ws_conn, test_cli = mocked_app_test_cli
+    batch_req = [
+        {"id": 1, "jsonrpc": "2.0", "method": "get_block", "params": [1000]},
+        {"id": 2, "jsonrpc": "2.0", "method": "get_dynamic_global_properties"}
+    ]
+    await app.config.cache_group.set('steemd.database_api.get_block.params=[1000]',
+                                     get_block_1000_response, 180)
+
+    # upstream id is x-jussi-request-id + batch_index
+    upstream_response = dict(expected_response, id=2)
+    mocked_ws_conn.recv.return_value = json.dumps(upstream_response)
+    response = await test_cli.post('/', json=batch_req, headers={'x-jussi-request-id': '1'})
+    assert 'x-jussi-cache-hit' not in response.headers
+    assert await response.json() == [get_block_1000_response,
+                                     dict(expected_response, id=2)]
+
+    # only the uncached item was sent upstream
+    assert mocked_ws_conn.send.call_count == 1
+    sent = json.loads(mocked_ws_conn.send.call_args[0][0])
+    assert sent['method'] == 'get_dynamic_global_properties'
+
+
+async def test_stale_while_revalidate(monkeypatch):
+    import asyncio
+    import copy
+
+    from jussi.cache.cache_group import CacheGroup
+    from jussi.middlewares import caching
+
+    from .conftest import TEST_UPSTREAM_CONFIG
+    from .conftest import make_request
+
+    config = copy.deepcopy(TEST_UPSTREAM_CONFIG)
+    config['upstreams'][0]['stale_grace'] = [['steemd.database_api', 5]]
+    http_request = make_request(body=req, upstreams=config)
+    app = http_request.app
+    app.config.cache_group = CacheGroup([])
+    app.config.cache_read_timeout = 1
+    app.config.last_irreversible_block_num = 1
+    cache_group = app.config.cache_group
+
+    refreshed = dict(expected_response, result={'head_block_number': 2})
+    calls = []
+
+    async def dispatch_single(http_request, jrpc_request):
+        calls.append(jrpc_request)
+        await asyncio.sleep(0.01)
+        return refreshed
+    monkeypatch.setattr(caching, 'dispatch_single', dispatch_single)
+
+    await cache_group.cache_single_jsonrpc_response(request=http_request.jsonrpc,
+                                                    response=expected_response)
+    # the response has expired, but is within its grace
+    cache_group._memory_cache.clears()
+    responses = [await caching.get_response(http_request) for _ in range(2)]
+    for response in responses:
+        assert json.loads(response.body) == expected_response
+        assert float(response.headers['x-jussi-cache-stale-age']) >= 0
+        assert response.headers['x-jussi-cache-hit'] == \
+            'steemd.database_api.get_dynamic_global_properties'
+
+    # one background refresh repopulates the cache
+    await asyncio.sleep(0.05)
+    assert len(calls) == 1
+    response = await caching.get_response(http_request)
+    assert json.loads(response.body) == refreshed
+    assert 'x-jussi-cache-stale-age' not in response.headers
+
+
+def test_stale_cache_budget():
+    from jussi.cache.cache_group import CacheGroup
+    from jussi.cache.backends.max_ttl import STALE_CACHE_MAX_BYTES
+
+    assert CacheGroup([])._stale_cache._max_bytes == STALE_CACHE_MAX_BYTES
+    cache_group = CacheGroup([], memory_cache_max_bytes=2**20, stale_cache_max_bytes=2**10)
+    assert cache_group._memory_cache._max_bytes == 2**20
+    assert cache_group._stale_cache._max_bytes == 2**10
+
+
+def test_stale_cache_max_ttl():
+    from jussi.cache.cache_group import CacheGroup
+
+    cache_group = CacheGroup([], memory_cache_max_ttl=10)
+    assert cache_group._stale_cache._max_ttl == 10
+    # graces past the memory cache's max ttl aren't cut short
+    cache_group = CacheGroup([], memory_cache_max_ttl=10, stale_cache_max_ttl=40)
+    assert cache_group._memory_cache._max_ttl == 10
+    assert cache_group._stale_cache._max_ttl == 40
+
+
+async def test_stale_batch_responses():
+    import copy
+
+    from jussi.cache.cache_group import CacheGroup
+
+    from .conftest import TEST_UPSTREAM_CONFIG
+    from .conftest import make_request
+
+    config = copy.deepcopy(TEST_UPSTREAM_CONFIG)
+    config['upstreams'][0]['stale_grace'] = [['steemd.database_api', 5]]
+    http_request = make_request(body=json.dumps([req, dict(req, id=2)]).encode(),
+                                upstreams=config)
+    cache_group = CacheGroup([])
+    await cache_group.cache_batch_jsonrpc_response(
+        requests=http_request.jsonrpc,
+        responses=[expected_response, dict(expected_response, id=2)],
+        last_irreversible_block_num=1)
+    cache_group._memory_cache.clears()
+    stale_response, stale_age = cache_group.get_stale_jsonrpc_response(http_request.jsonrpc[1])
+    assert stale_response == dict(expected_response, id=2)
+    assert stale_age == 0.0
+
+
+async def test_no_stale_responses_without_grace():
+    from jussi.cache.cache_group import CacheGroup
+
+    from .conftest import make_request
+
+    http_request = make_request(body=req)
+    cache_group = CacheGroup([])
+    await cache_group.cache_single_jsonrpc_response(request=http_request.jsonrpc,
+                                                    response=expected_response)
+    cache_group._memory_cache.clears()
+    assert cache_group.get_stale_jsonrpc_response(http_request.jsonrpc) is None
@@ -2,9 +2,14 @@
 
 
 import pytest
+import ujson
 
+from jussi.cache.backends.redis import Cache
 from jussi.cache.utils import jsonrpc_cache_key
+from jussi.cache.utils import merge_cached_response
 from jussi.request.jsonrpc import JSONRPCRequest
+from jussi.response import SerializedResponse
+from jussi.response import dumps_jsonrpc_response
 from .conftest import make_request
 from jussi.request.jsonrpc import from_http_request as jsonrpc_from_request
 
@@ -72,3 +77,30 @@ def cache_get_batch(loop, caches, cached, jrpc_batch_req, expected):
 
     results = loop.run_until_complete(cache_get_batch(caches, jrpc_batch_req))
     assert results == expected
+
+
+def test_serialized_response():
+    result = ujson.dumps(jrpc_resp_1['result']).encode()
+    cached = merge_cached_response(jrpc_req_1, result)
+    assert isinstance(cached, SerializedResponse)
+    assert ujson.loads(cached.to_bytes()) == {'id': '1', 'jsonrpc': '2.0',
+                                              'result': jrpc_resp_1['result']}
+    assert cached == {'id': '1', 'jsonrpc': '2.0', 'result': jrpc_resp_1['result']}
+
+    # legacy cached responses are still merged as dicts
+    assert merge_cached_response(jrpc_req_1, jrpc_resp_1) == {
+        'id': '1', 'jsonrpc': '2.0', 'result': jrpc_resp_1['result']}
+
+
+def test_dumps_jsonrpc_response():
+    batch = [SerializedResponse(1, b'{"a":1}'), {'id': 2, 'jsonrpc': '2.0', 'result': []}]
+    assert dumps_jsonrpc_response(batch[0]) == b'{"id":1,"jsonrpc":"2.0","result":{"a":1}}'
+    assert ujson.loads(dumps_jsonrpc_response(batch)) == [
+        {'id': 1, 'jsonrpc': '2.0', 'result': {'a': 1}},
+        {'id': 2, 'jsonrpc': '2.0', 'result': []}]
+
+
+def test_redis_cache_keeps_serialized_values():
+    cache = Cache(None)
+    assert cache._unpack(cache._pack(b'{"a":1}')) == b'{"a":1}'
+    assert cache._unpack(cache._pack({'a': 1})) == {'a': 1}
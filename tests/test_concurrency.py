@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from jussi.balancer import Balancer
+from jussi.concurrency import ConcurrencyLimiter
+from jussi.concurrency import ConcurrencyPolicy
+from jussi.errors import UpstreamOverloadError
+from jussi.handlers import fetch_limited
+
+from .conftest import make_request
+
+URL = 'ws://upstream.test'
+
+
+def limiter(**kwargs):
+    return ConcurrencyLimiter(URL, ConcurrencyPolicy(**kwargs))
+
+
+async def test_limiter_queues_and_rejects(loop):
+    limiter_ = limiter(initial_limit=1, max_queue=1)
+    await limiter_.acquire()
+    queued = asyncio.ensure_future(limiter_.acquire())
+    await asyncio.sleep(0)
+    assert limiter_.stats()['queued'] == 1
+
+    # over the limit with a full queue
+    with pytest.raises(UpstreamOverloadError):
+        await limiter_.acquire()
+    assert limiter_.rejected == 1
+
+    # the slot is handed to the queued request
+    limiter_.release(0.01)
+    await queued
+    assert limiter_.in_flight == 1
+    assert limiter_.stats()['queued'] == 0
+
+
+async def test_limiter_cancelled_waiter(loop):
+    limiter_ = limiter(initial_limit=1, max_queue=2)
+    await limiter_.acquire()
+    cancelled = asyncio.ensure_future(limiter_.acquire())
+    queued = asyncio.ensure_future(limiter_.acquire())
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    await asyncio.sleep(0)
+    assert limiter_.stats()['queued'] == 1
+
+    limiter_.release(0.01)
+    await queued
+    assert limiter_.in_flight == 1
+
+
+async def test_limiter_release_after_waiter_cancelled(loop):
+    limiter_ = limiter(initial_limit=1, max_queue=2)
+    await limiter_.acquire()
+    cancelled = asyncio.ensure_future(limiter_.acquire())
+    queued = asyncio.ensure_future(limiter_.acquire())
+    await asyncio.sleep(0)
+    # released before the cancelled acquire runs again
+    cancelled.cancel()
+    limiter_.release(0.01)
+    await queued
+    assert limiter_.in_flight == 1
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
+    assert limiter_.stats()['queued'] == 0
+
+
+def test_limiter_aimd():
+    limiter_ = limiter(initial_limit=10, min_limit=2, backoff_ratio=0.5)
+    # increases while at least half the limit is in use
+    limiter_.in_flight = 5
+    limiter_.record(0.1, method='get_block')
+    assert limiter_.limit == 11
+    limiter_.in_flight = 1
+    limiter_.record(0.1, method='get_block')
+    assert limiter_.limit == 11
+
+    # decreases on failures and on latency over the tolerance
+    limiter_.record(0.1, failed=True, method='get_block')
+    assert limiter_.limit == 5
+    limiter_.record(0.5, method='get_block')
+    assert limiter_.limit == 2
+    limiter_.record(0.5, method='get_block')
+    assert limiter_.limit == 2
+    assert limiter_.baselines == {'get_block': pytest.approx(0.1)}
+
+
+def test_limiter_baseline_per_method():
+    limiter_ = limiter(initial_limit=10)
+    limiter_.record(0.005, method='get_block')
+    # a naturally slow method has its own baseline
+    limiter_.record(0.2, method='get_state')
+    limiter_.record(0.2, method='get_state')
+    # requests without a method are only checked for failures
+    limiter_.record(5.0)
+    assert limiter_.limit == 10
+    assert set(limiter_.stats()['baseline_latency']) == {'get_block', 'get_state'}
+
+
+async def test_limiter_cancelled_requests_are_not_failures(loop):
+    limiter_ = limiter(initial_limit=10)
+    with pytest.raises(asyncio.CancelledError):
+        async with limiter_.admit('get_block'):
+            raise asyncio.CancelledError()
+    assert limiter_.in_flight == 0
+    assert limiter_.limit == 10
+    assert limiter_.baselines == {}
+
+    with pytest.raises(ConnectionError):
+        async with limiter_.admit('get_block'):
+            raise ConnectionError()
+    assert limiter_.in_flight == 0
+    assert limiter_.limit == 9
+
+
+async def test_fetch_limited(loop):
+    http_request = make_request(body={'id': 1, 'jsonrpc': '2.0', 'method': 'get_block',
+                                      'params': [1000]})
+    limiter_ = limiter(initial_limit=1, max_queue=0)
+
+    async def fetch(http_request, jrpc_request):
+        await asyncio.sleep(0.01)
+        return {'id': jrpc_request.id, 'jsonrpc': '2.0', 'result': None}
+
+    admitted = asyncio.ensure_future(
+        fetch_limited(http_request, http_request.jsonrpc, fetch, limiter_))
+    await asyncio.sleep(0)
+    with pytest.raises(UpstreamOverloadError):
+        await fetch_limited(http_request, http_request.jsonrpc, fetch, limiter_)
+    assert (await admitted)['id'] == 1
+    assert limiter_.in_flight == 0
+    assert set(limiter_.baselines) == {'database_api.get_block'}
+
+
+def test_balancer_limiter():
+    assert Balancer([URL]).limiter is None
+    balancer = Balancer([URL, 'ws://other.test'], concurrency=ConcurrencyPolicy())
+    assert balancer.limiter.url == 'ws://upstream.test ws://other.test'
+    assert balancer.stats()['concurrency']['limit'] == ConcurrencyPolicy().initial_limit
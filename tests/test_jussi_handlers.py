@@ -1,9 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
 import json
 import ujson
 import pytest
 
+from jussi.errors import UpstreamResponseError
+from jussi.handlers import fetch_coalesced
+from jussi.handlers import fetch_hedged
+from jussi.handlers import split_upstream_batch_response
+from jussi.request.jsonrpc import from_http_request as jsonrpc_from_request
+
+from .conftest import make_request
+
 correct_get_block_1000_response = {
     "id": 1,
     "result":
@@ -104,3 +113,165 @@ async def test_content_encoding(mocker, mocked_app_test_cli, jsonrpc_request,
     assert json.loads(test_request) == utf8_request
     assert json.loads(test_request)[
         'params'][2][0]['operations'][0][1]['body'] == "「又遲到了！」年輕人醒來的時候，已時八時三十分。"
+
+
+async def test_fetch_coalesced_shares_upstream_request(loop):
+    http_request = make_request()
+    http_request.app.config.upstream_requests_in_flight = dict()
+    jrpc_requests = [jsonrpc_from_request(http_request, 0, {
+        'id': _id, 'jsonrpc': '2.0', 'method': 'get_dynamic_global_properties'})
+        for _id in range(5)]
+    calls = []
+
+    async def fetch(http_request, jrpc_request):
+        calls.append(jrpc_request)
+        await asyncio.sleep(0.01)
+        return {'id': jrpc_request.id, 'jsonrpc': '2.0', 'result': {'head_block_number': 1}}
+
+    responses = await asyncio.gather(*[fetch_coalesced(http_request, r, fetch)
+                                       for r in jrpc_requests])
+    assert len(calls) == 1
+    assert [r['id'] for r in responses] == list(range(5))
+    assert all(r['result'] == {'head_block_number': 1} for r in responses)
+    assert http_request.app.config.upstream_requests_in_flight == {}
+
+    # completed requests are not shared
+    await fetch_coalesced(http_request, jrpc_requests[0], fetch)
+    assert len(calls) == 2
+
+
+async def test_fetch_coalesced_shares_upstream_errors(loop):
+    http_request = make_request()
+    http_request.app.config.upstream_requests_in_flight = dict()
+    jrpc_request = jsonrpc_from_request(http_request, 0, {
+        'id': 1, 'jsonrpc': '2.0', 'method': 'get_dynamic_global_properties'})
+
+    async def fetch(http_request, jrpc_request):
+        await asyncio.sleep(0.01)
+        raise ValueError('upstream error')
+
+    results = await asyncio.gather(fetch_coalesced(http_request, jrpc_request, fetch),
+                                   fetch_coalesced(http_request, jrpc_request, fetch),
+                                   return_exceptions=True)
+    assert all(isinstance(r, ValueError) for r in results)
+    assert http_request.app.config.upstream_requests_in_flight == {}
+
+
+def hedged_request(http_request, hedge=0.01):
+    jrpc_request = jsonrpc_from_request(http_request, 0, {
+        'id': 1, 'jsonrpc': '2.0', 'method': 'get_dynamic_global_properties'})
+    jrpc_request.upstream = jrpc_request.upstream._replace(hedge=hedge)
+    return jrpc_request
+
+
+@pytest.mark.parametrize('delays,calls,winner', [
+    # fast responses are never hedged
+    ([0, 0.05], 1, 0),
+    # the hedge wins when the first request is slow
+    ([0.05, 0], 2, 1),
+    # the first request still wins if it finishes before the hedge
+    ([0.02, 0.05], 2, 0),
+])
+async def test_fetch_hedged(loop, delays, calls, winner):
+    http_request = make_request()
+    jrpc_request = hedged_request(http_request)
+    sent = []
+
+    async def fetch(http_request, jrpc_request):
+        attempt = len(sent)
+        sent.append(attempt)
+        await asyncio.sleep(delays[attempt])
+        return {'id': 1, 'jsonrpc': '2.0', 'result': attempt}
+
+    response = await fetch_hedged(http_request, jrpc_request, fetch)
+    assert response['result'] == winner
+    assert len(sent) == calls
+    # the slower request finishes in the background
+    await asyncio.sleep(0.05)
+
+
+async def test_fetch_hedged_errors(loop):
+    http_request = make_request()
+    jrpc_request = hedged_request(http_request)
+    sent = []
+
+    async def fetch(http_request, jrpc_request):
+        sent.append(jrpc_request)
+        await asyncio.sleep(0.02)
+        if len(sent) == 1:
+            raise ValueError('upstream error')
+        return {'id': 1, 'jsonrpc': '2.0', 'result': 'hedge'}
+
+    # the first request failing doesn't fail a hedged request
+    response = await fetch_hedged(http_request, jrpc_request, fetch)
+    assert response['result'] == 'hedge'
+
+    async def failing_fetch(http_request, jrpc_request):
+        await asyncio.sleep(0.02)
+        raise ValueError('upstream error')
+
+    with pytest.raises(ValueError):
+        await fetch_hedged(http_request, jrpc_request, failing_fetch)
+
+
+async def test_upstream_batch_forwarding(app, mocked_app_test_cli):
+    mocked_ws_conn, test_cli = mocked_app_test_cli
+    app.config.args.upstream_batch_forwarding = True
+    batch_request = [
+        {'id': 'a', 'jsonrpc': '2.0', 'method': 'get_block', 'params': [1000]},
+        {'id': 'b', 'jsonrpc': '2.0', 'method': 'get_block', 'params': [1001]},
+        {'id': 'c', 'jsonrpc': '2.0', 'method': 'get_block', 'params': [1002]}
+    ]
+    # upstream ids are x-jussi-request-id + batch_index, returned out of order
+    mocked_ws_conn.recv.return_value = json.dumps([
+        {'id': 3, 'jsonrpc': '2.0', 'result': 1002},
+        {'id': 1, 'jsonrpc': '2.0', 'result': 1000},
+        {'id': 2, 'jsonrpc': '2.0', 'result': 1001}
+    ])
+    response = await test_cli.post('/', json=batch_request,
+                                   headers={'x-jussi-request-id': '1'})
+    assert await response.json() == [
+        {'id': 'a', 'jsonrpc': '2.0', 'result': 1000},
+        {'id': 'b', 'jsonrpc': '2.0', 'result': 1001},
+        {'id': 'c', 'jsonrpc': '2.0', 'result': 1002}
+    ]
+    assert mocked_ws_conn.send.call_count == 1
+    upstream_request = json.loads(mocked_ws_conn.send.call_args[0][0])
+    assert [r['id'] for r in upstream_request] == [1, 2, 3]
+    assert [r['params'] for r in upstream_request] == [[1000], [1001], [1002]]
+
+
+def test_split_upstream_batch_response():
+    http_request = make_request()
+    jrpc_requests = [jsonrpc_from_request(http_request, i, {
+        'id': f'id{i}', 'jsonrpc': '2.0', 'method': 'get_block', 'params': [i]})
+        for i in range(3)]
+    upstream_ids = [r.upstream_id for r in jrpc_requests]
+    upstream_response = [{'id': upstream_id, 'jsonrpc': '2.0', 'result': upstream_id}
+                         for upstream_id in reversed(upstream_ids)]
+    responses = split_upstream_batch_response(jrpc_requests, upstream_response)
+    assert [r['id'] for r in responses] == ['id0', 'id1', 'id2']
+    assert [r['result'] for r in responses] == upstream_ids
+
+    with pytest.raises(UpstreamResponseError):
+        split_upstream_batch_response(jrpc_requests, upstream_response[:2])
+    with pytest.raises(UpstreamResponseError):
+        split_upstream_batch_response(jrpc_requests, {'id': None, 'error': {}})
+
+
+@pytest.mark.parametrize('upstream_response,expected', [
+    ('{"id":7,"jsonrpc":"2.0","result":{"id":7,"block_id":"0000"}}',
+     b'{"id":"a","jsonrpc":"2.0","result":{"id":7,"block_id":"0000"}}'),
+    # responses that can't be rewritten in place are decoded as before
+    ('{"jsonrpc":"2.0","id":7,"result":1000}',
+     b'{"jsonrpc":"2.0","id":"a","result":1000}'),
+])
+async def test_upstream_response_passthrough(app, mocked_app_test_cli,
+                                             upstream_response, expected):
+    mocked_ws_conn, test_cli = mocked_app_test_cli
+    app.config.args.upstream_response_passthrough = True
+    mocked_ws_conn.recv.return_value = upstream_response
+    response = await test_cli.post('/', json={
+        'id': 'a', 'jsonrpc': '2.0', 'method': 'get_block', 'params': [1000]},
+        headers={'x-jussi-request-id': '7'})
+    assert await response.read() == expected
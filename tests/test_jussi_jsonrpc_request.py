@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 import os
 from copy import deepcopy
+import pytest
 import ujson
 
 from jussi.upstream import _Upstreams
 from jussi.request.jsonrpc import JSONRPCRequest
+from jussi.request.jsonrpc import from_http_request_json
 
 from .conftest import TEST_UPSTREAM_CONFIG
 from .conftest import AttrDict
@@ -124,6 +126,53 @@ def upstream_request(urn_test_request_dict):
                                                               ensure_ascii=False)
 
 
+def test_from_http_request_json(urn_test_request_dict):
+    jsonrpc_request, urn, url, ttl, timeout = urn_test_request_dict
+    dummy_request = make_request()
+    jussi_request = from_http_request_json(dummy_request, jsonrpc_request)
+    assert jussi_request.urn == urn
+    assert jussi_request.upstream.url == url
+
+    batch = from_http_request_json(dummy_request, [jsonrpc_request] * 3)
+    assert [r.batch_index for r in batch] == [0, 1, 2]
+    assert all(r.urn == urn for r in batch)
+
+
+@pytest.mark.parametrize('cache_key_digest,canonical_cache_keys', [
+    (False, False), (True, False), (False, True), (True, True)
+])
+def test_from_http_request_json_cache_key(urn_test_request_dict,
+                                          cache_key_digest, canonical_cache_keys):
+    from jussi.cache.cache_group import CacheGroup
+    jsonrpc_request, urn, url, ttl, timeout = urn_test_request_dict
+    dummy_request = make_request()
+    assert from_http_request_json(dummy_request, jsonrpc_request).cache_key is None
+
+    cache_group = CacheGroup([], cache_key_digest=cache_key_digest,
+                             canonical_cache_keys=canonical_cache_keys)
+    dummy_request.app.config.cache_group = cache_group
+    jussi_request = from_http_request_json(dummy_request, jsonrpc_request)
+    assert jussi_request.cache_key == cache_group.cache_key(jussi_request.urn)
+    assert cache_group._cache_key(jussi_request) == jussi_request.cache_key
+    batch = from_http_request_json(dummy_request, [jsonrpc_request] * 2)
+    assert [r.cache_key for r in batch] == [jussi_request.cache_key] * 2
+
+
+@pytest.mark.parametrize('request_json', [
+    {'id': 1, 'jsonrpc': '2.0', 'method': 'get_block', 'params': [1], 'x': 1},
+    {'id': 1, 'jsonrpc': '1.0', 'method': 'get_block'},
+    {'id': [], 'jsonrpc': '2.0', 'method': 'get_block'},
+    {'id': 1, 'jsonrpc': '2.0', 'method': 'get_block', 'params': 1},
+    [{'id': 1, 'jsonrpc': '2.0', 'method': 'get_block'}, {'id': 2, 'method': 'get_block'}],
+    [{'id': 1, 'jsonrpc': '2.0', 'method': 'get_block'}, 1],
+    [],
+    'get_block'
+])
+def test_from_http_request_json_invalid(request_json):
+    with pytest.raises(Exception):
+        from_http_request_json(make_request(), request_json)
+
+
 def test_log_extra():
     # TODO
     pass
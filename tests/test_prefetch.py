@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from collections import deque
+from types import SimpleNamespace
+
+import pytest
+from ujson import dumps
+from ujson import loads
+
+from jussi.cache.cache_group import CacheGroup
+from jussi.prefetch import BlockPrefetcher
+from jussi.prefetch import get_block_request
+from jussi.retries import RetryBudget
+
+from .conftest import make_request
+
+
+def get_block(block_num, _id=1):
+    return {'id': _id, 'jsonrpc': '2.0', 'method': 'get_block', 'params': [block_num]}
+
+
+def get_block_response(block_num, _id=1):
+    return {'id': _id, 'jsonrpc': '2.0',
+            'result': {'block_id': f'{block_num:08x}' + 'ab' * 16}}
+
+
+class FakeConnection:
+    """answers get_block requests, records the blocks requested"""
+
+    def __init__(self):
+        self.fetched = []
+        self._pending = deque()
+
+    async def send(self, message):
+        request = loads(message)
+        self.fetched.append(request['params'][0])
+        self._pending.append(request)
+
+    async def recv(self):
+        request = self._pending.popleft()
+        return dumps(get_block_response(request['params'][0], _id=request['id']))
+
+
+class FakePool:
+    def __init__(self):
+        self.connection = FakeConnection()
+
+    async def acquire(self):
+        return self.connection
+
+    async def release(self, connection):
+        pass
+
+
+@pytest.fixture
+def prefetch_app():
+    app = make_request().app
+    app.config.cache_group = CacheGroup([])
+    app.config.last_irreversible_block_num = 80
+    app.config.args = SimpleNamespace(websocket_multiplex=False,
+                                      upstream_response_passthrough=False,
+                                      upstream_request_coalescing=False)
+    app.config.upstream_retry_budget = RetryBudget()
+    pool = FakePool()
+    app.config.websocket_pools = {'wss://steemd.steemitdev.com': pool}
+    app.config.fetched = pool.connection.fetched
+    return app
+
+
+async def cached_block(app, block_num):
+    http_request = make_request(body=get_block(block_num), app=app)
+    return await app.config.cache_group.get_single_jsonrpc_response(http_request.jsonrpc)
+
+
+async def test_block_prefetcher(prefetch_app):
+    app = prefetch_app
+    prefetcher = BlockPrefetcher(depth=3, max_distance=20)
+    prefetcher.advance(app, 100)
+
+    prefetcher.schedule(app, make_request(body=get_block(99), app=app).jsonrpc)
+    await asyncio.sleep(0.01)
+    # blocks after the head block wait for it to advance
+    assert app.config.fetched == [100]
+    assert await cached_block(app, 100) == get_block_response(100)
+    assert prefetcher.stats() == {'head_block_number': 100, 'scheduled': 3, 'pending': 2}
+
+    prefetcher.advance(app, 101)
+    await asyncio.sleep(0.01)
+    assert app.config.fetched == [100, 101]
+    assert await cached_block(app, 101) == get_block_response(101)
+
+    # blocks are prefetched once
+    prefetcher.schedule(app, make_request(body=get_block(100), app=app).jsonrpc)
+    await asyncio.sleep(0.01)
+    assert app.config.fetched == [100, 101]
+    assert prefetcher.stats()['pending'] == 2
+
+    prefetcher.advance(app, 103)
+    await asyncio.sleep(0.01)
+    assert sorted(app.config.fetched) == [100, 101, 102, 103]
+
+
+async def test_block_prefetcher_ignores_distant_blocks(prefetch_app):
+    app = prefetch_app
+    prefetcher = BlockPrefetcher(depth=3, max_distance=20)
+    prefetcher.schedule(app, make_request(body=get_block(99), app=app).jsonrpc)
+    prefetcher.advance(app, 100)
+    prefetcher.schedule(app, make_request(body=get_block(50), app=app).jsonrpc)
+    # blocks far past the head don't accumulate
+    for i in range(10):
+        prefetcher.schedule(app, make_request(body=get_block(10**9 + i), app=app).jsonrpc)
+    prefetcher.schedule(app, make_request(body=get_block(104), app=app).jsonrpc)
+    prefetcher.schedule(app, make_request(
+        body={'id': 1, 'jsonrpc': '2.0', 'method': 'get_block_header', 'params': [99]},
+        app=app).jsonrpc)
+    await asyncio.sleep(0.01)
+    assert app.config.fetched == []
+    assert prefetcher.stats() == {'head_block_number': 100, 'scheduled': 0, 'pending': 0}
+
+
+@pytest.mark.parametrize('namespace,api,flavor,expected', [
+    ('steemd', 'database_api', 'condenser',
+     {'id': 5, 'jsonrpc': '2.0', 'method': 'get_block', 'params': [5]}),
+    ('appbase', 'condenser_api', 'condenser',
+     {'id': 5, 'jsonrpc': '2.0', 'method': 'condenser_api.get_block', 'params': [5]}),
+    ('appbase', 'block_api', 'block_api',
+     {'id': 5, 'jsonrpc': '2.0', 'method': 'block_api.get_block',
+      'params': {'block_num': 5}}),
+])
+def test_get_block_request(namespace, api, flavor, expected):
+    assert get_block_request(namespace, api, flavor, 5) == expected
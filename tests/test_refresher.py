@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from types import SimpleNamespace
+
+from ujson import dumps
+from ujson import loads
+
+from jussi import refresher
+from jussi.cache.cache_group import CacheGroup
+from jussi.retries import RetryBudget
+from jussi.upstream import _Upstreams
+
+from .conftest import TEST_UPSTREAM_CONFIG
+from .conftest import make_request
+
+HOT_REQUESTS = [{'method': 'get_block', 'params': [1000]}]
+
+
+def make_app(hot_requests=HOT_REQUESTS):
+    app = make_request().app
+    app.config.upstreams = _Upstreams(TEST_UPSTREAM_CONFIG, validate=False)
+    app.config.cache_group = CacheGroup([])
+    app.config.last_irreversible_block_num = None
+    app.config.args = SimpleNamespace(head_state_refresh_interval=0.01,
+                                      cache_hot_requests=hot_requests,
+                                      websocket_multiplex=False,
+                                      upstream_response_passthrough=False,
+                                      upstream_request_coalescing=False)
+    app.config.upstream_retry_budget = RetryBudget()
+    return app
+
+
+class FakeConnection:
+    """answers every request with the head state of block 2000"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(loads(message))
+
+    async def recv(self):
+        response = head_state_response(2000)
+        response['id'] = self.sent[-1]['id']
+        return dumps(response)
+
+
+class FakePool:
+    def __init__(self):
+        self.connection = FakeConnection()
+
+    async def acquire(self):
+        return self.connection
+
+    async def release(self, connection):
+        pass
+
+
+def head_state_response(head_block_number):
+    return {'id': 0, 'jsonrpc': '2.0',
+            'result': {'head_block_number': head_block_number,
+                       'last_irreversible_block_num': head_block_number - 20}}
+
+
+async def test_refresher(monkeypatch):
+    app = make_app()
+    head_block_numbers = iter([2000, 2000, 2001])
+    calls = []
+
+    async def dispatch_single(http_request, jrpc_request):
+        calls.append(jrpc_request.method)
+        if jrpc_request.method == 'get_dynamic_global_properties':
+            return head_state_response(next(head_block_numbers, 2001))
+        return {'id': jrpc_request.id, 'jsonrpc': '2.0',
+                'result': {'block_id': '000003e8'}}
+    monkeypatch.setattr(refresher, 'dispatch_single', dispatch_single)
+
+    task = asyncio.ensure_future(refresher.run_refresher(app))
+    for _ in range(100):
+        if calls.count('get_dynamic_global_properties') > 3:
+            break
+        await asyncio.sleep(0.01)
+    task.cancel()
+
+    assert app.config.last_irreversible_block_num == 1981
+    assert app.config.cache_group._memory_cache.gets('last_irreversible_block_num') == 1981
+    # hot requests are refreshed once per new head block
+    assert calls[:5] == ['get_dynamic_global_properties', 'get_block',
+                         'get_dynamic_global_properties',
+                         'get_dynamic_global_properties', 'get_block']
+    assert 'get_block' not in calls[5:]
+
+    http_request = make_request(body={'id': 7, 'jsonrpc': '2.0',
+                                      'method': 'get_block', 'params': [1000]},
+                                app=app)
+    cached = await app.config.cache_group.get_single_jsonrpc_response(http_request.jsonrpc)
+    assert cached == {'id': 7, 'jsonrpc': '2.0', 'result': {'block_id': '000003e8'}}
+
+
+async def test_refresher_survives_upstream_errors(monkeypatch):
+    app = make_app()
+    app.config.last_irreversible_block_num = 1
+
+    async def dispatch_single(http_request, jrpc_request):
+        raise ConnectionError('upstream down')
+    monkeypatch.setattr(refresher, 'dispatch_single', dispatch_single)
+
+    task = asyncio.ensure_future(refresher.run_refresher(app))
+    await asyncio.sleep(0.025)
+    assert not task.done()
+    task.cancel()
+    assert app.config.last_irreversible_block_num == 1
+
+
+async def test_refresher_upstream_request():
+    app = make_app()
+    pool = FakePool()
+    app.config.websocket_pools = {'wss://steemd.steemitdev.com': pool}
+
+    assert await refresher.refresh_head_state(app) == 2000
+    assert app.config.last_irreversible_block_num == 1980
+    upstream_request = pool.connection.sent[0]
+    assert upstream_request['method'] == 'get_dynamic_global_properties'
+    assert isinstance(upstream_request['id'], int)
+
+    # every refresher request has its own numeric request id
+    http_request = refresher.refresher_request(app, refresher.HEAD_STATE_REQUEST)
+    other_http_request = refresher.refresher_request(app, refresher.HEAD_STATE_REQUEST)
+    assert http_request.jussi_request_id != other_http_request.jussi_request_id
+    assert http_request.jsonrpc.to_upstream_request(as_json=False)['id'] == \
+        int(http_request.jussi_request_id)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import pytest
+import ujson
+
+from jussi.response import RawResponse
+from jussi.response import dumps_jsonrpc_response
+
+
+@pytest.mark.parametrize('upstream_response,expected', [
+    (b'{"id":10,"jsonrpc":"2.0","result":{"id":10}}',
+     b'{"id":"a","jsonrpc":"2.0","result":{"id":10}}'),
+    ('{"jsonrpc":"2.0","result":[1,2],"id":10}',
+     b'{"jsonrpc":"2.0","result":[1,2],"id":"a"}'),
+    (b'{"jsonrpc":"2.0","result":{"id":1},"id":10}\n',
+     b'{"jsonrpc":"2.0","result":{"id":1},"id":"a"}'),
+])
+def test_raw_response_from_upstream(upstream_response, expected):
+    raw = RawResponse.from_upstream(upstream_response, 10, 'a')
+    assert raw.to_bytes() == expected
+    assert raw.with_id(None).to_dict()['id'] is None
+    assert raw == ujson.loads(expected)
+
+
+@pytest.mark.parametrize('upstream_response', [
+    # id not first or last
+    b'{"jsonrpc":"2.0","id":10,"result":1}',
+    # different id
+    b'{"id":100,"jsonrpc":"2.0","result":1}',
+    b'{"jsonrpc":"2.0","result":1,"id":1}',
+    # nested ids only
+    b'{"jsonrpc":"2.0","result":{"id":10}}',
+    b'{"jsonrpc":"2.0","result":[{"x":1,"id":10}]}',
+    b'[{"id":10,"jsonrpc":"2.0","result":1}]',
+])
+def test_raw_response_from_upstream_not_rewritable(upstream_response):
+    assert RawResponse.from_upstream(upstream_response, 10, 'a') is None
+
+
+def test_dumps_jsonrpc_response_raw():
+    raw = RawResponse.from_upstream(b'{"id":10,"jsonrpc":"2.0","result":1}', 10, 1)
+    assert ujson.loads(dumps_jsonrpc_response([raw, {'id': 2, 'result': 2}])) == [
+        {'id': 1, 'jsonrpc': '2.0', 'result': 1}, {'id': 2, 'result': 2}]
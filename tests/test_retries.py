@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+from types import SimpleNamespace
+
+import pytest
+import ujson
+from websockets.exceptions import ConnectionClosed
+
+from jussi.handlers import dispatch_upstream_batch
+from jussi.handlers import fetch_retried
+from jussi.retries import RetryBudget
+
+from .conftest import make_request
+
+
+def test_retry_budget():
+    budget = RetryBudget(ratio=0.5, burst=2)
+    assert budget.withdraw() is True
+    assert budget.withdraw() is True
+    assert budget.withdraw() is False
+    budget.deposit()
+    assert budget.withdraw() is False
+    budget.deposit()
+    assert budget.withdraw() is True
+    assert budget.stats() == {'ratio': 0.5, 'balance': 0.0, 'retries': 3, 'exhausted': 2}
+
+    # deposits never exceed the burst
+    for _ in range(10):
+        budget.deposit()
+    assert budget.balance == 2
+
+    # one retry per request in a batch
+    budget.deposit(2)
+    assert budget.withdraw(3) is False
+    assert budget.withdraw(2) is True
+    assert budget.balance == 0
+
+
+def retried_request(retries, budget=None):
+    http_request = make_request(body={
+        'id': 1, 'jsonrpc': '2.0', 'method': 'get_dynamic_global_properties'})
+    http_request.app.config.upstream_retry_budget = budget or RetryBudget()
+    jrpc_request = http_request.jsonrpc
+    jrpc_request.upstream = jrpc_request.upstream._replace(retries=retries)
+    return http_request, jrpc_request
+
+
+def failing_fetch(errors):
+    errors = list(errors)
+
+    async def fetch(http_request, jrpc_request):
+        fetch.calls += 1
+        if errors:
+            raise errors.pop(0)
+        return {'id': 1, 'jsonrpc': '2.0', 'result': fetch.calls}
+    fetch.calls = 0
+    return fetch
+
+
+@pytest.mark.parametrize('retries,errors,calls', [
+    (1, [ConnectionClosed(1006, '')], 2),
+    (2, [ConnectionResetError(), ConnectionClosed(1006, '')], 3),
+    (3, [ConnectionResetError()], 2),
+])
+async def test_fetch_retried(loop, retries, errors, calls):
+    http_request, jrpc_request = retried_request(retries)
+    fetch = failing_fetch(errors)
+    response = await fetch_retried(http_request, jrpc_request, fetch)
+    assert response['result'] == calls
+    assert fetch.calls == calls
+    assert [t for _, t in jrpc_request.timings
+            if t == 'fetch_retried.retry'] == ['fetch_retried.retry'] * (calls - 1)
+
+
+@pytest.mark.parametrize('retries,errors,calls', [
+    # out of retries
+    (1, [ConnectionResetError(), ConnectionResetError()], 2),
+    # only transient errors are retried
+    (1, [ValueError()], 1),
+])
+async def test_fetch_retried_raises(loop, retries, errors, calls):
+    http_request, jrpc_request = retried_request(retries)
+    fetch = failing_fetch(errors)
+    with pytest.raises(type(errors[-1])):
+        await fetch_retried(http_request, jrpc_request, fetch)
+    assert fetch.calls == calls
+
+
+async def test_fetch_retried_budget_exhausted(loop):
+    budget = RetryBudget(ratio=0.1, burst=1)
+    http_request, jrpc_request = retried_request(3, budget=budget)
+    fetch = failing_fetch([ConnectionResetError()] * 3)
+    with pytest.raises(ConnectionResetError):
+        await fetch_retried(http_request, jrpc_request, fetch)
+    assert fetch.calls == 2
+    assert budget.stats()['exhausted'] == 1
+
+
+async def test_fetch_retried_after_deadline(loop):
+    http_request, jrpc_request = retried_request(3)
+    # the request has already used up its timeout
+    http_request.timings[0] = (http_request.timings[0][0] - 1000, 'http_create')
+    fetch = failing_fetch([ConnectionResetError()])
+    with pytest.raises(ConnectionResetError):
+        await fetch_retried(http_request, jrpc_request, fetch)
+    assert fetch.calls == 1
+
+
+def retried_batch(retries, budget=None):
+    body = [{'id': i, 'jsonrpc': '2.0', 'method': 'get_dynamic_global_properties'}
+            for i in range(2)]
+    http_request = make_request(body=ujson.dumps(body).encode())
+    app = http_request.app
+    app.config.upstream_retry_budget = budget or RetryBudget()
+    app.config.args = SimpleNamespace(websocket_multiplex=False)
+    jrpc_requests = http_request.jsonrpc
+    for r, r_retries in zip(jrpc_requests, retries):
+        r.upstream = r.upstream._replace(retries=r_retries)
+    return http_request, jrpc_requests
+
+
+class FailingConnection:
+    """fails the first batch sent, answers the next ones"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(ujson.loads(message))
+
+    async def recv(self):
+        if len(self.sent) == 1:
+            raise ConnectionClosed(1006, '')
+        return ujson.dumps([{'id': r['id'], 'jsonrpc': '2.0', 'result': 1}
+                            for r in self.sent[-1]])
+
+    def terminate(self):
+        pass
+
+
+class FailingPool:
+    def __init__(self):
+        self.connection = FailingConnection()
+
+    async def acquire(self):
+        return self.connection
+
+    async def release(self, connection):
+        pass
+
+
+async def test_fetch_retried_batch(loop):
+    budget = RetryBudget(ratio=0.1, burst=10)
+    http_request, jrpc_requests = retried_batch([1, 2], budget=budget)
+    fetch = failing_fetch([ConnectionResetError(), ConnectionResetError()])
+    with pytest.raises(ConnectionResetError):
+        await fetch_retried(http_request, jrpc_requests, fetch)
+    # the batch is retried as often as its least retried request
+    assert fetch.calls == 2
+    assert budget.retries == 2
+    for jrpc_request in jrpc_requests:
+        assert [t for _, t in jrpc_request.timings
+                if t == 'fetch_retried.retry'] == ['fetch_retried.retry']
+
+
+@pytest.mark.parametrize('retries,sent', [
+    ([1, 1], 2),
+    # batches with a request which isn't retried, eg a write, aren't
+    ([1, 0], 1),
+])
+async def test_dispatch_upstream_batch_retries(loop, retries, sent):
+    budget = RetryBudget(ratio=0.1, burst=10)
+    # the deposits for the two requests pay for the retry of both
+    budget.balance = 1.8
+    http_request, jrpc_requests = retried_batch(retries, budget=budget)
+    pool = FailingPool()
+    http_request.app.config.websocket_pools = {jrpc_requests[0].upstream.url: pool}
+    if sent == 1:
+        with pytest.raises(ConnectionClosed):
+            await dispatch_upstream_batch(http_request, jrpc_requests)
+    else:
+        responses = await dispatch_upstream_batch(http_request, jrpc_requests)
+        assert [r['id'] for r in responses] == [0, 1]
+    assert len(pool.connection.sent) == sent
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+import pytest
+
+from jussi.cache.backends.shared_memory import PAGE_SIZE
+from jussi.cache.backends.shared_memory import SharedMemoryCache
+from jussi.cache.cache_group import CacheGroup
+
+SMALL_CACHE_SIZE = 4 * PAGE_SIZE
+
+
+@pytest.fixture
+def cache_path(tmpdir):
+    return str(tmpdir.join('jussi-cache'))
+
+
+def test_shared_memory_cache_get_set(cache_path):
+    cache = SharedMemoryCache(cache_path, size=SMALL_CACHE_SIZE)
+    assert cache.gets('key') is None
+    cache.sets('key', {'id': 1, 'result': 'value'}, expire_time=None)
+    assert cache.gets('key') == {'id': 1, 'result': 'value'}
+    cache.sets('key', 'new value', expire_time=None)
+    assert cache.gets('key') == 'new value'
+    cache.sets('bytes', b'{"a":1}', expire_time=None)
+    assert cache.gets('bytes') == b'{"a":1}'
+    cache.set_manys({'key1': 1, 'key2': 2}, expire_time=None)
+    assert cache.mgets(['key1', 'missing', 'key2']) == [1, None, 2]
+    cache.deletes('key1')
+    assert cache.gets('key1') is None
+    cache.clears()
+    assert cache.mgets(['key', 'key2']) == [None, None]
+
+
+def test_shared_memory_cache_expiration(cache_path):
+    cache = SharedMemoryCache(cache_path, size=SMALL_CACHE_SIZE)
+    cache.sets('expires', 'value', expire_time=1)
+    cache.sets('no_expire', 'value', expire_time=None)
+    assert cache.gets('expires') == 'value'
+    time.sleep(1.1)
+    assert cache.gets('expires') is None
+    assert cache.gets('no_expire') == 'value'
+
+
+def test_shared_memory_cache_shared_between_processes(cache_path):
+    cache = SharedMemoryCache(cache_path, size=SMALL_CACHE_SIZE)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            child_cache = SharedMemoryCache(cache_path, size=SMALL_CACHE_SIZE)
+            child_cache.sets('from_child', {'result': [1, 2, 3]}, expire_time=10)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert cache.gets('from_child') == {'result': [1, 2, 3]}
+
+
+def test_shared_memory_cache_reopen_keeps_entries(cache_path):
+    cache = SharedMemoryCache(cache_path, size=SMALL_CACHE_SIZE)
+    cache.sets('key', 'value', expire_time=None)
+    assert SharedMemoryCache(cache_path, size=SMALL_CACHE_SIZE).gets('key') == 'value'
+    # a different layout reinitializes the file
+    assert SharedMemoryCache(cache_path, size=2 * SMALL_CACHE_SIZE).gets('key') is None
+
+
+def test_shared_memory_cache_evicts_when_full(cache_path):
+    cache = SharedMemoryCache(cache_path, size=SMALL_CACHE_SIZE)
+    value = 'x' * 100000
+    for i in range(200):
+        cache.sets(f'key{i}', value, expire_time=None)
+    assert cache.gets('key199') == value
+    assert cache.gets('key0') is None
+    assert cache.stats['pages_used'] == cache.stats['pages']
+
+    # other size classes can't get pages, but existing ones still work
+    cache.sets('small', 'value', expire_time=None)
+    assert cache.gets('key199') == value
+
+
+def test_shared_memory_cache_skips_oversized_values(cache_path):
+    cache = SharedMemoryCache(cache_path, size=SMALL_CACHE_SIZE)
+    cache.sets('key', 'value', expire_time=None)
+    cache.sets('key', 'x' * (PAGE_SIZE + 1), expire_time=None)
+    assert cache.gets('key') is None
+
+
+async def test_cache_group_reads_shared_memory_cache(cache_path):
+    shared_memory_cache = SharedMemoryCache(cache_path, size=SMALL_CACHE_SIZE)
+    cache_group = CacheGroup([], shared_memory_cache=shared_memory_cache)
+    await cache_group.set('key', 'value', expire_time=None)
+    assert shared_memory_cache.gets('key') == 'value'
+
+    # another worker's cache group shares the entry
+    other_cache_group = CacheGroup(
+        [], shared_memory_cache=SharedMemoryCache(cache_path, size=SMALL_CACHE_SIZE))
+    assert other_cache_group._memory_cache.gets('key') is None
+    assert await other_cache_group.mget(['key', 'missing']) == ['value', None]
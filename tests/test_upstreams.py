@@ -203,3 +203,112 @@ def test_hash_ineq():
     upstreams1 = _Upstreams(SIMPLE_CONFIG, validate=False)
     upstreams2 = _Upstreams(VALID_HOSTNAME_CONFIG, validate=False)
     assert hash(upstreams1) != hash(upstreams2)
+
+
+PARAMS_CONFIG = {
+    "limits": {},
+    "upstreams": [
+        {
+            "name": "test",
+            "urls": [
+                ["test", 'http://test.com'],
+                ["test.api.method.params=[1]", 'http://params.test.com'],
+            ],
+            "ttls": [
+                ["test", 1],
+                ["test.api", 2],
+                ["test.api.method.params=['/trending']", 3],
+                ["test.api.method.params=[2889020,false]", 4],
+                ["test.api.method.params={'b': 1, 'a': 2}", 5],
+            ],
+            "timeouts": [
+                ["test", 0]
+            ]
+        }
+    ]}
+
+
+@pytest.mark.parametrize('method,params,url,ttl', [
+    ('test.api.method', [1], 'http://params.test.com', 2),
+    ('test.api.method', [10], 'http://test.com', 2),
+    ('test.api.method', ['/trending'], 'http://test.com', 3),
+    ('test.api.method', ['/trending/x'], 'http://test.com', 2),
+    ('test.api.method', [2889020, False], 'http://test.com', 4),
+    ('test.api.method', {'a': 2, 'b': 1}, 'http://test.com', 5),
+    ('test.api.other', ['/trending'], 'http://test.com', 2),
+    ('test.method', [1], 'http://test.com', 1),
+    ('test.api.method', None, 'http://test.com', 2),
+])
+def test_params_prefixes(method, params, url, ttl):
+    from jussi.urn import from_request
+    request = {'id': 1, 'jsonrpc': '2.0', 'method': method}
+    if params is not None:
+        request['params'] = params
+    urn = from_request(request)
+    upstreams = _Upstreams(PARAMS_CONFIG, validate=False)
+    assert upstreams.url(urn) == url
+    assert upstreams.ttl(urn) == ttl
+    assert upstreams.timeout(urn) is None
+
+
+def test_no_matching_prefix():
+    from jussi.urn import URN
+    upstreams = _Upstreams(SIMPLE_CONFIG, validate=False)
+    urn = URN('other', 'api', 'method', [1])
+    assert upstreams.ttl(urn) is None
+    with pytest.raises(InvalidUpstreamURL):
+        upstreams.url(urn)
+
+
+@pytest.mark.parametrize('api,method,hedge', [
+    ('api', 'method', 0.1),
+    ('slow_api', 'method', 0.5),
+    ('network_broadcast_api', 'broadcast_transaction', None),
+    ('condenser_api', 'broadcast_transaction_synchronous', None),
+])
+def test_hedges(api, method, hedge):
+    from jussi.urn import URN
+    config = {
+        "limits": {},
+        "upstreams": [dict(SIMPLE_CONFIG['upstreams'][0],
+                           hedges=[["test", 0.1],
+                                   ["test.slow_api", 0.5],
+                                   ["test.network_broadcast_api", 0.1]])]}
+    upstreams = _Upstreams(config, validate=False)
+    assert upstreams.hedge(URN('test', api, method, False)) == hedge
+
+
+def test_hedges_not_configured():
+    from jussi.urn import URN
+    upstreams = _Upstreams(SIMPLE_CONFIG, validate=False)
+    assert upstreams.hedge(URN('test', 'api', 'method', False)) is None
+
+
+@pytest.mark.parametrize('api,method,retries', [
+    ('api', 'method', 2),
+    ('network_broadcast_api', 'broadcast_transaction', 0),
+    ('condenser_api', 'broadcast_transaction_synchronous', 0),
+])
+def test_retries(api, method, retries):
+    from jussi.urn import URN
+    config = {
+        "limits": {},
+        "upstreams": [dict(SIMPLE_CONFIG['upstreams'][0], retries=[["test", 2]])]}
+    upstreams = _Upstreams(config, validate=False)
+    assert upstreams.retries(URN('test', api, method, False)) == retries
+    assert _Upstreams(SIMPLE_CONFIG, validate=False).retries(
+        URN('test', api, method, False)) == 0
+
+
+def test_stale_grace():
+    from jussi.urn import URN
+    config = {
+        "limits": {},
+        "upstreams": [dict(SIMPLE_CONFIG['upstreams'][0],
+                           stale_grace=[["test.api", 10]])]}
+    upstreams = _Upstreams(config, validate=False)
+    assert upstreams.stale_grace(URN('test', 'api', 'method', False)) == 10
+    assert upstreams.stale_grace(URN('test', 'other_api', 'method', False)) == 0
+    # the longest ttl plus the longest grace
+    assert upstreams.max_stale_time == 11
+    assert _Upstreams(SIMPLE_CONFIG, validate=False).max_stale_time == 0
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+import ujson
+
+from jussi.ws.multiplex import MultiplexedPool
+
+
+class FakeWSConn:
+    """echoes each request back as a response, answering in reverse order
+    once `batch_size` requests have been sent
+    """
+
+    def __init__(self, batch_size=1):
+        self.open = True
+        self.sent = []
+        self.batch_size = batch_size
+        self.responses = asyncio.Queue()
+
+    async def send(self, message):
+        if message.startswith('['):
+            requests = ujson.loads(message)
+            self.responses.put_nowait(ujson.dumps(
+                [{'id': r['id'], 'jsonrpc': '2.0', 'result': r['params']}
+                 for r in reversed(requests)]))
+            return
+        self.sent.append(message)
+        if len(self.sent) % self.batch_size == 0:
+            for request in reversed(self.sent[-self.batch_size:]):
+                request = ujson.loads(request)
+                self.responses.put_nowait(ujson.dumps(
+                    {'id': request['id'], 'jsonrpc': '2.0', 'result': request['params']}))
+
+    async def recv(self):
+        response = await self.responses.get()
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def fail_connection(self):
+        self.open = False
+
+
+class FakeMultiplexedPool(MultiplexedPool):
+    def __init__(self, conns, *args, **kwargs):
+        self.conns = iter(conns)
+        super().__init__(*args, **kwargs)
+
+    async def _get_new_connection(self):
+        return next(self.conns)
+
+
+def make_pool(loop, conns, size=1):
+    return FakeMultiplexedPool(conns, size, loop, 'ws://127.0.0.1')
+
+
+def upstream_request(upstream_id):
+    return ujson.dumps({'id': upstream_id, 'jsonrpc': '2.0',
+                        'method': 'get_block', 'params': [upstream_id]})
+
+
+async def test_multiplexed_pool_matches_responses_by_id(loop):
+    conn = FakeWSConn(batch_size=10)
+    pool = await make_pool(loop, [conn])
+    responses = await asyncio.gather(*[pool.request(i, upstream_request(i))
+                                       for i in range(10)])
+    assert [r['id'] for r in responses] == list(range(10))
+    assert [r['result'] for r in responses] == [[i] for i in range(10)]
+    assert len(conn.sent) == 10
+    assert pool.in_flight == [0]
+
+
+async def test_multiplexed_pool_spreads_requests(loop):
+    conns = [FakeWSConn(batch_size=2), FakeWSConn(batch_size=2)]
+    pool = await make_pool(loop, conns, size=2)
+    responses = await asyncio.gather(*[pool.request(i, upstream_request(i))
+                                       for i in range(4)])
+    assert [r['id'] for r in responses] == list(range(4))
+    assert [len(c.sent) for c in conns] == [2, 2]
+
+
+async def test_multiplexed_pool_duplicate_ids_use_other_connection(loop):
+    # responses are only read after every request has been sent, so the
+    # duplicate id is still in flight when the second request is routed
+    conns = [FakeWSConn(), FakeWSConn()]
+    pool = await make_pool(loop, conns, size=2)
+    responses = await asyncio.gather(pool.request(1, upstream_request(1)),
+                                     pool.request(1, upstream_request(1)),
+                                     pool.request(2, upstream_request(2)),
+                                     pool.request(3, upstream_request(3)))
+    assert [r['id'] for r in responses] == [1, 1, 2, 3]
+    assert [[ujson.loads(r)['id'] for r in c.sent].count(1) for c in conns] == [1, 1]
+
+
+async def test_multiplexed_pool_duplicate_ids_wait_for_connection(loop):
+    # the third request waits until a connection has answered id 1
+    conns = [FakeWSConn(), FakeWSConn()]
+    pool = await make_pool(loop, conns, size=2)
+    responses = await asyncio.wait_for(
+        asyncio.gather(*[pool.request(1, upstream_request(1)) for _ in range(3)]), 1)
+    assert [r['id'] for r in responses] == [1, 1, 1]
+    assert sum(len(c.sent) for c in conns) == 3
+
+
+async def test_multiplexed_pool_fails_pending_on_closed_connection(loop):
+    conn = FakeWSConn(batch_size=2)
+    replacement = FakeWSConn(batch_size=1)
+    pool = await make_pool(loop, [conn, replacement])
+    future = asyncio.ensure_future(pool.request(1, upstream_request(1)))
+    await asyncio.sleep(0)
+    conn.open = False
+    conn.responses.put_nowait(ConnectionError('closed'))
+    with pytest.raises(ConnectionError):
+        await future
+
+    # a new connection is opened for the next request
+    response = await pool.request(2, upstream_request(2))
+    assert response['id'] == 2
+    assert len(replacement.sent) == 1
+
+
+async def test_multiplexed_pool_request_batch(loop):
+    conn = FakeWSConn()
+    pool = await make_pool(loop, [conn])
+    batch = ujson.dumps([ujson.loads(upstream_request(i)) for i in range(3)])
+    single, responses = await asyncio.gather(pool.request(3, upstream_request(3)),
+                                             pool.request_batch([0, 1, 2], batch))
+    assert single['id'] == 3
+    assert [r['id'] for r in responses] == [0, 1, 2]
+    assert [r['result'] for r in responses] == [[0], [1], [2]]
+    assert pool.in_flight == [0]
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+import jussi.ws.pool
+from jussi.ws.pool import Pool
+
+
+class FakeConnection:
+    def __init__(self, pong=True):
+        self.open = True
+        self.pong = pong
+        self.closed_by_pool = False
+
+    @property
+    def closed(self):
+        return not self.open
+
+    async def ping(self):
+        future = asyncio.get_event_loop().create_future()
+        if self.pong:
+            future.set_result(None)
+        return future
+
+    async def close(self):
+        self.open = False
+        self.closed_by_pool = True
+
+    def fail_connection(self):
+        self.open = False
+
+
+class FakePool(Pool):
+    __slots__ = ('connects', 'failures')
+
+    async def _get_new_connection(self):
+        self.connects += 1
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionRefusedError()
+        return FakeConnection()
+
+
+async def fake_pool(loop, min_size=1, max_size=2, failures=0, **kwargs):
+    pool = FakePool(min_size, max_size, 0, loop, 'ws://upstream.test', **kwargs)
+    pool.connects = 0
+    pool.failures = failures
+    return await pool
+
+
+async def test_pool_connects_min_size(loop):
+    pool = await fake_pool(loop, min_size=2, max_size=3)
+    assert pool.connects == 2
+    conn = await pool.acquire()
+    assert conn.open
+    await pool.release(conn)
+    # acquires use the open connections
+    conn = await pool.acquire()
+    assert pool.connects == 2
+    await pool.release(conn)
+    await pool.close()
+
+
+async def test_pool_connects_for_waiting_requests(loop):
+    pool = await fake_pool(loop, min_size=0, max_size=2)
+    assert pool.connects == 0
+    conns = await asyncio.wait_for(asyncio.gather(pool.acquire(), pool.acquire()), 1)
+    assert all(conn.open for conn in conns)
+    assert pool.connects == 2
+    for conn in conns:
+        await pool.release(conn)
+    await pool.close()
+
+
+async def test_pool_reconnects_with_backoff(loop, monkeypatch):
+    monkeypatch.setattr(jussi.ws.pool, 'RECONNECT_BACKOFF_BASE', 0.001)
+    pool = await fake_pool(loop, min_size=1, max_size=1, failures=3)
+    assert pool._reconnect_failures == 1
+    conn = await asyncio.wait_for(pool.acquire(), 1)
+    assert conn.open
+    assert pool.connects == 4
+    assert pool._reconnect_failures == 0
+    await pool.release(conn)
+    await pool.close()
+
+
+async def test_pool_skips_closed_idle_connections(loop):
+    pool = await fake_pool(loop, min_size=2, max_size=2)
+    conn = await pool.acquire()
+    await pool.release(conn)
+    # the upstream closed the connection while it was idle
+    conn._con.open = False
+    conn = await asyncio.wait_for(pool.acquire(), 1)
+    assert conn.open
+    await pool.release(conn)
+    await pool.close()
+
+
+@pytest.mark.parametrize('kwargs,pong,replaced', [
+    # expired connections
+    (dict(max_age=0.001, ping_interval=0), True, True),
+    # connections which don't answer pings
+    (dict(ping_interval=1, ping_timeout=0.01), False, True),
+    (dict(ping_interval=1, ping_timeout=0.01), True, False),
+])
+async def test_pool_replaces_idle_connections(loop, kwargs, pong, replaced):
+    pool = await fake_pool(loop, min_size=1, max_size=1, **kwargs)
+    old_con = pool._holders[0]._con
+    old_con.pong = pong
+    await asyncio.sleep(0.01)
+    await pool._check_idle()
+    await asyncio.sleep(0)
+    assert (pool._holders[0]._con is not old_con) is replaced
+    assert old_con.closed_by_pool is replaced
+    assert pool._holders[0].is_open
+    await pool.close()
+
+
+async def test_pool_pings_idle_connections_at_once(loop):
+    pool = await fake_pool(loop, min_size=3, max_size=3, ping_interval=1, ping_timeout=0.1)
+    for ch in pool._holders:
+        ch._con.pong = False
+    start = loop.time()
+    await pool._check_idle()
+    # one ping timeout, not one per connection
+    assert loop.time() - start < 0.25
+    assert pool.connects == 6
+    await pool.close()
+
+
+async def test_pool_shrinks_idle_connections(loop):
+    pool = await fake_pool(loop, min_size=1, max_size=3, idle_timeout=0.01)
+    conns = await asyncio.wait_for(asyncio.gather(*[pool.acquire() for _ in range(3)]), 1)
+    assert pool.stats()['size'] == 3
+    for conn in conns:
+        await pool.release(conn)
+    await asyncio.sleep(0.02)
+    await pool._check_idle()
+    assert pool.stats()['size'] == 1
+    # the closed holders are left to the maintainer, not queued
+    assert pool._queue.qsize() == 1
+    assert len(pool._unconnected) == 2
+    assert pool._needed() == 0
+    pool._waiters = 3
+    assert pool._needed() == 2
+    pool._waiters = 0
+
+    # and grows again when needed
+    conns = await asyncio.wait_for(asyncio.gather(*[pool.acquire() for _ in range(3)]), 1)
+    assert pool.stats()['size'] == 3
+    assert pool.stats()['in_use'] == 3
+    for conn in conns:
+        await pool.release(conn)
+    await pool.close()
+
+
+async def test_pool_stats(loop):
+    pool = await fake_pool(loop, min_size=1, max_size=2)
+    conn = await pool.acquire()
+    stats = pool.stats()
+    assert stats['size'] == 1
+    assert stats['in_use'] == 1
+    assert stats['waiters'] == 0
+    assert sum(stats['acquire_wait'].values()) == 1
+    assert stats['acquire_wait']['le_0.001'] == 1
+    await pool.release(conn)
+    await pool.close()